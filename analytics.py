@@ -0,0 +1,227 @@
+#
+# Streaming availability and outage analytics for my network monitor box
+#
+# Probe results are folded into sliding windows (of 1 hour, 24 hours, 7 days
+# and 30 days) made of fixed time buckets as they arrive, so adding a result
+# costs the same, and so does summarizing a window, however long the box has
+# been running. Uptime is weighted by time rather than by probe count (since
+# targets are probed at different rates): the time until a target's next
+# result counts as up if its latest result was good, and as down otherwise.
+# An outage runs from a target's first failed result (after a good one, or
+# its first result) to its next good one. E.g.:
+#    a = Availability()
+#    a.record("router", clock.time(), PROBE_UP)
+#    a.summary(clock.time())["router"]["24h"]["uptime"]
+#
+
+
+import threading
+
+from probes import PROBE_UP
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_ANALYTICS = flag('analytics')
+
+
+# The windows, as (name, span in seconds, number of buckets)
+WINDOWS = (
+  ('1h', 3600, 60),
+  ('24h', 24 * 3600, 96),
+  ('7d', 7 * 24 * 3600, 168),
+  ('30d', 30 * 24 * 3600, 120)
+)
+
+
+# One sliding window of a target's results. Its buckets are kept in a ring,
+# indexed by the absolute bucket number (i.e., time // width) of their time.
+class Window:
+
+  def __init__(self, span, buckets):
+    self.span = span
+    self.buckets = buckets
+    self.width = float(span) / buckets
+    self._slot = None
+    self._up = [0.0] * buckets
+    self._down = [0.0] * buckets
+    self._outages = [0] * buckets
+    self._recoveries = [0] * buckets
+    self._recovery_total = [0.0] * buckets
+    self._longest = [0.0] * buckets
+
+  # Move the window on to the bucket for the given time, clearing the buckets
+  # that drop out of it (at most every bucket, however long it has been)
+  def _advance(self, when):
+    slot = int(when // self.width)
+    if self._slot is None:
+      self._slot = slot
+    elif slot > self._slot:
+      for s in range(max(self._slot + 1, slot - self.buckets + 1), slot + 1):
+        i = s % self.buckets
+        self._up[i] = 0.0
+        self._down[i] = 0.0
+        self._outages[i] = 0
+        self._recoveries[i] = 0
+        self._recovery_total[i] = 0.0
+        self._longest[i] = 0.0
+      self._slot = slot
+
+  # Return the ring index of the bucket for the given time (or None if it is
+  # no longer in the window)
+  def _index(self, when):
+    self._advance(when)
+    slot = int(when // self.width)
+    if slot <= self._slot - self.buckets:
+      return None
+    return slot % self.buckets
+
+  # Count the time in [start, end) as up (or down), across its buckets
+  def add_time(self, start, end, up):
+    self._advance(end)
+    t = max(start, (self._slot - self.buckets + 1) * self.width)
+    totals = self._up if up else self._down
+    while t < end:
+      slot = int(t // self.width)
+      stop = min(end, (slot + 1) * self.width)
+      totals[slot % self.buckets] += stop - t
+      t = stop
+
+  def add_outage(self, when):
+    i = self._index(when)
+    if i is not None:
+      self._outages[i] += 1
+
+  def add_recovery(self, when, duration):
+    i = self._index(when)
+    if i is not None:
+      self._recoveries[i] += 1
+      self._recovery_total[i] += duration
+      self._longest[i] = max(self._longest[i], duration)
+
+  # Return the uptime (in percent, of the time with known state), the number
+  # of outages, the mean time to recovery and the longest outage (including
+  # any ongoing one) in this window
+  def summary(self, now, down_since=None):
+    self._advance(now)
+    up = sum(self._up)
+    known = up + sum(self._down)
+    recoveries = sum(self._recoveries)
+    longest = max(self._longest)
+    if down_since is not None:
+      longest = max(longest, now - down_since)
+    j = dict()
+    j['uptime'] = 100.0 * up / known if known else None
+    j['outages'] = sum(self._outages)
+    j['mttr'] = sum(self._recovery_total) / recoveries if recoveries else None
+    j['longest-outage'] = longest if longest else None
+    return j
+
+  def snapshot(self):
+    j = dict()
+    j['slot'] = self._slot
+    j['up'] = [round(x, 1) for x in self._up]
+    j['down'] = [round(x, 1) for x in self._down]
+    j['outages'] = list(self._outages)
+    j['recoveries'] = list(self._recoveries)
+    j['recovery-total'] = [round(x, 1) for x in self._recovery_total]
+    j['longest'] = [round(x, 1) for x in self._longest]
+    return j
+
+  def restore(self, j):
+    self._slot = j['slot']
+    self._up = [float(x) for x in j['up']]
+    self._down = [float(x) for x in j['down']]
+    self._outages = [int(x) for x in j['outages']]
+    self._recoveries = [int(x) for x in j['recoveries']]
+    self._recovery_total = [float(x) for x in j['recovery-total']]
+    self._longest = [float(x) for x in j['longest']]
+
+
+# The windows of every target (created on demand, by their first result).
+# Gaps of more than max_gap seconds between a target's results (e.g., while
+# the box was down) count as neither up nor down.
+MAX_GAP_SEC = 300
+class Availability:
+
+  def __init__(self, max_gap=MAX_GAP_SEC, windows=WINDOWS):
+    self._max_gap = max_gap
+    self._spec = windows
+    self._windows = {}
+    self._last = {}
+    self._down_since = {}
+    self._lock = threading.Lock()
+
+  def _target(self, name):
+    windows = self._windows.get(name)
+    if windows is None:
+      debug(DEBUG_ANALYTICS, '--> new windows for "%s"', name)
+      windows = self._windows[name] = [Window(span, buckets) for label, span, buckets in self._spec]
+    return windows
+
+  # Add a probe result (the arguments match HistoryStore.record, so the
+  # probe log can be replayed into either). Results must arrive in time order
+  # (for each target); older ones are ignored.
+  def record(self, name, when, status, rtt=None):
+    good = PROBE_UP == status
+    with self._lock:
+      windows = self._target(name)
+      last = self._last.get(name)
+      if last is not None:
+        then, was_good = last
+        if when < then:
+          return
+        if when - then <= self._max_gap:
+          for w in windows:
+            w.add_time(then, when, was_good)
+      if not good and name not in self._down_since:
+        self._down_since[name] = when
+        for w in windows:
+          w.add_outage(when)
+        debug(DEBUG_ANALYTICS, '--> "%s": outage', name)
+      elif good and name in self._down_since:
+        duration = when - self._down_since.pop(name)
+        for w in windows:
+          w.add_recovery(when, duration)
+        debug(DEBUG_ANALYTICS, '--> "%s": recovered after %0.1fs', name, duration)
+      self._last[name] = (when, good)
+
+  # Return the summary of every window of every target, as
+  # {name: {window: {"uptime": ..., "outages": ..., ...}}}
+  def summary(self, now):
+    j = dict()
+    with self._lock:
+      for name, windows in self._windows.items():
+        j[name] = dict()
+        for (label, span, buckets), w in zip(self._spec, windows):
+          j[name][label] = w.summary(now, self._down_since.get(name))
+    return j
+
+  # Return the state of every window of every target, as a JSON serializable
+  # object (to be restored after a restart)
+  def snapshot(self):
+    j = dict()
+    with self._lock:
+      for name, windows in self._windows.items():
+        t = j[name] = dict()
+        t['last'] = self._last.get(name)
+        t['down-since'] = self._down_since.get(name)
+        t['windows'] = dict()
+        for (label, span, buckets), w in zip(self._spec, windows):
+          t['windows'][label] = w.snapshot()
+    return j
+
+  # Restore a snapshot (skipping any window whose size has since changed)
+  def restore(self, j):
+    with self._lock:
+      for name, t in j.items():
+        windows = self._target(name)
+        if t.get('last') is not None:
+          self._last[name] = (t['last'][0], t['last'][1])
+        if t.get('down-since') is not None:
+          self._down_since[name] = t['down-since']
+        for (label, span, buckets), w in zip(self._spec, windows):
+          saved = t.get('windows', {}).get(label)
+          if saved is not None and len(saved['up']) == buckets:
+            w.restore(saved)
+
@@ -0,0 +1,426 @@
+#
+# Benchmarks for my network monitor box
+#
+# These run on any Linux box (no Pi needed), on the simulated board and the
+# real clock, with local stand-ins for the things the box watches: an HTTP
+# (and TCP) server in a process of its own, and ICMP to the loopback address.
+# They measure:
+#    probes - probes completed per second by the ProbeEngine, as the number
+#             of targets grows
+#    api    - requests per second (and the latency percentiles) of "/", on
+#             the whole daemon
+#    button - the latency from a button edge to the write of its LED's pin
+#    idle   - the wakeups per second, CPU use and RSS of the whole daemon
+#             while nothing but its probes is going on
+# The results are written as JSON, so runs can be compared. Everything runs in
+# the MY_RUNTIME mode (the default is "threads"). E.g.:
+#    python bench.py --out bench.json
+#    MY_RUNTIME=loop python bench.py --only idle,api --seconds 20
+#
+
+
+import os
+import sys
+
+# Always the simulated board, and the real clock
+os.environ['MY_GPIO_BACKEND'] = 'sim'
+os.environ['MY_CLOCK_SCALE'] = '1'
+
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing
+import platform
+import selectors
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+import hal
+from hal import SimulatedBoard
+import runtime
+from probes import ProbeEngine, TCPProbe, ICMPProbe, PROBE_UP, icmp_socket
+from chk_wifi import HTTPProbe
+from scheduler import AdaptiveSchedule
+from buttons import Button
+from rgb_leds import RGB_LED
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_BENCH = flag('bench')
+
+
+# Return the given percentile (0-100) of a list of numbers (nearest rank)
+def percentile(values, p):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+# Return the usual summary of a list of latencies (in ms)
+def latencies(seconds):
+  j = dict()
+  j['count'] = len(seconds)
+  for p in (50, 90, 99):
+    j['p%d-ms' % p] = None if not seconds else round(percentile(seconds, p) * 1000.0, 3)
+  j['max-ms'] = None if not seconds else round(max(seconds) * 1000.0, 3)
+  return j
+
+
+# The HTTP (and TCP) stand-in: answers every request with a 200 and closes the
+# connection, on a single (non-blocking) loop in a process of its own, so it
+# does not compete with what is being measured for the interpreter
+STAND_IN_ANSWER = b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+def serve_stand_in(listener):
+  signal.signal(signal.SIGINT, signal.SIG_DFL)
+  selector = selectors.DefaultSelector()
+  listener.setblocking(False)
+  selector.register(listener, selectors.EVENT_READ)
+  requests = {}
+  while True:
+    for key, _ in selector.select():
+      sock = key.fileobj
+      if sock is listener:
+        try:
+          conn, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+          continue
+        conn.setblocking(False)
+        requests[conn] = b''
+        selector.register(conn, selectors.EVENT_READ)
+        continue
+      try:
+        data = sock.recv(4096)
+      except (BlockingIOError, InterruptedError):
+        continue
+      except OSError:
+        data = b''
+      requests[sock] += data
+      if data and b'\r\n\r\n' not in requests[sock]:
+        continue
+      if data:
+        try:
+          sock.send(STAND_IN_ANSWER)
+        except OSError:
+          pass
+      selector.unregister(sock)
+      del requests[sock]
+      sock.close()
+
+# Start the stand-in, returning (process, port)
+def start_stand_in():
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind(('127.0.0.1', 0))
+  listener.listen(1024)
+  process = multiprocessing.get_context('fork').Process(target=serve_stand_in, args=(listener,), daemon=True)
+  process.start()
+  port = listener.getsockname()[1]
+  listener.close()
+  return process, port
+
+# Return whether ICMP probes can be sent from here
+def icmp_available():
+  try:
+    sock, raw = icmp_socket()
+    sock.close()
+    return True
+  except OSError:
+    return False
+
+
+# Probes completed per second, for each number of targets. Every target is
+# probed every interval (a mix of HTTP, TCP and, if possible, ICMP probes of
+# the stand-ins), so the offered rate is targets / interval, and the engine
+# keeps up with it until it saturates. (The loops use select(), so the targets
+# must stay well under its limit of 1024 sockets.)
+PROBE_TARGETS = (10, 50, 100, 250)
+PROBE_INTERVAL_SEC = 0.1
+PROBE_WARMUP_SEC = 2.0
+def bench_probes(port, targets, seconds):
+  kinds = [lambda i: HTTPProbe('http-%d' % i, '127.0.0.1:%d' % port), lambda i: TCPProbe('tcp-%d' % i, '127.0.0.1:%d' % port)]
+  if icmp_available():
+    kinds.append(lambda i: ICMPProbe('icmp-%d' % i, '127.0.0.1'))
+  results = []
+  for count in targets:
+    done = []
+    schedule = AdaptiveSchedule(PROBE_INTERVAL_SEC, PROBE_INTERVAL_SEC, fast=PROBE_INTERVAL_SEC, jitter=0)
+    engine = ProbeEngine(lambda name, kind, status, rtt: done.append((status, rtt)), schedule=schedule)
+    for i in range(count):
+      engine.add(kinds[i % len(kinds)](i))
+    engine.start()
+    time.sleep(PROBE_WARMUP_SEC)
+    first = len(done)
+    began = time.monotonic()
+    time.sleep(seconds)
+    measured = done[first:]
+    elapsed = time.monotonic() - began
+    engine.stop()
+    j = dict()
+    j['targets'] = count
+    j['kinds'] = len(kinds)
+    j['offered-per-sec'] = round(count / PROBE_INTERVAL_SEC, 1)
+    j['probes-per-sec'] = round(len(measured) / elapsed, 1)
+    j['up-fraction'] = round(len([s for s, rtt in measured if PROBE_UP == s]) / float(len(measured)), 3) if measured else None
+    j['rtt'] = latencies([rtt for s, rtt in measured if PROBE_UP == s])
+    debug(DEBUG_BENCH, '--> probes: %s', j)
+    results.append(j)
+    time.sleep(0.5)
+  return results
+
+
+# The latency from a button edge (injected on the simulated board) to the
+# write of its LED's pin (by the LED driver), with the daemon's handling of a
+# press: the LED turns solid green. Measured for edge-triggered buttons (as the
+# daemon uses them) and polled ones.
+BUTTON_PIN = 26
+BUTTON_LED_PINS = (21, 25)
+BUTTON_PRESSES = {'edge': 100, 'polled': 20}
+BUTTON_SETTLE_SEC = 0.05
+BUTTON_WAIT_SEC = 2.0
+class TimedBoard(SimulatedBoard):
+
+  def __init__(self):
+    SimulatedBoard.__init__(self)
+    self.watch = None
+    self.written = threading.Event()
+    self.written_at = None
+
+  # Note when the watched (pin, level) is written
+  def output(self, pin, level):
+    SimulatedBoard.output(self, pin, level)
+    if (pin, 1 if level else 0) == self.watch and not self.written.is_set():
+      self.written_at = time.perf_counter()
+      self.written.set()
+
+  def expect(self, pin, level):
+    self.written.clear()
+    self.watch = (pin, level)
+
+def bench_button():
+  board = TimedBoard()
+  hal.install(gpio=board)
+  board.setup(BUTTON_PIN, board.IN, pull_up_down=board.PUD_UP)
+  for pin in BUTTON_LED_PINS:
+    board.setup(pin, board.OUT)
+  red, green = BUTTON_LED_PINS
+  led = RGB_LED('bench', red, green, None)
+  results = dict()
+  for mode, presses in BUTTON_PRESSES.items():
+    button = Button('bench-' + mode, BUTTON_PIN, edge_triggered=('edge' == mode))
+    button.on_press(lambda b: (led.green(), led.flash(False)))
+    button.on_release(lambda b, held: led.off())
+    seconds = []
+    missed = 0
+    for i in range(presses):
+      board.expect(green, board.HIGH)
+      pressed = time.perf_counter()
+      board.press(BUTTON_PIN)
+      if board.written.wait(BUTTON_WAIT_SEC):
+        seconds.append(board.written_at - pressed)
+      else:
+        missed += 1
+      time.sleep(BUTTON_SETTLE_SEC)
+      board.expect(green, board.LOW)
+      board.release(BUTTON_PIN)
+      board.written.wait(BUTTON_WAIT_SEC)
+      time.sleep(BUTTON_SETTLE_SEC)
+    button.stop()
+    results[mode] = latencies(seconds)
+    results[mode]['missed'] = missed
+    debug(DEBUG_BENCH, '--> button (%s): %s', mode, results[mode])
+  led.stop()
+  return results
+
+
+# The whole daemon (mybox.py, on the simulated board), watching the stand-ins
+DAEMON_PORT = 8666
+DAEMON_START_SEC = 30
+DAEMON_SETTLE_SEC = 10
+def daemon_topology(port):
+  main = {'name': 'main', 'led': {'red': 21, 'green': 25}, 'button': 26, 'http': {'monitor': '127.0.0.1:%d' % port}}
+  router = {'name': 'router', 'led': {'red': 16, 'green': 20}, 'button': 13, 'relay': 27, 'tcp': {'router-web': '127.0.0.1:%d' % port}}
+  if icmp_available():
+    router['ping'] = {'router': '127.0.0.1'}
+  return {'targets': [main, router]}
+
+def start_daemon(port):
+  env = dict(os.environ)
+  env['MY_TOPOLOGY'] = json.dumps(daemon_topology(port))
+  env['MY_RUNTIME'] = runtime.mode
+  env.pop('MY_DATA_DIR', None)
+  here = os.path.dirname(os.path.abspath(__file__))
+  daemon = subprocess.Popen([sys.executable, os.path.join(here, 'mybox.py')], cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  deadline = time.monotonic() + DAEMON_START_SEC
+  while time.monotonic() < deadline:
+    if daemon.poll() is not None:
+      raise RuntimeError('the daemon exited (%d) while starting' % (daemon.returncode))
+    try:
+      get_status()
+      return daemon
+    except OSError:
+      time.sleep(0.2)
+  daemon.kill()
+  raise RuntimeError('the daemon did not start within %ds' % (DAEMON_START_SEC))
+
+def stop_daemon(daemon):
+  daemon.send_signal(signal.SIGTERM)
+  try:
+    daemon.wait(10)
+  except subprocess.TimeoutExpired:
+    daemon.kill()
+    daemon.wait()
+
+def get_status(connection=None):
+  conn = connection or http.client.HTTPConnection('127.0.0.1', DAEMON_PORT, timeout=5)
+  conn.request('GET', '/')
+  response = conn.getresponse()
+  body = response.read()
+  if 200 != response.status:
+    raise OSError('GET / answered %d' % (response.status))
+  if connection is None:
+    conn.close()
+  return body
+
+# Return (context switches, CPU seconds) of a process, over all of its threads
+def process_counters(pid):
+  switches = 0
+  for task in os.listdir('/proc/%d/task' % (pid)):
+    try:
+      with open('/proc/%d/task/%s/status' % (pid, task), 'r') as file:
+        for line in file:
+          if line.startswith('voluntary_ctxt_switches:') or line.startswith('nonvoluntary_ctxt_switches:'):
+            switches += int(line.split()[1])
+    except OSError:
+      pass
+  with open('/proc/%d/stat' % (pid), 'r') as file:
+    fields = file.read().rsplit(')', 1)[1].split()
+  cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+  return switches, cpu
+
+def process_memory(pid):
+  j = dict()
+  with open('/proc/%d/status' % (pid), 'r') as file:
+    for line in file:
+      if line.startswith('VmRSS:'):
+        j['rss-mb'] = round(int(line.split()[1]) / 1024.0, 1)
+      elif line.startswith('Threads:'):
+        j['threads'] = int(line.split()[1])
+  return j
+
+# The wakeups (context switches, over all threads) per second, CPU use and RSS
+# of the daemon, once it has settled, with nothing asking it for anything
+def bench_idle(daemon, seconds):
+  time.sleep(DAEMON_SETTLE_SEC)
+  switches, cpu = process_counters(daemon.pid)
+  began = time.monotonic()
+  time.sleep(seconds)
+  elapsed = time.monotonic() - began
+  now_switches, now_cpu = process_counters(daemon.pid)
+  j = dict()
+  j['seconds'] = round(elapsed, 1)
+  j['wakeups-per-sec'] = round((now_switches - switches) / elapsed, 2)
+  j['cpu-percent'] = round(100.0 * (now_cpu - cpu) / elapsed, 2)
+  j.update(process_memory(daemon.pid))
+  j['budget'] = json.loads(get_status()).get('runtime')
+  debug(DEBUG_BENCH, '--> idle: %s', j)
+  return j
+
+# Requests per second (and latencies) of "/", from API_CLIENTS clients, each
+# sending requests one after the other over a keep-alive connection
+API_CLIENTS = 4
+def bench_api(seconds):
+  deadline = time.monotonic() + seconds
+  seconds_by_client = [[] for i in range(API_CLIENTS)]
+  errors = [0]
+  def client(times):
+    conn = http.client.HTTPConnection('127.0.0.1', DAEMON_PORT, timeout=5)
+    while time.monotonic() < deadline:
+      began = time.perf_counter()
+      try:
+        get_status(conn)
+        times.append(time.perf_counter() - began)
+      except (OSError, http.client.HTTPException):
+        errors[0] += 1
+        conn.close()
+        conn = http.client.HTTPConnection('127.0.0.1', DAEMON_PORT, timeout=5)
+    conn.close()
+  began = time.monotonic()
+  clients = [threading.Thread(target=client, args=(times,)) for times in seconds_by_client]
+  for t in clients:
+    t.start()
+  for t in clients:
+    t.join()
+  elapsed = time.monotonic() - began
+  times = [s for c in seconds_by_client for s in c]
+  j = dict()
+  j['clients'] = API_CLIENTS
+  j['seconds'] = round(elapsed, 1)
+  j['requests-per-sec'] = round(len(times) / elapsed, 1)
+  j['errors'] = errors[0]
+  j['latency'] = latencies(times)
+  debug(DEBUG_BENCH, '--> api: %s', j)
+  return j
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+BENCHMARKS = ('probes', 'api', 'button', 'idle')
+def main():
+  parser = argparse.ArgumentParser(description='Benchmarks for my network monitor box')
+  parser.add_argument('--out', help='write the JSON results to this file (default: stdout)')
+  parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma separated benchmarks to run (%s)' % (', '.join(BENCHMARKS)))
+  parser.add_argument('--seconds', type=float, default=10.0, help='how long each measurement runs')
+  parser.add_argument('--targets', default=','.join(str(n) for n in PROBE_TARGETS), help='comma separated target counts for the probe benchmark')
+  args = parser.parse_args()
+  only = [b for b in args.only.split(',') if b]
+  for b in only:
+    if b not in BENCHMARKS:
+      parser.error('unknown benchmark: "%s"' % (b))
+
+  # Fork the stand-in before any threads are started
+  stand_in, port = start_stand_in()
+  j = dict()
+  j['time'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+  j['commit'] = git_commit()
+  j['host'] = platform.node()
+  j['python'] = platform.python_version()
+  j['cpus'] = os.cpu_count()
+  j['runtime'] = runtime.mode
+  j['icmp'] = icmp_available()
+  j['results'] = dict()
+  try:
+    if 'probes' in only:
+      j['results']['probes'] = bench_probes(port, [int(n) for n in args.targets.split(',')], args.seconds)
+    if 'button' in only:
+      j['results']['button'] = bench_button()
+    if 'idle' in only or 'api' in only:
+      daemon = start_daemon(port)
+      try:
+        if 'idle' in only:
+          j['results']['idle'] = bench_idle(daemon, args.seconds)
+        if 'api' in only:
+          j['results']['api'] = bench_api(args.seconds)
+      finally:
+        stop_daemon(daemon)
+  finally:
+    stand_in.terminate()
+    runtime.stop()
+
+  text = json.dumps(j, indent=2) + '\n'
+  if args.out:
+    with open(args.out, 'w') as file:
+      file.write(text)
+  else:
+    sys.stdout.write(text)
+
+if __name__ == '__main__':
+  main()
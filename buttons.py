@@ -6,36 +6,55 @@
 
 
 import threading
-import time
 
+import runtime
+from runtime import Worker
 
-# Import the GPIO library so python can work with the GPIO pins
-import RPi.GPIO as GPIO
 
+# Import the GPIO library so python can work with the GPIO pins (and the clock)
+from hal import GPIO, clock
+from tracing import flag, debug
 
 
-# Debug flags
-DEBUG_BUTTONS = False
 
-# Debug print
-def debug(flag, str):
-  if flag:
-    print(str)
+# Debug flags
+DEBUG_BUTTONS = flag('buttons')
 
 
 
 # Class to monitor buttons
+# By default the button is polled from its own loop. In edge-triggered mode
+# GPIO event detection calls back on each edge instead (so there are no wakeups
+# at all while idle), and the edges are debounced in software. In both modes,
+# consumers can subscribe to press, hold-threshold and release events, E.g.:
+#    b = Button("main", 26, edge_triggered=True)
+#    b.on_hold(4.0, lambda button, held: print("%s held %0.1fs" % (button.name, held)))
 SLEEP_BETWEEN_STATE_CHECKS_SEC = 0.25
-class Button(threading.Thread):
+DEBOUNCE_SEC = 0.02
+class Button(Worker):
 
-  def __init__(self, name, gpio):
-    threading.Thread.__init__(self)
+  def __init__(self, name, gpio, edge_triggered=False):
+    Worker.__init__(self, 'button-' + name)
     self.name = name
     self.gpio = gpio
+    self.pressed_at = None
+    self.released_at = None
+    self._edge_triggered = edge_triggered
     self._is_pressed = False
-    self._keep_swimming = True
     self._start_time = None
-    self.start()
+    self._last_edge = 0
+    self._lock = threading.Lock()
+    self._press_callbacks = []
+    self._hold_callbacks = []
+    self._release_callbacks = []
+    self._hold_timers = []
+    if self._edge_triggered:
+      debug(DEBUG_BUTTONS, "Button edge detection for \"%s\" (GPIO#%d) started!", self.name, self.gpio)
+      GPIO.add_event_detect(self.gpio, GPIO.BOTH, callback=runtime.on_loop(self._edge))
+      self._update(self._read(), clock.time())
+    else:
+      debug(DEBUG_BUTTONS, "Button monitor for \"%s\" (GPIO#%d) started!", self.name, self.gpio)
+      self.start()
 
   def is_pressed(self):
     return self._is_pressed
@@ -44,36 +63,89 @@ class Button(threading.Thread):
     if not self._is_pressed:
       return 0
     else:
-      return (time.time() - self._start_time)
+      return (clock.time() - self._start_time)
 
-  def stop(self):
-    self._keep_swimming = False
+  # Call callback(button) whenever this button is pressed
+  def on_press(self, callback):
+    self._press_callbacks.append(callback)
 
-  def run(self):
-    debug(DEBUG_BUTTONS, ("Button monitor for \"%s\" (GPIO#%d) started!" % (self.name, self.gpio)))
-    while self._keep_swimming:
+  # Call callback(button, held_time) once per press, when it has been held for
+  # the given number of seconds
+  def on_hold(self, seconds, callback):
+    self._hold_callbacks.append((seconds, callback))
 
-      # Note previous state
-      was_pressed = self._is_pressed
-      # Get current state
-      self._is_pressed = '1' != str(GPIO.input(self.gpio))
+  # Call callback(button, held_time) whenever this button is released
+  def on_release(self, callback):
+    self._release_callbacks.append(callback)
+
+  def stop(self):
+    Worker.stop(self)
+    if self._edge_triggered:
+      GPIO.remove_event_detect(self.gpio)
+    self._cancel_hold_timers()
+
+  def _read(self):
+    return '1' != str(GPIO.input(self.gpio))
+
+  # GPIO event callback (edge-triggered mode). The first edge is acted on
+  # immediately, further edges within the debounce time are ignored, and the
+  # level is checked again once the contacts have settled.
+  def _edge(self, channel):
+    now = clock.time()
+    with self._lock:
+      if now - self._last_edge < DEBOUNCE_SEC:
+        return
+      self._last_edge = now
+    self._update(self._read(), now)
+    clock.timer(DEBOUNCE_SEC, self._settle)
+
+  def _settle(self):
+    self._update(self._read(), clock.time())
+
+  def _cancel_hold_timers(self):
+    for t in self._hold_timers:
+      t.cancel()
+    self._hold_timers = []
+
+  def _hold(self, pressed_at, callback):
+    # Only fire if this is still the same press
+    if self._is_pressed and pressed_at == self._start_time:
+      callback(self, clock.time() - pressed_at)
+
+  # Note a (possibly unchanged) button state, and emit events on any change
+  def _update(self, is_pressed, when):
+    with self._lock:
+      if is_pressed == self._is_pressed:
+        return
+      self._is_pressed = is_pressed
+      if is_pressed:
+        self._start_time = self.pressed_at = when
+        self._cancel_hold_timers()
+        for seconds, callback in self._hold_callbacks:
+          t = clock.timer(max(0, seconds - (clock.time() - when)), self._hold, args=[when, callback])
+          self._hold_timers.append(t)
+      else:
+        self.released_at = when
+        self._cancel_hold_timers()
+    debug(DEBUG_BUTTONS, "--> Button \"%s\"(GPIO#%d): %s", self.name, self.gpio, str(is_pressed))
+    if is_pressed:
+      for callback in self._press_callbacks:
+        callback(self)
+    else:
+      for callback in self._release_callbacks:
+        callback(self, when - self._start_time)
 
-      # If not pressed, reset the held timer
+  # Poll the button (in the default mode)
+  def _work(self, now):
 
-      # Is the button just being pressed?
-      if not was_pressed and self._is_pressed:
-        # Note the start time for the "held()" function
-        self._start_time = time.time()
+    # Get current state (emitting any press or release events)
+    self._update(self._read(), now)
 
-      # If the button state has changed, emit this debug message
-      if was_pressed != self._is_pressed:
-        if self._is_pressed:
-          debug(DEBUG_BUTTONS, ("--> Button \"%s\"(GPIO#%d): %s" % (self.name, self.gpio, str(self._is_pressed))))
-      # Else if it is on show how long it has been held down
-      elif self._is_pressed:
-        debug(DEBUG_BUTTONS, ("--> Button \"%s\"(GPIO#%d): %s (%0.1fs)" % (self.name, self.gpio, str(self._is_pressed), self.held_time())))
+    # If it is on show how long it has been held down
+    if self._is_pressed:
+      debug(DEBUG_BUTTONS, "--> Button \"%s\"(GPIO#%d): %s (%0.1fs)", self.name, self.gpio, str(self._is_pressed), self.held_time())
 
-      time.sleep(SLEEP_BETWEEN_STATE_CHECKS_SEC)
+    return now + SLEEP_BETWEEN_STATE_CHECKS_SEC
 
 
 
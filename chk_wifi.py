@@ -3,82 +3,162 @@
 #
 # Written by Glen Darling, July 2020.
 #
+# Each WiFi monitor is checked with an HTTP probe (a plugin of the
+# ProbeEngine, in probes.py), which is up when the monitor answers with a 200.
+# The latency is the time from sending the request until the status line of
+# the answer arrives. Each probe keeps one (non-blocking) keep-alive
+# connection open, reading every answer through to its end so the next request
+# can reuse it, and only reconnects after an error, a timeout, or the monitor
+# closing it. E.g.:
+#    e = ProbeEngine(got)
+#    e.add(HTTPProbe("Bag End", "192.168.123.201"))
+#    e.add(HTTPProbe("nas", "192.168.123.10:8080", method="HEAD", path="/health"))
+#
 
 
-import json
-import requests
-import threading
-import time
+import errno
+import socket
 
+from probes import SocketProbe, PROBE_UP, PROBE_DOWN, split_address
+from tracing import flag, debug
 
-# Debug flags
-DEBUG_WIFI = False
 
-# Debug print
-def debug(flag, str):
-  if flag:
-    print(str)
+# Debug flags
+DEBUG_WIFI = flag('wifi')
 
 
-# Class to monitor wifi
+HTTP_PORT = 80
 REQUEST_TIMEOUT_SEC = 10
-SLEEP_BETWEEN_WIFI_CHECKS_SEC = 0.25
-class WiFiMonitor(threading.Thread):
-
-  def __init__(self, wifis):
-    threading.Thread.__init__(self)
-    self._wifis = wifis
-    self._lasts = {}
-    for ssid in self._wifis.keys():
-      addr = self._wifis[ssid]
-      self._lasts[addr] = 0
-      debug(DEBUG_WIFI, ('--> "%s": "%s"' % (ssid, addr)))
-    self._keep_swimming = True
-    self.start()
-
-  def last_good_status(self):
-    longest = 0
-    which = None
-    for addr in self._lasts.keys():
-      t = time.time() - self._lasts[addr]
-      debug(DEBUG_WIFI, ('--> "%s": t=%0.1fs' % (addr, t)))
-      if t > longest:
-        longest = t
-        which = addr
-    debug(DEBUG_WIFI, ('<-- last: %0.1f (t=%0.1fs)' % (self._lasts[addr], longest)))
-    return self._lasts[addr]
-
-  def details(self):
-    j = dict()
-    for ssid in self._wifis.keys():
-      addr = self._wifis[ssid]
-      j[ssid] = dict()
-      j[ssid]['addr'] = addr
-      j[ssid]['last'] = time.time() - self._lasts[addr]
-    debug(DEBUG_WIFI, ('<-- details: %s' % (json.dumps(j))))
-    return (json.dumps(j) + '\n').encode('UTF-8')
-
-  def stop(self):
-    self._keep_swimming = False
-
-  def run(self):
-    debug(DEBUG_WIFI, "WiFi monitor is online.")
-    while self._keep_swimming:
-      for k in self._wifis.keys():
-        addr = self._wifis[k]
-        url = 'http://' + addr + '/'
-        try:
-          r = requests.get(url, timeout=REQUEST_TIMEOUT_SEC)
-          if 200 == r.status_code:
-            self._lasts[addr] = time.time()
-            debug(DEBUG_WIFI, ('--> "%s" [UP]' % (addr)))
-          else:
-            debug(DEBUG_WIFI, ('--> "%s" [DN]' % (addr)))
-        except requests.exceptions.Timeout:
-          debug(DEBUG_WIFI, ('--> "%s" [TO]' % (addr)))
-        except:
-          debug(DEBUG_WIFI, ('--> "%s" [ER]' % (addr)))
-      time.sleep(SLEEP_BETWEEN_WIFI_CHECKS_SEC)
+WIFI_CHECK_BASE_SEC = 1.0
+MAX_SLEEP_BETWEEN_WIFI_CHECKS_SEC = 10
+MAX_STATUS_LINE_BYTES = 1024
+MAX_ANSWER_BYTES = 64 * 1024
+class HTTPProbe(SocketProbe):
+
+  kind = 'http'
+  timeout = REQUEST_TIMEOUT_SEC
+
+  def __init__(self, name, address, method='GET', path='/', timeout=None):
+    SocketProbe.__init__(self, name, address, timeout)
+    self.host, self.port = split_address(address, HTTP_PORT)
+    self.method = method
+    self._request = ('%s %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: mybox\r\n\r\n' % (method, path, address)).encode('ascii')
+    self._ip = None
+    self._reused = False
+    self._unsent = b''
+    self._answer = b''
+    self._latency = None
+
+  def begin(self, now):
+    if self.sock is not None:
+      self._reused = True
+      self._send()
+      return True
+    ip = self.engine.resolve(self.host)
+    if ip is None:
+      return False
+    self._connect(ip)
+    return True
+
+  def _connect(self, ip):
+    self._ip = ip
+    self._reused = False
+    sock = self._open(socket.AF_INET, socket.SOCK_STREAM)
+    err = sock.connect_ex((ip, self.port))
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      self.finish(PROBE_DOWN)
+    else:
+      self._send()
+
+  def _send(self):
+    self._unsent = self._request
+    self._answer = b''
+    self._latency = None
+    self.sent = None
+    self.engine.watch(self.sock, True, self._writable)
+
+  # A monitor may close an idle keep-alive connection at any time, so a reused
+  # one that fails before any answer arrives is reopened (once) before giving up
+  def _retry_or_fail(self):
+    if self._reused and not self._answer:
+      self._close()
+      self._connect(self._ip)
+      return
+    debug(DEBUG_WIFI, '--> "%s" [ER]', self.address)
+    self.finish(PROBE_DOWN)
 
+  # Connected (or failed to), and then able to send more of the request
+  def _writable(self, now):
+    err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+      debug(DEBUG_WIFI, '--> "%s" [ER] %s', self.address, errno.errorcode.get(err, err))
+      self.finish(PROBE_DOWN)
+      return
+    if self.sent is None:
+      self.sending()
+    try:
+      self._unsent = self._unsent[self.sock.send(self._unsent):]
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      self._retry_or_fail()
+      return
+    if not self._unsent:
+      self.engine.watch(self.sock, False, self._readable)
 
+  # The answer is read through to the end of its body (when its length is
+  # known), so the connection is left ready for the next request
+  def _readable(self, now):
+    try:
+      data = self.sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      data = b''
+    received = self.elapsed()
+    if not data:
+      self._retry_or_fail()
+      return
+    self._answer += data
+    if self._latency is None:
+      if b'\r\n' not in self._answer:
+        if len(self._answer) > MAX_STATUS_LINE_BYTES:
+          self.finish(PROBE_DOWN)
+        return
+      self._latency = received
+    head, sep, body = self._answer.partition(b'\r\n\r\n')
+    if not sep:
+      if len(self._answer) > MAX_ANSWER_BYTES:
+        self._end(False)
+      return
+    lines = head.decode('latin-1').split('\r\n')
+    fields = lines[0].split()
+    headers = dict((k.strip().lower(), v.strip().lower()) for k, _, v in (line.partition(':') for line in lines[1:]))
+    up = len(fields) >= 2 and fields[0].startswith('HTTP/') and '200' == fields[1]
+    if 'HEAD' == self.method or fields[1:2] in (['204'], ['304']):
+      length = 0
+    elif 'content-length' in headers and 'transfer-encoding' not in headers:
+      try:
+        length = int(headers['content-length'])
+      except ValueError:
+        length = None
+    else:
+      length = None
+    # Without a known length (or with too much of it), the answer cannot be
+    # read through cheaply, so the connection is not kept
+    if length is None or length > MAX_ANSWER_BYTES:
+      self._end(up, False)
+    elif len(body) >= length:
+      self._end(up, 'close' != headers.get('connection'))
 
+  def _end(self, up, keep=False):
+    if up:
+      debug(DEBUG_WIFI, '--> "%s" [UP] %0.1fms', self.address, self._latency * 1000.0)
+    else:
+      debug(DEBUG_WIFI, '--> "%s" [DN]', self.address)
+    self._answer = b''
+    if keep:
+      self.engine.unwatch(self.sock)
+      self.done(PROBE_UP if up else PROBE_DOWN, self._latency if up else None)
+    else:
+      self.finish(PROBE_UP if up else PROBE_DOWN, self._latency if up else None)
@@ -0,0 +1,75 @@
+#
+# A cached, pre-encoded JSON document (for the REST API of my network monitor)
+#
+# The document is only rebuilt when it has been invalidated (i.e., the state it
+# describes has changed) or when it is older than its maximum age, so polling
+# clients are served the same pre-encoded (and pre-compressed) bytes, with an
+# ETag so they can revalidate with If-None-Match. E.g.:
+#    doc = DocumentCache(lambda: {"foo": "bar"}, 1.0)
+#    @webapp.route("/")
+#    def get_foo():
+#      return doc.respond(request)
+#
+
+
+import gzip
+import hashlib
+import json
+import threading
+
+from hal import clock
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_DOC_CACHE = flag('doc-cache')
+
+
+GZIP_MIN_BYTES = 256
+GZIP_LEVEL = 6
+class DocumentCache:
+
+  # The build function must return a JSON serializable object
+  def __init__(self, build, max_age):
+    self._build = build
+    self._max_age = max_age
+    self._lock = threading.Lock()
+    self._entry = None
+    self._version = 0
+
+  # Note that the state has changed, so the document must be rebuilt
+  def invalidate(self):
+    self._version += 1
+
+  # Return the current (body, gzipped body, etag) of the document
+  def get(self):
+    entry = self._entry
+    if entry is None or entry[3] != self._version or clock.time() - entry[4] > self._max_age:
+      with self._lock:
+        # Some other thread may have already rebuilt it
+        entry = self._entry
+        if entry is None or entry[3] != self._version or clock.time() - entry[4] > self._max_age:
+          version = self._version
+          body = (json.dumps(self._build()) + '\n').encode('UTF-8')
+          zipped = None
+          if len(body) >= GZIP_MIN_BYTES:
+            zipped = gzip.compress(body, GZIP_LEVEL)
+          etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+          entry = self._entry = (body, zipped, etag, version, clock.time())
+          debug(DEBUG_DOC_CACHE, '--> rebuilt document (v%d, %d bytes)', version, len(body))
+    return entry[0], entry[1], entry[2]
+
+  # Return a Flask response for the given request, honoring If-None-Match and
+  # Accept-Encoding: gzip
+  def respond(self, request):
+    from flask import Response
+    body, zipped, etag = self.get()
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if etag in request.headers.get('If-None-Match', ''):
+      return Response(status=304, headers=headers)
+    if zipped and 'gzip' in request.headers.get('Accept-Encoding', ''):
+      headers['Content-Encoding'] = 'gzip'
+      body = zipped
+    return Response(body, mimetype='application/json', headers=headers)
+
+
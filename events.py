@@ -0,0 +1,94 @@
+#
+# A stream of state change events (for the REST API of my network monitor)
+#
+# Every event gets a monotonically increasing sequence number, and the most
+# recent events are kept so clients can resume after a disconnect by passing
+# the last sequence number they saw (e.g., in the SSE Last-Event-ID header).
+# E.g.:
+#    events = EventStream()
+#    events.publish("led", {"led": "main", "state": "red,flashing"})
+#    for chunk in events.sse(last_seq): ...
+#
+
+
+import json
+import threading
+from collections import deque
+
+from hal import clock
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_EVENTS = flag('events')
+
+
+EVENT_BACKLOG = 1000
+HEARTBEAT_SEC = 15
+class EventStream:
+
+  def __init__(self, backlog=EVENT_BACKLOG):
+    self._events = deque(maxlen=backlog)
+    self._seq = 0
+    self._clients = 0
+    self._cond = threading.Condition()
+
+  # Return the sequence number of the most recent event
+  def seq(self):
+    return self._seq
+
+  # Return the number of clients currently streaming events
+  def clients(self):
+    return self._clients
+
+  # Publish an event (safe to call from any thread)
+  def publish(self, kind, data):
+    with self._cond:
+      self._seq += 1
+      event = {'seq': self._seq, 'time': clock.time(), 'event': kind, 'data': data}
+      self._events.append((self._seq, kind, json.dumps(event)))
+      self._cond.notify_all()
+    debug(DEBUG_EVENTS, '--> event #%d %s: %s', event['seq'], kind, json.dumps(data))
+
+  # Return the events after the given sequence number (as (seq, kind, json)
+  # tuples), and whether any of them have already been discarded
+  def since(self, seq):
+    with self._cond:
+      missed = len(self._events) > 0 and self._events[0][0] > seq + 1
+      return [e for e in self._events if e[0] > seq], missed
+
+  # Wait (up to timeout seconds) for events after the given sequence number
+  def wait(self, seq, timeout):
+    with self._cond:
+      self._cond.wait_for(lambda: self._seq > seq, timeout)
+    return self.since(seq)
+
+  # Generate a server-sent events stream of the events after the given
+  # sequence number (forever). A "resync" event is sent first if some of the
+  # requested events have already been discarded (so the client should fetch
+  # the full status again).
+  def sse(self, seq):
+    with self._cond:
+      self._clients += 1
+    try:
+      yield 'retry: 1000\n\n'
+      # A client ahead of us has seen a previous run of this server
+      if seq is not None and seq > self._seq:
+        yield 'event: resync\ndata: {}\n\n'
+        seq = None
+      if seq is None:
+        seq = self._seq
+      while True:
+        events, missed = self.wait(seq, clock.real(HEARTBEAT_SEC))
+        if missed:
+          yield 'event: resync\ndata: {}\n\n'
+        if not events:
+          yield ': heartbeat\n\n'
+        for e in events:
+          yield 'id: %d\nevent: %s\ndata: %s\n\n' % (e[0], e[1], e[2])
+          seq = e[0]
+    finally:
+      with self._cond:
+        self._clients -= 1
+
+
@@ -0,0 +1,311 @@
+#
+# Fleet aggregator for my network monitor boxes
+#
+# Polls the status document ("/", on port 8666) of any number of boxes, and
+# serves one (cached) fleet view of them all, with how stale each box's part
+# of it is. Each box is a "box" probe (a plugin of the ProbeEngine, in
+# probes.py), so the polls all run concurrently on the engine's loop, each over
+# a keep-alive connection of its own, revalidated with the box's ETag (so an
+# unchanged document costs a 304), and each with its own timeout, so a slow or
+# dead box never delays the others. Only a summary of each box's latest
+# document is kept (and answers are limited to MAX_STATUS_BYTES), so memory
+# stays bounded however many boxes there are. The boxes are given in MY_FLEET
+# (JSON, a {"name": "host[:port]"} dict, or a list of addresses), or in the
+# MY_FLEET_FILE, and the fleet view is served on MY_FLEET_PORT. E.g.:
+#    MY_FLEET='{"home": "192.168.123.3", "cabin": "cabin.example.com:8666"}' python fleet.py
+#    curl -sS localhost:8667/
+#
+
+
+import errno
+import gzip
+import json
+import os
+import socket
+
+# The aggregator uses no GPIO pins, so it runs anywhere (on a simulated board)
+os.environ.setdefault('MY_GPIO_BACKEND', 'sim')
+
+from hal import clock
+import runtime
+from probes import ProbeEngine, SocketProbe, PROBE_UP, PROBE_DOWN, split_address
+from scheduler import AdaptiveSchedule
+from resolver import DNSCache
+from doc_cache import DocumentCache
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_FLEET = flag('fleet')
+
+
+# Return a summary of a box's status document (i.e., what the fleet view
+# shows of it)
+def summary(j):
+  s = dict()
+  for key in ('version', 'swimming', 'power-cycling', 'indicators', 'rgb-leds', 'provisional'):
+    s[key] = j.get(key)
+  s['probes'] = dict((name, probe.get('status')) for name, probe in j.get('probes', {}).items())
+  s['over-budget'] = j.get('runtime', {}).get('over-budget')
+  return s
+
+
+# The status document of a box, fetched over a keep-alive connection (that is
+# reopened whenever the box has closed it), and revalidated with its ETag. Up
+# once the answer is in (with the time that took), and down on any error. The
+# summary of the latest document is kept (with whether the last poll changed
+# it), and the rest is dropped.
+BOX_PORT = 8666
+BOX_TIMEOUT_SEC = 5
+MAX_STATUS_BYTES = 1024 * 1024
+class BoxProbe(SocketProbe):
+
+  kind = 'box'
+  timeout = BOX_TIMEOUT_SEC
+
+  def __init__(self, name, address, timeout=None):
+    SocketProbe.__init__(self, name, address, timeout)
+    self.host, self.port = split_address(address, BOX_PORT)
+    self.summary = None
+    self.changed = False
+    self.error = None
+    self._etag = None
+    self._ip = None
+    self._reused = False
+    self._unsent = b''
+    self._answer = b''
+
+  def begin(self, now):
+    self.changed = False
+    self.error = None
+    if self.sock is not None:
+      self._reused = True
+      self._request()
+      return True
+    ip = self.engine.resolve(self.host)
+    if ip is None:
+      return False
+    self._connect(ip)
+    return True
+
+  def _connect(self, ip):
+    self._ip = ip
+    self._reused = False
+    sock = self._open(socket.AF_INET, socket.SOCK_STREAM)
+    err = sock.connect_ex((ip, self.port))
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      self._fail(errno.errorcode.get(err, str(err)))
+    else:
+      self._request()
+
+  def _request(self):
+    etag = ('If-None-Match: %s\r\n' % (self._etag)) if self._etag else ''
+    self._unsent = ('GET / HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: gzip\r\nUser-Agent: mybox-fleet\r\n%s\r\n' % (self.address, etag)).encode('ascii')
+    self._answer = b''
+    self.sent = None
+    self.engine.watch(self.sock, True, self._writable)
+
+  def cancel(self):
+    self.error = 'timed out'
+    SocketProbe.cancel(self)
+
+  def _fail(self, error):
+    self.error = error
+    debug(DEBUG_FLEET, '--> box "%s" (%s): %s', self.name, self.address, error)
+    self.finish(PROBE_DOWN)
+
+  # Connected (or failed to), and then able to send more of the request
+  def _writable(self, now):
+    err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+      self._fail(errno.errorcode.get(err, str(err)))
+      return
+    if self.sent is None:
+      self.sending()
+    try:
+      self._unsent = self._unsent[self.sock.send(self._unsent):]
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError as e:
+      self._retry_or_fail(str(e))
+      return
+    if not self._unsent:
+      self.engine.watch(self.sock, False, self._readable)
+
+  # A box may close an idle keep-alive connection at any time, so a reused one
+  # that fails before any answer arrives is reopened (once) before giving up
+  def _retry_or_fail(self, error):
+    if self._reused and not self._answer:
+      self._close()
+      self._connect(self._ip)
+      return
+    self._close()
+    self._fail(error)
+
+  def _readable(self, now):
+    try:
+      data = self.sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError as e:
+      self._retry_or_fail(str(e))
+      return
+    if not data:
+      self._retry_or_fail('connection closed')
+      return
+    self._answer += data
+    if len(self._answer) > MAX_STATUS_BYTES:
+      self._fail('answer too long')
+      return
+    head, sep, body = self._answer.partition(b'\r\n\r\n')
+    if not sep:
+      return
+    lines = head.decode('latin-1').split('\r\n')
+    fields = lines[0].split()
+    headers = dict((k.strip().lower(), v.strip()) for k, _, v in (line.partition(':') for line in lines[1:]))
+    try:
+      code = int(fields[1])
+      length = int(headers.get('content-length', 0))
+    except (IndexError, ValueError):
+      self._fail('bad answer')
+      return
+    if len(body) < length:
+      return
+    latency = self.elapsed()
+    if 200 == code:
+      body = body[:length]
+      try:
+        if 'gzip' == headers.get('content-encoding'):
+          body = gzip.decompress(body)
+        self.summary = summary(json.loads(body.decode('UTF-8')))
+      except (OSError, ValueError) as e:
+        self._fail('bad document: %s' % (e))
+        return
+      self._etag = headers.get('etag')
+      self.changed = True
+    elif 304 != code:
+      self._fail('HTTP %d' % (code))
+      return
+    self._answer = b''
+    if 'close' == headers.get('connection', '').lower():
+      self._close()
+    else:
+      self.engine.unwatch(self.sock)
+    debug(DEBUG_FLEET, '--> box "%s" (%s): HTTP %d in %0.1fms', self.name, self.address, code, latency * 1000.0)
+    self.done(PROBE_UP, latency)
+
+
+# The boxes (as {name: address}) from the environment
+def load_fleet():
+  text = os.environ.get('MY_FLEET')
+  path = os.environ.get('MY_FLEET_FILE')
+  if path:
+    with open(path, 'r') as file:
+      text = file.read()
+  if not text:
+    raise ValueError('no boxes: set MY_FLEET or MY_FLEET_FILE')
+  spec = json.loads(text)
+  if isinstance(spec, list):
+    return dict((address, address) for address in spec)
+  return dict(spec)
+
+
+# The fleet: every box is polled every FLEET_POLL_SEC (with some jitter, so
+# the polls spread out), and is stale once its latest document is more than
+# FLEET_STALE_SEC old
+FLEET_POLL_SEC = float(os.environ.get('MY_FLEET_POLL_SEC', '5'))
+FLEET_STALE_SEC = 3 * FLEET_POLL_SEC
+FLEET_MAX_AGE_SEC = 1.0
+class Fleet:
+
+  def __init__(self, boxes, server=None):
+    self._boxes = dict()
+    self._statuses = dict()
+    self._goods = dict()
+    self.cache = DocumentCache(self.document, FLEET_MAX_AGE_SEC)
+    self._resolver = DNSCache(None, server)
+    schedule = AdaptiveSchedule(FLEET_POLL_SEC, FLEET_POLL_SEC, fast=FLEET_POLL_SEC)
+    self._engine = ProbeEngine(self._result, schedule=schedule, resolver=self._resolver)
+    for name, address in boxes.items():
+      self._boxes[name] = BoxProbe(name, address)
+      self._statuses[name] = None
+      self._goods[name] = None
+      self._engine.add(self._boxes[name])
+
+  def start(self):
+    self._engine.start()
+
+  def stop(self):
+    self._engine.stop()
+    self._resolver.stop()
+
+  def _result(self, name, kind, status, rtt):
+    box = self._boxes[name]
+    if PROBE_UP == status:
+      self._goods[name] = clock.time()
+    if box.changed or status != self._statuses[name]:
+      self.cache.invalidate()
+    self._statuses[name] = status
+
+  # Return the fleet view (each box's latest summary, with its age)
+  def document(self):
+    now = clock.time()
+    j = dict()
+    j['time'] = now
+    j['boxes'] = dict()
+    counts = dict(ok=0, stale=0, unknown=0)
+    indicators = dict()
+    power_cycling = []
+    for name, box in self._boxes.items():
+      good = self._goods[name]
+      b = dict()
+      b['addr'] = box.address
+      b['poll'] = self._statuses[name]
+      b['error'] = box.error
+      b['age'] = None if good is None else now - good
+      b['rtt'] = self._engine.rtt(name)
+      b['state'] = 'unknown' if box.summary is None else ('stale' if b['age'] is None or b['age'] > FLEET_STALE_SEC else 'ok')
+      b['status'] = box.summary
+      counts[b['state']] += 1
+      if box.summary:
+        for indicator, state in (box.summary['indicators'] or {}).items():
+          indicators.setdefault(state, []).append('%s/%s' % (name, indicator))
+        if box.summary['power-cycling'] not in (None, 'None'):
+          power_cycling.append('%s/%s' % (name, box.summary['power-cycling']))
+      j['boxes'][name] = b
+    j['summary'] = dict(counts)
+    j['summary']['boxes'] = len(self._boxes)
+    j['summary']['indicators'] = indicators
+    j['summary']['power-cycling'] = power_cycling
+    return j
+
+
+# Main program (polls the fleet, and serves its view)
+FLEET_BIND_ADDRESS = '0.0.0.0'
+FLEET_PORT = int(os.environ.get('MY_FLEET_PORT', '8667'))
+FLEET_HTTP_THREADS = 8
+if __name__ == '__main__':
+
+  import signal
+  import sys
+  from flask import Flask, request
+
+  fleet = Fleet(load_fleet(), os.environ.get('MY_DNS_SERVER'))
+  def signal_handler(signum, frame):
+    fleet.stop()
+    runtime.stop()
+    sys.exit(0)
+  signal.signal(signal.SIGINT, signal_handler)
+  signal.signal(signal.SIGTERM, signal_handler)
+  fleet.start()
+
+  webapp = Flask('fleet')
+  @webapp.route("/")
+  def get_fleet():
+    return fleet.cache.respond(request)
+
+  try:
+    import waitress
+    waitress.serve(webapp, host=FLEET_BIND_ADDRESS, port=FLEET_PORT, threads=FLEET_HTTP_THREADS)
+  except ImportError:
+    webapp.run(host=FLEET_BIND_ADDRESS, port=FLEET_PORT, threaded=True)
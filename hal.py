@@ -0,0 +1,283 @@
+#
+# Hardware abstraction layer for my network monitor box
+#
+# All of the modules use the GPIO and clock objects from here (instead of
+# importing RPi.GPIO, and calling time.time() and time.sleep() directly), so
+# the whole daemon can run off a Pi, on a simulated board, and with a virtual
+# clock that runs many times faster than real time. E.g.:
+#    MY_GPIO_BACKEND=sim MY_CLOCK_SCALE=20 python mybox.py
+# Or, from python (before anything starts using them):
+#    hal.install(gpio=SimulatedBoard(), clock=ScaledClock(20))
+#
+
+
+import os
+import threading
+import time
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_HAL = flag('hal')
+
+
+# The real clock
+class Clock:
+
+  scale = 1.0
+  loop = None
+
+  def time(self):
+    return time.time()
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
+
+  # Convert a duration on this clock into real seconds (e.g., for timeouts)
+  def real(self, seconds):
+    return seconds
+
+  # Return a (started, daemon) timer that calls function(*args) after seconds
+  # (or, when the clock has a loop, a call scheduled on that loop instead)
+  def timer(self, seconds, function, args=()):
+    if self.loop is not None:
+      return self.loop.call_later(seconds, function, args)
+    t = threading.Timer(self.real(seconds), function, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+
+# A virtual clock, running scale times faster than real time (starting from
+# the given time, or from now)
+class ScaledClock(Clock):
+
+  def __init__(self, scale, start=None):
+    self.scale = float(scale)
+    self._start = time.time() if start is None else start
+    self._origin = time.monotonic()
+
+  def time(self):
+    return self._start + (time.monotonic() - self._origin) * self.scale
+
+  def sleep(self, seconds):
+    time.sleep(self.real(seconds))
+
+  def real(self, seconds):
+    return seconds / self.scale
+
+
+# Simulated PWM channel (with the same API as an RPi.GPIO.PWM). Like
+# RPi.GPIO's software PWM, stopping it only takes effect at the end of the
+# current half period, when the pin is driven low and freed for a new channel.
+class SimulatedPWM:
+
+  def __init__(self, board, pin, frequency):
+    self._board = board
+    self.pin = pin
+    self.frequency = frequency
+    self.duty = 0
+    self.running = False
+
+  def start(self, duty):
+    self.duty = duty
+    self.running = True
+    self._board._pwms[self.pin] = self
+
+  def ChangeDutyCycle(self, duty):
+    self.duty = duty
+
+  def ChangeFrequency(self, frequency):
+    self.frequency = frequency
+
+  def stop(self):
+    if self.running:
+      self.running = False
+      clock.timer(self._half_period_left(clock.time()), self._end)
+    else:
+      self._end()
+
+  def _end(self):
+    self._board._pwms.pop(self.pin, None)
+    self._board.output(self.pin, 0)
+    self._board._channels.pop(self.pin, None)
+
+  # Return the time until the current half period of the waveform ends
+  def _half_period_left(self, when):
+    if self.frequency <= 0:
+      return 0
+    phase = (when * self.frequency) % 1.0
+    duty = min(1.0, max(0.0, self.duty / 100.0))
+    if 0 < duty < 1:
+      return ((duty if phase < duty else 1.0) - phase) / self.frequency
+    return (1.0 - phase) / self.frequency
+
+  # Return the level of the simulated waveform at the given time
+  def level(self, when):
+    if self.duty >= 100:
+      return 1
+    if self.duty <= 0 or self.frequency <= 0:
+      return 0
+    phase = (when * self.frequency) % 1.0
+    return 1 if phase < self.duty / 100.0 else 0
+
+
+# An in-memory simulated board, with the same API as the RPi.GPIO module. It
+# records the output pin levels (and every write), accepts injected input
+# edges (e.g., button presses), and simulates PWM outputs.
+class SimulatedBoard:
+
+  BCM = 11
+  BOARD = 10
+  OUT = 0
+  IN = 1
+  LOW = 0
+  HIGH = 1
+  PUD_OFF = 20
+  PUD_DOWN = 21
+  PUD_UP = 22
+  RISING = 31
+  FALLING = 32
+  BOTH = 33
+
+  def __init__(self, cpu_temp=45.0):
+    self.cpu_temp = cpu_temp
+    self.mode = None
+    self.writes = 0
+    self._levels = {}
+    self._directions = {}
+    self._callbacks = {}
+    self._pwms = {}
+    self._channels = {}
+    self._log = []
+    self._lock = threading.Lock()
+
+  def setwarnings(self, flag):
+    pass
+
+  def setmode(self, mode):
+    self.mode = mode
+
+  def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+    self._directions[pin] = direction
+    if self.IN == direction:
+      self._levels[pin] = self.HIGH if self.PUD_UP == pull_up_down else self.LOW
+    else:
+      self._levels[pin] = self.LOW if initial is None else initial
+
+  def output(self, pin, level):
+    with self._lock:
+      self._levels[pin] = 1 if level else 0
+      self.writes += 1
+      self._log.append((clock.time(), pin, self._levels[pin]))
+      del self._log[:-SIM_LOG_LENGTH]
+
+  def input(self, pin):
+    return self._levels.get(pin, self.LOW)
+
+  def PWM(self, pin, frequency):
+    if pin in self._channels:
+      raise RuntimeError('A PWM object already exists for this GPIO channel')
+    pwm = self._channels[pin] = SimulatedPWM(self, pin, frequency)
+    return pwm
+
+  def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+    self._callbacks[pin] = (edge, callback)
+
+  def remove_event_detect(self, pin):
+    self._callbacks.pop(pin, None)
+
+  def cleanup(self, *pins):
+    pass
+
+  # Return the current level of a pin (following any PWM waveform on it)
+  def level(self, pin):
+    pwm = self._pwms.get(pin)
+    if pwm:
+      return pwm.level(clock.time())
+    return self._levels.get(pin, self.LOW)
+
+  # Return the current level of every pin that has been set up
+  def levels(self):
+    return dict((pin, self.level(pin)) for pin in self._directions.keys())
+
+  # Return the most recent writes, as (time, pin, level) tuples
+  def log(self):
+    with self._lock:
+      return list(self._log)
+
+  # Return the PWM channel running on a pin (or None)
+  def pwm(self, pin):
+    return self._pwms.get(pin)
+
+  # Return the (frequency, duty cycle) of every running PWM channel
+  def pwms(self):
+    return dict((pin, (p.frequency, p.duty)) for pin, p in list(self._pwms.items()))
+
+  # Inject an edge on an input pin (calling its event callback, if any)
+  def inject(self, pin, level):
+    old = self._levels.get(pin, self.LOW)
+    self._levels[pin] = 1 if level else 0
+    if old == self._levels[pin]:
+      return
+    edge, callback = self._callbacks.get(pin, (None, None))
+    rising = self._levels[pin] == self.HIGH
+    if callback and (self.BOTH == edge or (self.RISING == edge) == rising):
+      callback(pin)
+
+  # Buttons pull their (pulled up) input pin low while they are pressed
+  def press(self, pin):
+    self.inject(pin, self.LOW)
+
+  def release(self, pin):
+    self.inject(pin, self.HIGH)
+
+
+# Return the CPU temperature (in C) from the given file, or the simulated one
+def cpu_temperature(path):
+  if isinstance(GPIO._target, SimulatedBoard):
+    return GPIO.cpu_temp
+  with open(path, 'r') as file:
+    return float(file.read().replace('\n', '')) / 1000.0
+
+
+# Every module holds on to these proxies, so the backends behind them can be
+# swapped (with install()) before the daemon starts
+class Proxy:
+
+  def __init__(self, target):
+    object.__setattr__(self, '_target', target)
+
+  def __getattr__(self, name):
+    return getattr(self._target, name)
+
+  def __setattr__(self, name, value):
+    setattr(self._target, name, value)
+
+
+def install(gpio=None, clock=None):
+  if gpio is not None:
+    object.__setattr__(GPIO, '_target', gpio)
+  if clock is not None:
+    object.__setattr__(globals()['clock'], '_target', clock)
+
+def simulated():
+  return isinstance(GPIO._target, SimulatedBoard)
+
+
+# Select the backends from the environment (default: the real hardware)
+SIM_LOG_LENGTH = 1000
+GPIO_BACKEND = os.environ.get('MY_GPIO_BACKEND', 'rpi')
+CLOCK_SCALE = float(os.environ.get('MY_CLOCK_SCALE', '1'))
+if 'sim' == GPIO_BACKEND:
+  GPIO = Proxy(SimulatedBoard())
+else:
+  import RPi.GPIO
+  GPIO = Proxy(RPi.GPIO)
+if 1.0 == CLOCK_SCALE:
+  clock = Proxy(Clock())
+else:
+  clock = Proxy(ScaledClock(CLOCK_SCALE))
+debug(DEBUG_HAL, '--> GPIO backend: %s, clock scale: %s', GPIO_BACKEND, CLOCK_SCALE)
+
+
@@ -0,0 +1,164 @@
+#
+# Compact, fixed-memory history of probe results for my network monitor box.
+#
+# Each target gets a ring buffer made of typed arrays (one for timestamps, one
+# for status and one for round trip times), which grows in chunks as samples
+# arrive, and never past its capacity. At 9 bytes per sample, a week of 1 Hz
+# samples is about 5.4MB, but a target only pays for the samples it has.
+# E.g.:
+#    h = HistoryStore()
+#    h.record("router", clock.time(), PROBE_UP, 0.002)
+#    h.get("router").query(clock.time() - 3600, clock.time(), 60)
+#
+
+
+import array
+import threading
+
+from hal import clock
+from probes import PROBE_UP, PROBE_DOWN, PROBE_TIMEOUT
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_HISTORY = flag('history')
+
+
+# Status codes stored in the ring buffer
+STATUS_CODES = {PROBE_UP: 1, PROBE_DOWN: 2, PROBE_TIMEOUT: 3}
+STATUS_NAMES = {1: PROBE_UP, 2: PROBE_DOWN, 3: PROBE_TIMEOUT}
+
+
+# Timestamps are stored as signed 32 bit deciseconds relative to the time the
+# buffer was created (good for +/- 6.8 years), and round trip times as 32 bit
+# floats (in seconds, NaN when there was no reply).
+HISTORY_CAPACITY = 7 * 24 * 3600 # A week of 1 Hz samples
+HISTORY_RETENTION_SEC = 7 * 24 * 3600
+HISTORY_CHUNK = 3600
+TICKS_PER_SEC = 10
+class ProbeHistory:
+
+  def __init__(self, capacity=HISTORY_CAPACITY):
+    self.capacity = capacity
+    self._epoch = int(clock.time())
+    size = min(capacity, HISTORY_CHUNK)
+    self._times = array.array('i', bytes(4 * size))
+    self._states = array.array('b', bytes(size))
+    self._rtts = array.array('f', bytes(4 * size))
+    self._first = 0
+    self._count = 0
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return self._count
+
+  # Return the number of bytes used by this ring buffer
+  def nbytes(self):
+    return sum(a.itemsize * len(a) for a in (self._times, self._states, self._rtts))
+
+  # Double the arrays (up to the capacity). Until they reach it the buffer has
+  # never wrapped, so the samples stay where they are.
+  def _grow(self):
+    more = min(len(self._times), self.capacity - len(self._times))
+    self._times.frombytes(bytes(4 * more))
+    self._states.frombytes(bytes(more))
+    self._rtts.frombytes(bytes(4 * more))
+
+  # Add a sample (overwriting the oldest one when the buffer is full). Samples
+  # are expected to arrive in time order.
+  def append(self, when, status, rtt):
+    tick = int(round((when - self._epoch) * TICKS_PER_SEC))
+    with self._lock:
+      if self._count == len(self._times) < self.capacity:
+        self._grow()
+      if self._count < self.capacity:
+        i = (self._first + self._count) % self.capacity
+        self._count += 1
+      else:
+        i = self._first
+        self._first = (self._first + 1) % self.capacity
+      self._times[i] = tick
+      self._states[i] = STATUS_CODES[status]
+      self._rtts[i] = float('nan') if rtt is None else rtt
+
+  # Return the time of the n-th oldest sample (lock must be held)
+  def _time(self, n):
+    return self._epoch + self._times[(self._first + n) % self.capacity] / TICKS_PER_SEC
+
+  # Return the index (oldest first) of the first sample at or after when
+  def _bisect(self, when):
+    lo = 0
+    hi = self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._time(mid) < when:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  # Downsample the samples in [start, end) into the given number of buckets of
+  # equal width. Each bucket gives the count of each status, and the min, max
+  # and average round trip time of the successful probes.
+  def query(self, start, end, buckets):
+    width = (end - start) / buckets
+    counts = [[0, 0, 0, 0] for b in range(buckets)]
+    rtt_mins = [None] * buckets
+    rtt_maxs = [None] * buckets
+    rtt_totals = [0.0] * buckets
+    rtt_counts = [0] * buckets
+    with self._lock:
+      n = self._bisect(start)
+      while n < self._count:
+        when = self._time(n)
+        if when >= end:
+          break
+        i = (self._first + n) % self.capacity
+        b = min(buckets - 1, int((when - start) / width))
+        counts[b][self._states[i]] += 1
+        rtt = self._rtts[i]
+        if rtt == rtt:
+          rtt_totals[b] += rtt
+          rtt_counts[b] += 1
+          if rtt_mins[b] is None or rtt < rtt_mins[b]:
+            rtt_mins[b] = rtt
+          if rtt_maxs[b] is None or rtt > rtt_maxs[b]:
+            rtt_maxs[b] = rtt
+        n += 1
+    result = []
+    for b in range(buckets):
+      bucket = {'start': start + b * width, 'count': sum(counts[b])}
+      for code in STATUS_NAMES.keys():
+        bucket[STATUS_NAMES[code]] = counts[b][code]
+      bucket['rtt-min'] = rtt_mins[b]
+      bucket['rtt-max'] = rtt_maxs[b]
+      bucket['rtt-avg'] = rtt_totals[b] / rtt_counts[b] if rtt_counts[b] else None
+      result.append(bucket)
+    return result
+
+
+# A collection of ProbeHistory ring buffers, one per target (created on demand)
+class HistoryStore:
+
+  def __init__(self, capacity=HISTORY_CAPACITY):
+    self._capacity = capacity
+    self._histories = {}
+    self._lock = threading.Lock()
+
+  def get(self, name):
+    return self._histories.get(name)
+
+  def names(self):
+    return list(self._histories.keys())
+
+  def record(self, name, when, status, rtt):
+    history = self._histories.get(name)
+    if history is None:
+      with self._lock:
+        history = self._histories.get(name)
+        if history is None:
+          debug(DEBUG_HISTORY, '--> new history for "%s"', name)
+          history = self._histories[name] = ProbeHistory(self._capacity)
+    history.append(when, status, rtt)
+
+
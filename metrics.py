@@ -0,0 +1,179 @@
+#
+# Prometheus-style metrics for my network monitor box
+#
+# All of the metrics are updated incrementally (in O(1)) where things happen,
+# so a scrape only has to format the current values. E.g.:
+#    c = REGISTRY.counter("mybox_things_total", "Things seen.", ["kind"])
+#    c.labels("foo").inc()
+#    print(REGISTRY.exposition())
+#
+
+
+import bisect
+import threading
+
+
+# Label values must be escaped in the text exposition format
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=None):
+  pairs = ['%s="%s"' % (n, escape(v)) for n, v in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  if not pairs:
+    return ''
+  return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Base class for a metric with (optional) labels. Each distinct set of label
+# values gets its own child, which is what actually holds the value(s).
+class Metric:
+
+  kind = None
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self._children = {}
+    self._lock = threading.Lock()
+
+  def _new_child(self):
+    raise NotImplementedError
+
+  # Return the child for these label values (creating it if necessary)
+  def labels(self, *values):
+    child = self._children.get(values)
+    if child is None:
+      with self._lock:
+        child = self._children.get(values)
+        if child is None:
+          child = self._children[values] = self._new_child()
+    return child
+
+  def _samples(self, values, child):
+    raise NotImplementedError
+
+  def exposition(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+    for values, child in list(self._children.items()):
+      lines.extend(self._samples(values, child))
+    return '\n'.join(lines)
+
+
+class CounterValue:
+
+  def __init__(self):
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+class Counter(Metric):
+
+  kind = 'counter'
+
+  def _new_child(self):
+    return CounterValue()
+
+  def _samples(self, values, child):
+    return ['%s%s %s' % (self.name, format_labels(self.labelnames, values), format_value(child.value))]
+
+
+class GaugeValue:
+
+  def __init__(self):
+    self.value = 0
+
+  def set(self, value):
+    self.value = value
+
+class Gauge(Metric):
+
+  kind = 'gauge'
+
+  def _new_child(self):
+    return GaugeValue()
+
+  def _samples(self, values, child):
+    return ['%s%s %s' % (self.name, format_labels(self.labelnames, values), format_value(child.value))]
+
+
+class HistogramValue:
+
+  def __init__(self, buckets):
+    self._buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+    self._lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect.bisect_left(self._buckets, value)
+    with self._lock:
+      self.counts[i] += 1
+      self.sum += value
+      self.count += 1
+
+class Histogram(Metric):
+
+  kind = 'histogram'
+
+  def __init__(self, name, help, labelnames=(), buckets=()):
+    Metric.__init__(self, name, help, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def _new_child(self):
+    return HistogramValue(self.buckets)
+
+  def _samples(self, values, child):
+    lines = []
+    total = 0
+    for le, count in zip(self.buckets + (float('inf'),), child.counts):
+      total += count
+      labels = format_labels(self.labelnames, values, 'le="%s"' % format_value(float(le)))
+      lines.append('%s_bucket%s %d' % (self.name, labels, total))
+    labels = format_labels(self.labelnames, values)
+    lines.append('%s_sum%s %s' % (self.name, labels, format_value(child.sum)))
+    lines.append('%s_count%s %d' % (self.name, labels, child.count))
+    return lines
+
+
+class Registry:
+
+  def __init__(self):
+    self._metrics = []
+
+  def _add(self, metric):
+    self._metrics.append(metric)
+    return metric
+
+  def counter(self, name, help, labelnames=()):
+    return self._add(Counter(name, help, labelnames))
+
+  def gauge(self, name, help, labelnames=()):
+    return self._add(Gauge(name, help, labelnames))
+
+  def histogram(self, name, help, labelnames=(), buckets=()):
+    return self._add(Histogram(name, help, labelnames, buckets))
+
+  # Return all of the metrics in the Prometheus text exposition format
+  def exposition(self):
+    return '\n'.join(m.exposition() for m in self._metrics) + '\n'
+
+
+# The registry used by all of the modules, and the metrics they share
+REGISTRY = Registry()
+LATENCY_BUCKETS_SEC = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_BUCKETS_SEC = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+loop_seconds = REGISTRY.histogram('mybox_loop_iteration_seconds', 'Time taken by each iteration of a periodic loop.', ['thread'], LOOP_BUCKETS_SEC)
+loop_lateness = REGISTRY.histogram('mybox_loop_lateness_seconds', 'How late each iteration of a periodic loop started.', ['thread'], LOOP_BUCKETS_SEC)
+loop_wakeups = REGISTRY.counter('mybox_loop_wakeups_total', 'Wakeups of each event loop.', ['loop'])
@@ -5,437 +5,938 @@
 #
 
 
+import ast
 import json
 import os
-import subprocess
-import threading
 import time
 import datetime
 from collections import deque
 
+# Startup is timed (in real seconds) from here
+STARTUP_BEGAN = time.monotonic()
+
 from rgb_leds import *
 from buttons import *
 from chk_wifi import *
-
-# Flask for debugging
+from probes import *
+from history import HistoryStore, HISTORY_RETENTION_SEC
+from analytics import Availability, MAX_GAP_SEC
+from probe_log import ProbeLog, KIND_CODES, record_dict, export_csv, export_columnar
+from doc_cache import DocumentCache
+from events import EventStream
+from metrics import REGISTRY, LATENCY_BUCKETS_SEC
+from status_engine import StatusEngine, DEAD
+from power import PowerOrchestrator, JOB_DONE
+from scheduler import AdaptiveSchedule
+from resolver import DNSCache, DNSProbe
+from topology import Topology, load_spec
+from state import StateStore, thaw
+import runtime
+from runtime import Worker
+
+# Flask for debugging (served by waitress when it is installed). Flask is
+# slow to import, so the routes are only collected here, and the app is made
+# by start_webapp() once the LEDs are showing and the probes are running.
 FLASK_BIND_ADDRESS = '0.0.0.0'
 FLASK_PORT = 8666
-from flask import Flask
-webapp = Flask('box')
+# Each /events client holds an HTTP thread for as long as it streams, so only
+# a few are allowed (MY_MAX_EVENT_CLIENTS), on top of the threads for the rest
+# of the API
+MAX_EVENT_CLIENTS = int(os.environ.get('MY_MAX_EVENT_CLIENTS', '4'))
+HTTP_THREADS = 4 + MAX_EVENT_CLIENTS
+routes = []
+def route(rule, **options):
+  def add(fn):
+    routes.append((rule, fn, options))
+    return fn
+  return add
 
+webapp = None
+def start_webapp():
+  global webapp, Flask, Response, request, abort
+  from flask import Flask, Response, request, abort
+  webapp = Flask('box')
+  for rule, fn, options in routes:
+    webapp.add_url_rule(rule, fn.__name__, fn, **options)
 
 
-# Import the GPIO library so python can work with the GPIO pins
-import RPi.GPIO as GPIO
+
+# Import the GPIO library so python can work with the GPIO pins (and the clock)
+import hal
+from hal import GPIO, clock
+import tracing
+from tracing import flag, debug
 
 
 
 # Debug flags
-DEBUG_GPIO = False
-DEBUG_SIGNALS = False
-DEBUG_FAN = False
-DEBUG_PING = False
-DEBUG_POWER = False
-DEBUG_WIFI_MONITORS = False
-
-# Debug print
-def debug(flag, str):
-  if flag:
-    print(str)
-
-
-
-# These values need to be provided in the container environment
-
-MY_LED_MAIN_GREEN    = int(os.environ['MY_LED_MAIN_GREEN'])
-MY_LED_MAIN_RED      = int(os.environ['MY_LED_MAIN_RED'])
-MY_LED_WIFI_GREEN    = int(os.environ['MY_LED_WIFI_GREEN'])
-MY_LED_WIFI_RED      = int(os.environ['MY_LED_WIFI_RED'])
-MY_LED_ROUTER_GREEN  = int(os.environ['MY_LED_ROUTER_GREEN'])
-MY_LED_ROUTER_RED    = int(os.environ['MY_LED_ROUTER_RED'])
-MY_LED_MODEM_GREEN   = int(os.environ['MY_LED_MODEM_GREEN'])
-MY_LED_MODEM_RED     = int(os.environ['MY_LED_MODEM_RED'])
-MY_RELAY_WIFI        = int(os.environ['MY_RELAY_WIFI'])
-MY_RELAY_ROUTER      = int(os.environ['MY_RELAY_ROUTER'])
-MY_RELAY_MODEM       = int(os.environ['MY_RELAY_MODEM'])
-MY_BUTTON_MAIN       = int(os.environ['MY_BUTTON_MAIN'])
-MY_BUTTON_WIFI       = int(os.environ['MY_BUTTON_WIFI'])
-MY_BUTTON_ROUTER     = int(os.environ['MY_BUTTON_ROUTER'])
-MY_BUTTON_MODEM      = int(os.environ['MY_BUTTON_MODEM'])
-MY_FAN_CONTROL_PWM   = int(os.environ['MY_FAN_CONTROL_PWM'])
-MY_ROUTER_IP         = os.environ['MY_ROUTER_IP']
-MY_WIFI_AP_IP        = os.environ['MY_WIFI_AP_IP']
-MY_OUTSIDE_IP        = os.environ['MY_OUTSIDE_IP']
-MY_WIFI_MONITORS     = os.environ['MY_WIFI_MONITORS']
-
-
-
-# Setup the GPIOs
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(MY_LED_MAIN_GREEN, GPIO.OUT)
-GPIO.setup(MY_LED_MAIN_RED, GPIO.OUT)
-GPIO.setup(MY_LED_WIFI_GREEN, GPIO.OUT)
-GPIO.setup(MY_LED_WIFI_RED, GPIO.OUT)
-GPIO.setup(MY_LED_ROUTER_GREEN, GPIO.OUT)
-GPIO.setup(MY_LED_ROUTER_RED, GPIO.OUT)
-GPIO.setup(MY_LED_MODEM_GREEN, GPIO.OUT)
-GPIO.setup(MY_LED_MODEM_RED, GPIO.OUT)
-GPIO.setup(MY_RELAY_WIFI, GPIO.OUT)
-GPIO.setup(MY_RELAY_ROUTER, GPIO.OUT)
-GPIO.setup(MY_RELAY_MODEM, GPIO.OUT)
-GPIO.setup(MY_BUTTON_MAIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(MY_BUTTON_WIFI, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(MY_BUTTON_ROUTER, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(MY_BUTTON_MODEM, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(MY_FAN_CONTROL_PWM, GPIO.OUT)
+DEBUG_GPIO = flag('gpio')
+DEBUG_SIGNALS = flag('signals')
+DEBUG_FAN = flag('fan')
+DEBUG_PING = flag('ping')
+DEBUG_POWER = flag('power')
+DEBUG_WIFI_MONITORS = flag('wifi-monitors')
+DEBUG_STARTUP = flag('startup')
+
+# The time each phase of the startup was reached (in real seconds since
+# STARTUP_BEGAN, and each only the first time), e.g., "settled" once every
+# probed target's LED shows a state from fresh probe results
+startup = dict()
+def startup_phase(phase):
+  if phase not in startup:
+    startup[phase] = round(time.monotonic() - STARTUP_BEGAN, 3)
+    debug(DEBUG_STARTUP, '--> startup: %s at %0.3fs', phase, startup[phase])
+
+
+
+# These values need to be provided in the container environment (except on a
+# simulated board, where they default to the values for my hardware)
+SIM_DEFAULTS = {
+  'MY_LED_MAIN_GREEN': '25',
+  'MY_LED_MAIN_RED': '21',
+  'MY_LED_WIFI_GREEN': '14',
+  'MY_LED_WIFI_RED': '15',
+  'MY_LED_ROUTER_GREEN': '20',
+  'MY_LED_ROUTER_RED': '16',
+  'MY_LED_MODEM_GREEN': '8',
+  'MY_LED_MODEM_RED': '7',
+  'MY_RELAY_WIFI': '22',
+  'MY_RELAY_ROUTER': '27',
+  'MY_RELAY_MODEM': '17',
+  'MY_BUTTON_MAIN': '26',
+  'MY_BUTTON_WIFI': '19',
+  'MY_BUTTON_ROUTER': '13',
+  'MY_BUTTON_MODEM': '6',
+  'MY_FAN_CONTROL_PWM': '18',
+  'MY_ROUTER_IP': '127.0.0.1',
+  'MY_WIFI_AP_IP': '127.0.0.1',
+  'MY_OUTSIDE_IP': 'localhost',
+  'MY_WIFI_MONITORS': '{"Loopback": "127.0.0.1:8666"}'
+}
+def env(name):
+  if hal.simulated():
+    return os.environ.get(name, SIM_DEFAULTS[name])
+  return os.environ[name]
+
+MY_FAN_CONTROL_PWM   = int(env('MY_FAN_CONTROL_PWM'))
+
+# The targets (and their LEDs, relays and buttons) are read from the topology
+# in MY_TOPOLOGY (JSON) or the MY_TOPOLOGY_FILE (JSON or YAML). Without either,
+# the original topology of my box is built from the other MY_* variables.
+MIN_TOLERANCE = 1 + (MAX_SLEEP_BETWEEN_PINGS_SEC + PING_TIMEOUT_SEC)
+ROUTER_ALIVE_TOLERANCE_SEC = MIN_TOLERANCE
+ROUTER_DEAD_TOLERANCE_SEC = MIN_TOLERANCE + 60
+WIFI_AP_ALIVE_TOLERANCE_SEC = MIN_TOLERANCE
+WIFI_AP_DEAD_TOLERANCE_SEC = MIN_TOLERANCE + 60
+MONITORS_ALIVE_TOLERANCE_SEC = MIN_TOLERANCE + 30
+MONITORS_DEAD_TOLERANCE_SEC = MIN_TOLERANCE + 90
+OUTSIDE_ALIVE_TOLERANCE_SEC = 120
+OUTSIDE_DEAD_TOLERANCE_SEC = 240
+def legacy_topology():
+  def led(name):
+    return {'red': int(env('MY_LED_%s_RED' % name)), 'green': int(env('MY_LED_%s_GREEN' % name))}
+  main = {'name': 'main', 'led': led('MAIN'), 'button': int(env('MY_BUTTON_MAIN'))}
+  main['http'] = ast.literal_eval(env('MY_WIFI_MONITORS'))
+  main['alive'] = MONITORS_ALIVE_TOLERANCE_SEC
+  main['dead'] = MONITORS_DEAD_TOLERANCE_SEC
+  wifi = {'name': 'wifi', 'led': led('WIFI'), 'relay': int(env('MY_RELAY_WIFI')), 'button': int(env('MY_BUTTON_WIFI'))}
+  wifi['ping'] = {'ap': env('MY_WIFI_AP_IP')}
+  wifi['alive'] = WIFI_AP_ALIVE_TOLERANCE_SEC
+  wifi['dead'] = WIFI_AP_DEAD_TOLERANCE_SEC
+  wifi['power_on_order'] = 1
+  wifi['power_on_delay'] = 1
+  router = {'name': 'router', 'led': led('ROUTER'), 'relay': int(env('MY_RELAY_ROUTER')), 'button': int(env('MY_BUTTON_ROUTER'))}
+  router['ping'] = {'router': env('MY_ROUTER_IP')}
+  router['alive'] = ROUTER_ALIVE_TOLERANCE_SEC
+  router['dead'] = ROUTER_DEAD_TOLERANCE_SEC
+  router['power_on_order'] = 0
+  router['power_on_delay'] = 5
+  modem = {'name': 'modem', 'led': led('MODEM'), 'relay': int(env('MY_RELAY_MODEM')), 'button': int(env('MY_BUTTON_MODEM'))}
+  modem['ping'] = {'outside': env('MY_OUTSIDE_IP')}
+  modem['alive'] = OUTSIDE_ALIVE_TOLERANCE_SEC
+  modem['dead'] = OUTSIDE_DEAD_TOLERANCE_SEC
+  modem['power_on_order'] = 2
+  return {'targets': [main, wifi, router, modem]}
+
+# The status document of the built-in (legacy) layout keeps the key names it
+# has always had, for the dashboards and scrapers that poll it
+LEGACY_LAYOUT = not (os.environ.get('MY_TOPOLOGY') or os.environ.get('MY_TOPOLOGY_FILE'))
+LEGACY_STATUS_KEYS = {'rgb-leds': {'wifi': 'wifi-ap'}, 'last-ping': {'ap': 'wifi-ap'}}
+def legacy_keys(j):
+  for section, renames in LEGACY_STATUS_KEYS.items():
+    for name, legacy in renames.items():
+      if name in j[section]:
+        j[section][legacy] = j[section].pop(name)
+
+def load_topology():
+  if LEGACY_LAYOUT:
+    return Topology(legacy_topology())
+  return Topology(load_spec(os.environ.get('MY_TOPOLOGY'), os.environ.get('MY_TOPOLOGY_FILE')))
+topology = load_topology()
+
+
+
+# Setup the GPIOs (called by the main program, not at import time)
 PWM_FREQUENCY = 110
-fan_percent = GPIO.PWM(MY_FAN_CONTROL_PWM, PWM_FREQUENCY)
-debug(DEBUG_GPIO, 'GPIO pin modes set.')
+fan_percent = None
+def setup_gpio():
+  global fan_percent
+  GPIO.setwarnings(False)
+  GPIO.setmode(GPIO.BCM)
+  for target in topology:
+    for pin in target.outputs():
+      GPIO.setup(pin, GPIO.OUT)
+    if target.button is not None:
+      GPIO.setup(target.button, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+  GPIO.setup(MY_FAN_CONTROL_PWM, GPIO.OUT)
+  fan_percent = GPIO.PWM(MY_FAN_CONTROL_PWM, PWM_FREQUENCY)
+  debug(DEBUG_GPIO, 'GPIO pin modes set.')
+
+
+# A global noting whether the daemon is still running (until it is shut down)
+keep_on_swimming = True
 
+# The state shared by the workers and the REST API is published as versioned
+# snapshots (see state.py), in these sections: "probes" (the last good result
+# of each probe), "statuses" (the latest status of each probe, and DNS host),
+# "indicators", "leds", "buttons" (when each was pressed, if it is) and "power"
+# (the running and queued jobs). The engines each publish their passes as one
+# version, and the event handlers each theirs.
+store = StateStore()
 
-# A global to control all of the thread loops
-keep_on_swimming = True
+
+
+# Metrics (exposed at /metrics). Shared ones (e.g., loop timing) are in metrics.py
+probe_results = REGISTRY.counter('mybox_probe_results_total', 'Completed probes, by target and result (up, down or timeout).', ['target', 'result'])
+probe_rtt = REGISTRY.histogram('mybox_probe_rtt_seconds', 'Round trip time of successful probes.', ['target', 'kind'], LATENCY_BUCKETS_SEC)
+cpu_temperature = REGISTRY.gauge('mybox_cpu_temperature_celsius', 'CPU temperature.')
+fan_duty = REGISTRY.gauge('mybox_fan_duty_percent', 'Current fan PWM duty cycle.')
+power_cycles = REGISTRY.counter('mybox_power_cycles_total', 'Power cycles started, by target.', ['target'])
+power_cycle_seconds = REGISTRY.histogram('mybox_power_cycle_duration_seconds', 'Time from the start of a power cycle until the power is back on.', ['target'], (5, 10, 15, 20, 30, 60))
 
 
 
-# A thread to loop forever checking CPU temperature and adjusting the fan PWM
+# The workers (besides the engines) are kept here, to be stopped on exit
+flasher = None
+fan = None
+
+# A worker to check the CPU temperature (forever) and adjust the fan PWM
 FAN_RAMP_START = 40.0 # I.e., fan starts to ramp up speed at this temp (in C)
 FAN_RAMP_FULL = 60.0 # I.e., max fan starts at this temp (in C)
 FAN_MIN = 25.0 # Baseline fan speed in percent (it will never go below this)
 SLEEP_BETWEEN_TEMP_CHECKS_SEC = 120
 CPUTEMP_PATH = '/cputemp'
-class FanThread(threading.Thread):
-  def run(self):
+class FanControl(Worker):
+  def __init__(self):
+    Worker.__init__(self, 'fan')
+    debug(DEBUG_FAN, ("Fan management started!"))
+
+  def _work(self, now):
     global fan_percent
-    debug(DEBUG_FAN, ("Fan management thread started!"))
     fn = CPUTEMP_PATH
-    global keep_on_swimming
-    while keep_on_swimming:
-      with open(fn, 'r') as file:
-        temp = float(file.read().replace('\n', '')) / 1000.0
-      fan_ramp = 0
-      if temp >= FAN_RAMP_START:
-        fan_ramp = temp - FAN_RAMP_START
-      if temp >= FAN_RAMP_FULL:
-        fan_ramp = (FAN_RAMP_FULL - FAN_RAMP_START)
-      fan_pct = int(100.0 * (fan_ramp / (FAN_RAMP_FULL - FAN_RAMP_START)))
-      if fan_pct < FAN_MIN:
-        fan_pct = FAN_MIN
-      if fan_pct > 100:
-        fan_pct = 100
-      debug(DEBUG_FAN, ("--> FAN: t=%0.1f\N{DEGREE SIGN}C, f=%d%%\n" % (temp, fan_pct)))
-      fan_percent.ChangeDutyCycle(fan_pct)
-      time.sleep(SLEEP_BETWEEN_TEMP_CHECKS_SEC)
-
-
-
-# A thread to set a specified relay low, pause, then set it high again
-power_cycling_target = None
+    temp = hal.cpu_temperature(fn)
+    fan_ramp = 0
+    if temp >= FAN_RAMP_START:
+      fan_ramp = temp - FAN_RAMP_START
+    if temp >= FAN_RAMP_FULL:
+      fan_ramp = (FAN_RAMP_FULL - FAN_RAMP_START)
+    fan_pct = int(100.0 * (fan_ramp / (FAN_RAMP_FULL - FAN_RAMP_START)))
+    if fan_pct < FAN_MIN:
+      fan_pct = FAN_MIN
+    if fan_pct > 100:
+      fan_pct = 100
+    debug(DEBUG_FAN, "--> FAN: t=%0.1f\N{DEGREE SIGN}C, f=%d%%\n", temp, fan_pct)
+    fan_percent.ChangeDutyCycle(fan_pct)
+    cpu_temperature.labels().set(temp)
+    if probe_log:
+      probe_log.temperature('cpu', now, temp)
+    fan_duty.labels().set(fan_pct)
+    return now + SLEEP_BETWEEN_TEMP_CHECKS_SEC
+
+
+
+# Show a color (solid or flashing) on a target's RGB_LED, if it has one
+def show_led(name, color, flashing):
+  led = rgb_leds.get(name)
+  if led is not None:
+    getattr(led, color)()
+    led.flash(flashing)
+
+def led_changed(led):
+  with store.transaction() as t:
+    t.set('leds', led.name, led.state())
+    publish_event('led', {'led': led.name, 'state': led.state()})
+  if flasher:
+    flasher.led_changed()
+
+# Power cycles are run by the PowerOrchestrator, as jobs of timed steps, so
+# whatever requests them (the buttons, the REST API, or the automatic policy)
+# never waits for them. A job for a target with a relay confirms (solid red),
+# then turns it off (flashing green), then back on. A job for a target without
+# a relay (i.e., "main") turns every relay off, then back on in power-up order.
 POWER_OFF_CONFIRMATION_SEC = 3
 POWER_OFF_DURATION_SEC = 10
-def power_cycle(relay):
-  global power_cycling_target
-  debug(DEBUG_POWER, ("Power cycling \"%s\"... [OFF]" % (power_cycling_target)))
-  GPIO.output(relay, GPIO.LOW)
-  time.sleep(POWER_OFF_DURATION_SEC)
-  GPIO.output(relay, GPIO.HIGH)
-  debug(DEBUG_POWER, ("Power cycling \"%s\"... [ON!]" % (power_cycling_target)))
-  power_cycling_target = None
-
-# Turn the appropriate outlet off then back on, then reset state
-def start_power_cycle(which):
-  if "main" == which:
-    global power_cycling_target
-    debug(DEBUG_POWER, "Power cycling all devices ... [OFF]")
-    rgb_led_main.red()
-    rgb_led_main.flash(False)
-    time.sleep(POWER_OFF_CONFIRMATION_SEC)
-    GPIO.output(MY_RELAY_WIFI, GPIO.LOW)
-    GPIO.output(MY_RELAY_ROUTER, GPIO.LOW)
-    GPIO.output(MY_RELAY_MODEM, GPIO.LOW)
-    rgb_led_main.green()
-    rgb_led_main.flash(True)
-    time.sleep(POWER_OFF_DURATION_SEC)
-    debug(DEBUG_POWER, "Power cycling all devices ... [ROUTER->ON!]")
-    rgb_led_router.green()
-    rgb_led_router.flash(True)
-    GPIO.output(MY_RELAY_ROUTER, GPIO.HIGH)
-    time.sleep(5)
-    debug(DEBUG_POWER, "Power cycling all devices ... [WIFI->ON!]")
-    rgb_led_wifi.green()
-    rgb_led_wifi.flash(True)
-    GPIO.output(MY_RELAY_WIFI, GPIO.HIGH)
-    time.sleep(1)
-    debug(DEBUG_POWER, "Power cycling all devices ... [MODEM->ON!]")
-    rgb_led_modem.green()
-    rgb_led_modem.flash(True)
-    GPIO.output(MY_RELAY_MODEM, GPIO.HIGH)
-    power_cycling_target = None
-  elif "wifi" == which:
-    t = threading.Thread(target=power_cycle, args=[MY_RELAY_WIFI])
-    rgb_led_wifi.red()
-    rgb_led_wifi.flash(False)
-    time.sleep(POWER_OFF_CONFIRMATION_SEC)
-    rgb_led_wifi.green()
-    rgb_led_wifi.flash(True)
-    t.start()
-  elif "router" == which:
-    t = threading.Thread(target=power_cycle, args=[MY_RELAY_ROUTER])
-    rgb_led_router.red()
-    rgb_led_router.flash(False)
-    time.sleep(POWER_OFF_CONFIRMATION_SEC)
-    rgb_led_router.green()
-    rgb_led_router.flash(True)
-    t.start()
-  elif "modem" == which:
-    t = threading.Thread(target=power_cycle, args=[MY_RELAY_MODEM])
-    rgb_led_modem.red()
-    rgb_led_modem.flash(False)
-    time.sleep(POWER_OFF_CONFIRMATION_SEC)
-    rgb_led_modem.green()
-    rgb_led_modem.flash(True)
-    t.start()
-
-
-SLEEP_BETWEEN_PINGS_SEC = 10
-PING_TIMEOUT_SEC = 10
-ping_times = {}
-wifi_monitor = None
-class PingThread(threading.Thread):
-  def __init__(self, name, addr):
-    threading.Thread.__init__(self)
-    global ping_times
-    self._name = name
-    self._addr = addr
-    ping_times[self._name] = 0
-  def run(self):
-    global ping_times
-    debug(DEBUG_PING, ('--> ping %s (%s)' % (self._name, self._addr)))
-    global keep_on_swimming
-    while keep_on_swimming:
-      try:
-        p = subprocess.run('ping -c 1 ' + self._addr + ' >/dev/null 2>&1', capture_output=False, shell=True, check=True, timeout=PING_TIMEOUT_SEC)
-        # The ping command returned in time with 0 exit status
-        ping_times[self._name] = time.time()
-        debug(DEBUG_PING, ('<-- ping %s (%s) [UP]' % (self._name, self._addr)))
-      except subprocess.CalledProcessError:
-        # The ping command gave a non-zero exit status (host did not respond)
-        debug(DEBUG_PING, ('<-- ping %s (%s) [DN]' % (self._name, self._addr)))
-      except subprocess.TimeoutExpired:
-        # The ping command did not complete before the timeout
-        p.kill()
-        debug(DEBUG_PING, ('<-- ping %s (%s) [TO]' % (self._name, self._addr)))
-      time.sleep(SLEEP_BETWEEN_PINGS_SEC)
-
-# Loop forever checking status, and setting status LEDs accordingly
-SLEEP_BETWEEN_LED_CHECKS_SEC = 2
-MIN_TOLERANCE = 1 + (SLEEP_BETWEEN_PINGS_SEC + PING_TIMEOUT_SEC)
-ROUTER_ALIVE_TOLERANCE_SEC = MIN_TOLERANCE
-ROUTER_DEAD_TOLERANCE_SEC = MIN_TOLERANCE + 60
-WIFI_AP_ALIVE_TOLERANCE_SEC = MIN_TOLERANCE
-WIFI_AP_DEAD_TOLERANCE_SEC = MIN_TOLERANCE + 60
-MONITORS_ALIVE_TOLERANCE_SEC = MIN_TOLERANCE + 30
-MONITORS_DEAD_TOLERANCE_SEC = MIN_TOLERANCE + 90
-OUTSIDE_ALIVE_TOLERANCE_SEC = 120
-OUTSIDE_DEAD_TOLERANCE_SEC = 240
-rgb_led_main = None
-rgb_led_wifi = None
-rgb_led_router = None
-rgb_led_modem = None
-no_buttons_active = True
-class StatusThread(threading.Thread):
-  def run(self):
-    rgb_led_main.green()
-    rgb_led_wifi.green()
-    rgb_led_router.green()
-    rgb_led_modem.green()
-    rgb_led_main.flash(True)
-    rgb_led_wifi.flash(True)
-    rgb_led_router.flash(True)
-    rgb_led_modem.flash(True)
-    router_ping_thread = PingThread("router", MY_ROUTER_IP)
-    router_ping_thread.start()
-    wifi_ap_ping_thread = PingThread("ap", MY_WIFI_AP_IP)
-    wifi_ap_ping_thread.start()
-    outside_ping_thread = PingThread("outside", MY_OUTSIDE_IP)
-    outside_ping_thread.start()
-    last_good_wifi = 0
-    last_good_router = 0
-    last_good_outside = 0
-    last_good_monitors = 0
-    global no_buttons_active
-    global keep_on_swimming
-    while keep_on_swimming:
-
-      # Pause status updates when power cycling in progress
-      if None == power_cycling_target and no_buttons_active:
-
-        # Local router status
-        last_good_router = ping_times["router"]
-        if ROUTER_ALIVE_TOLERANCE_SEC >= (time.time() - last_good_router):
-          rgb_led_router.green()
-          rgb_led_router.flash(False)
-        elif ROUTER_DEAD_TOLERANCE_SEC < (time.time() - last_good_router):
-          rgb_led_router.red()
-          rgb_led_router.flash(True)
-        else:
-          rgb_led_router.green()
-          rgb_led_router.flash(True)
-
-        # Local WiFi access point status
-        last_good_wifi = ping_times["ap"]
-        if WIFI_AP_ALIVE_TOLERANCE_SEC >= (time.time() - last_good_wifi):
-          rgb_led_wifi.green()
-          rgb_led_wifi.flash(False)
-        elif WIFI_AP_DEAD_TOLERANCE_SEC < (time.time() - last_good_wifi):
-          rgb_led_wifi.red()
-          rgb_led_wifi.flash(True)
-        else:
-          rgb_led_wifi.green()
-          rgb_led_wifi.flash(True)
-
-        # Local outside internet connection status
-        last_good_outside = ping_times["outside"]
-        if OUTSIDE_ALIVE_TOLERANCE_SEC >= (time.time() - last_good_outside):
-          rgb_led_modem.green()
-          rgb_led_modem.flash(False)
-        elif OUTSIDE_DEAD_TOLERANCE_SEC < (time.time() - last_good_outside):
-          rgb_led_modem.red()
-          rgb_led_modem.flash(True)
-        else:
-          rgb_led_modem.green()
-          rgb_led_modem.flash(True)
-
-        # WiFi monitors' connection status
-        last_good_monitors = wifi_monitor.last_good_status()
-        debug(DEBUG_WIFI_MONITORS, '--> LastGoodMonitors: %0.1fs' % (last_good_monitors))
-        if MONITORS_ALIVE_TOLERANCE_SEC >= (time.time() - last_good_monitors):
-          debug(DEBUG_WIFI_MONITORS, '** GOOD!')
-          rgb_led_main.green()
-          rgb_led_main.flash(False)
-        elif MONITORS_DEAD_TOLERANCE_SEC < (time.time() - last_good_monitors):
-          debug(DEBUG_WIFI_MONITORS, '** BAD!')
-          rgb_led_main.red()
-          rgb_led_main.flash(True)
-        else:
-          debug(DEBUG_WIFI_MONITORS, '** ????')
-          rgb_led_main.green()
-          rgb_led_main.flash(True)
-
-      time.sleep(SLEEP_BETWEEN_LED_CHECKS_SEC)
-
-
-
-# Loop forever watching the buttons, and if needed, power cycling things
+power = None
+def set_relays(relays, level):
+  for relay in relays:
+    GPIO.output(relay, level)
+
+def power_on(target):
+  def on():
+    debug(DEBUG_POWER, "Power cycling ... [%s->ON!]", target.name.upper())
+    show_led(target.name, 'green', True)
+    GPIO.output(target.relay, GPIO.HIGH)
+  return on
+
+def power_cycle_steps(which):
+  order = [topology[which]]
+  if topology[which].relay is None:
+    order = topology.power_on_order()
+  relays = [target.relay for target in order]
+  def confirm():
+    show_led(which, 'red', False)
+  def off():
+    debug(DEBUG_POWER, "Power cycling \"%s\"... [OFF]", which)
+    set_relays(relays, GPIO.LOW)
+    show_led(which, 'green', True)
+  steps = [('confirm', confirm, POWER_OFF_CONFIRMATION_SEC), ('off', off, POWER_OFF_DURATION_SEC)]
+  for i, target in enumerate(order):
+    steps.append(('on:' + target.name, power_on(target), target.power_on_delay if i + 1 < len(order) else 0))
+  return relays, steps
+
+# Request a power cycle of a target (returning its job, which may be one that
+# was already queued or running for it). Cancelled jobs turn the power back on.
+def request_power_cycle(which, source):
+  relays, steps = power_cycle_steps(which)
+  return power.submit(which, relays, steps, source, lambda: set_relays(relays, GPIO.HIGH))
+
+# While a job runs, the indicators of the targets it powers off are held (and
+# the job shows its progress on their LEDs instead)
+def power_indicators(job):
+  if topology[job.target].relay is None:
+    return [job.target] + [target.name for target in topology.power_on_order()]
+  return [job.target]
+
+def power_started(job):
+  power_cycles.labels(job.target).inc()
+  if probe_log:
+    probe_log.power(job.target, job.started, 'started', None)
+  for name in power_indicators(job):
+    status_engine.hold(name, True)
+  publish_event('power-cycle', {'target': job.target, 'job': job.id, 'source': job.source, 'state': 'started'})
+
+def power_done(job):
+  if JOB_DONE == job.state:
+    power_cycle_seconds.labels(job.target).observe(job.finished - job.started)
+  if probe_log:
+    probe_log.power(job.target, job.finished, job.state, job.finished - job.started)
+  for name in power_indicators(job):
+    status_engine.hold(name, False)
+  publish_event('power-cycle', {'target': job.target, 'job': job.id, 'source': job.source, 'state': job.state})
+
+# The jobs are published after every pass over them (in the same version as
+# the LEDs and relays their steps changed)
+def power_changed():
+  with store.transaction() as t:
+    t.set('power', 'active', power.active())
+    t.set('power', 'jobs', power.jobs())
+
+def start_power():
+  global power
+  power = PowerOrchestrator(power_started, power_done, power_changed)
+  power.batch = store.transaction
+  power.start()
+
+# Targets with an auto_cycle_after are power cycled once they have been dead
+# for that long (but no more often than every AUTO_CYCLE_COOLDOWN_SEC)
+AUTO_CYCLE_COOLDOWN_SEC = 3600
+dead_since = {}
+auto_cycled = {}
+def indicator_changed(name, state):
+  with store.transaction() as t:
+    t.set('indicators', name, state)
+  publish_event('indicator', {'target': name, 'state': state})
+  save_states()
+  if DEAD != state:
+    dead_since.pop(name, None)
+    return
+  dead_since[name] = clock.time()
+  after = topology[name].auto_cycle_after
+  if after is not None:
+    clock.timer(after, auto_power_cycle, (name, dead_since[name]))
+
+def auto_power_cycle(name, since):
+  now = clock.time()
+  if dead_since.get(name) == since and now - auto_cycled.get(name, -AUTO_CYCLE_COOLDOWN_SEC) >= AUTO_CYCLE_COOLDOWN_SEC:
+    auto_cycled[name] = now
+    debug(DEBUG_POWER, "Power cycling \"%s\" (dead since %0.1fs ago)", name, now - since)
+    request_power_cycle(name, 'auto')
+
+
+# All of the probes (of every kind) are run by a single ProbeEngine, on one
+# adaptive schedule
+prober = None
+probe_schedule = None
+history = HistoryStore()
+
+# When MY_DATA_DIR is set (e.g., to a volume), the probe results, power cycles
+# and temperatures are also appended to a persistent log there, which is
+# replayed into the history at startup. Logs are kept for
+# MY_LOG_RETENTION_DAYS.
+MY_DATA_DIR = os.environ.get('MY_DATA_DIR')
+MY_LOG_RETENTION_DAYS = float(os.environ.get('MY_LOG_RETENTION_DAYS', '90'))
+probe_log = None
+def start_probe_log():
+  global probe_log
+  if MY_DATA_DIR:
+    probe_log = ProbeLog(os.path.join(MY_DATA_DIR, 'log'), MY_LOG_RETENTION_DAYS)
+    probe_log.replay(history, clock.time() - HISTORY_RETENTION_SEC)
+    saved = load_data_file(ANALYTICS_FILE)
+    if saved:
+      analytics.restore(saved['targets'])
+    probe_log.replay(analytics, saved['time'] if saved else clock.time() - HISTORY_RETENTION_SEC)
+    save_analytics()
+
+# Small JSON files are kept in MY_DATA_DIR too (each replaced atomically)
+def load_data_file(name):
+  if not MY_DATA_DIR:
+    return None
+  try:
+    with open(os.path.join(MY_DATA_DIR, name), 'r') as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    return None
+
+def save_data_file(name, j):
+  if not MY_DATA_DIR:
+    return
+  path = os.path.join(MY_DATA_DIR, name)
+  try:
+    if not os.path.isdir(MY_DATA_DIR):
+      os.makedirs(MY_DATA_DIR)
+    with open(path + '.tmp', 'w') as file:
+      json.dump(j, file)
+    os.replace(path + '.tmp', path)
+  except OSError as e:
+    debug(DEBUG_STARTUP, '--> cannot save %s: %s', path, e)
+
+# The indicator states are saved (whenever one changes), so after a restart
+# each LED can show its last known state until fresh results arrive
+STATES_FILE = 'states.json'
+def load_states():
+  saved = load_data_file(STATES_FILE)
+  if saved is None:
+    return dict()
+  return saved.get('indicators', dict())
+
+def save_states():
+  j = dict()
+  j['time'] = clock.time()
+  j['indicators'] = status_engine.states()
+  save_data_file(STATES_FILE, j)
+
+# The analytics are saved every ANALYTICS_SAVE_SEC (and on exit), and only
+# the results logged since then are replayed into them at startup
+ANALYTICS_FILE = 'analytics.json'
+ANALYTICS_SAVE_SEC = 600
+def save_analytics(again=True):
+  j = dict()
+  j['time'] = clock.time()
+  j['targets'] = analytics.snapshot()
+  save_data_file(ANALYTICS_FILE, j)
+  if again:
+    clock.timer(ANALYTICS_SAVE_SEC, save_analytics)
+
+def probe_result(name, kind, status, rtt):
+  now = clock.time()
+  with store.transaction() as t:
+    if PROBE_UP == status:
+      probe = dict(t.get('probes', name))
+      probe['good'] = now
+      probe['rtt'] = rtt
+      t.set('probes', name, probe)
+      probe_rtt.labels(name, kind).observe(rtt)
+    probe_results.labels(name, status).inc()
+    history.record(name, now, status, rtt)
+    analytics.record(name, now, status, rtt)
+    if probe_log:
+      probe_log.probe(name, now, status, rtt)
+    probe_state(name, status)
+    status_engine.result(topology.target_of(name).name, name, PROBE_UP == status)
+    report_result(name)
+  debug(DEBUG_PING, '<-- %s %s [%s]', kind, name, status)
+
+# A target is only as good as the oldest last good result of its probes. It is
+# only reported once all of them have a result (until then, its indicator
+# keeps its provisional state).
+settled = set()
+def report_result(probe):
+  startup_phase('first-result')
+  target = topology.target_of(probe)
+  with store.transaction() as t:
+    if any(t.get('statuses', p) is None for p in target.probes()):
+      return
+    status_engine.report(target.name, min(t.get('probes', p)['good'] for p in target.probes()))
+  if target.name not in settled:
+    settled.add(target.name)
+    if all(t.name in settled for t in topology if t.probes()):
+      startup_phase('settled')
+
+# Note the latest status of a probe target, and whether it has changed
+def probe_state(name, status):
+  with store.transaction() as t:
+    if t.get('statuses', name) != status:
+      t.set('statuses', name, status)
+      publish_event('probe', {'target': name, 'status': status})
+
+# The status engine sets the status LEDs (of the targets that have them) as
+# probe results arrive, and as the tolerances since the last good results pass
+rgb_leds = {}
+status_engine = None
+def start_status_engine():
+  global status_engine
+  status_engine = StatusEngine(indicator_changed)
+  status_engine.batch = store.transaction
+  states = load_states()
+  for target in topology:
+    status_engine.add(target.name, rgb_leds.get(target.name), target.alive_tolerance, target.dead_tolerance, states.get(target.name), target.detector)
+  with store.transaction() as t:
+    for name, state in status_engine.states().items():
+      t.set('indicators', name, state)
+  status_engine.start()
+
+# Pause status updates while buttons are active
+def update_status_pause():
+  if status_engine:
+    status_engine.pause(any(b.is_pressed() for b in buttons.values()))
+
+# Each target is probed on an adaptive schedule, whose ceiling keeps at least
+# two probes inside the alive tolerance of the indicator it drives (so a single
+# lost probe is retried before it can show), and never goes over the
+# (optional) MY_PROBE_MAX_INTERVAL_SEC
+PROBE_MAX_INTERVAL_SEC = float(os.environ.get('MY_PROBE_MAX_INTERVAL_SEC', '60'))
+def probe_ceiling(probe):
+  return min(PROBE_MAX_INTERVAL_SEC, topology.target_of(probe).alive_tolerance / 2.0)
+
+# Uptime, outages and recovery times of every probe target, over sliding
+# windows of up to 30 days (see analytics.py). Gaps between results longer
+# than the probes ever leave (e.g., while the box was down) are not counted.
+analytics = Availability(max(MAX_GAP_SEC, 2 * PROBE_MAX_INTERVAL_SEC))
+
+# The kinds of probes (by their topology keys), as (plugin, base interval).
+# A probe is given in the topology by its address (or query, for "dns"), or by
+# a dict of the plugin's keyword arguments (e.g., {"address": ..., "path": ...}).
+PROBE_KINDS = {
+  'ping': (ICMPProbe, PING_BASE_SEC),
+  'http': (HTTPProbe, WIFI_CHECK_BASE_SEC),
+  'tcp': (TCPProbe, PING_BASE_SEC),
+  'dns': (DNSProbe, PING_BASE_SEC)
+}
+def make_probe(key, name, spec):
+  plugin = PROBE_KINDS[key][0]
+  options = dict(spec) if isinstance(spec, dict) else dict()
+  if 'dns' == key:
+    options.setdefault('server', MY_DNS_SERVER)
+  if isinstance(spec, dict):
+    return plugin(name, **options)
+  return plugin(name, spec, **options)
+
+def start_probes():
+  global prober
+  global probe_schedule
+  probe_schedule = AdaptiveSchedule(PING_BASE_SEC, PROBE_MAX_INTERVAL_SEC)
+  prober = ProbeEngine(probe_result, schedule=probe_schedule, resolver=resolver)
+  with store.transaction() as t:
+    for name, (key, spec) in topology.probes().items():
+      probe = make_probe(key, name, spec)
+      t.set('probes', name, {'kind': probe.kind, 'addr': probe.address, 'good': 0, 'rtt': None})
+      probe_schedule.base(name, PROBE_KINDS[key][1])
+      probe_schedule.ceiling(name, probe_ceiling(name))
+      prober.add(probe)
+  prober.start()
+
+# The host names of the probe targets (e.g., MY_OUTSIDE_IP) are resolved by a
+# caching resolver, so the probes test the links to the cached addresses, and
+# DNS is watched separately: each lookup is a "dns:<host>" result of its own
+# (in the history, metrics and events, but driving no indicator).
+# The name server is the one in resolv.conf, unless MY_DNS_SERVER is set.
+MY_DNS_SERVER = os.environ.get('MY_DNS_SERVER')
+DNS_PREFIX = 'dns:'
+resolver = None
+def dns_result(host, status, seconds):
+  name = DNS_PREFIX + host
+  probe_results.labels(name, status).inc()
+  if PROBE_UP == status:
+    probe_rtt.labels(name, 'dns').observe(seconds)
+  history.record(name, clock.time(), status, seconds if PROBE_UP == status else None)
+  probe_state(name, status)
+
+def start_resolver():
+  global resolver
+  resolver = DNSCache(dns_result, MY_DNS_SERVER)
+
+
+
+
+# Watch the buttons (through their press, hold and release events), and if
+# needed, power cycle things. A held button shows solid green on its LED, then
+# flashing red after FLASH_START_SEC, then power cycles after FLASH_ENOUGH_SEC.
 FLASH_START_SEC = 0.5
 FLASH_ENOUGH_SEC = 4.0
-SLEEP_BETWEEN_BUTTON_CHECKS_SEC = 0.33
-button_main = None
-button_wifi = None
-button_router = None
-button_modem = None
-class ButtonThread(threading.Thread):
-  def run(self):
-    global button_main
-    global button_wifi
-    global button_router
-    global button_modem
-    global rgb_led_main
-    global rgb_led_wifi
-    global rgb_led_router
-    global rgb_led_modem
-    global power_cycling_target
-    global no_buttons_active
-    global keep_on_swimming
-    while keep_on_swimming:
-
-      no_buttons_active = not (button_main.is_pressed() or button_wifi.is_pressed() or button_router.is_pressed() or button_modem.is_pressed())
-
-      # Ignore the buttons if anything is already power cycling
-      if None == power_cycling_target:
-
-        # main button
-        if button_main.held_time() > 0 and button_main.held_time() < FLASH_START_SEC:
-          rgb_led_main.green()
-          rgb_led_main.flash(False)
-        elif button_main.held_time() > FLASH_START_SEC:
-          rgb_led_main.red()
-          rgb_led_main.flash(True)
-          if button_main.held_time() > FLASH_ENOUGH_SEC:
-            power_cycling_target = "main"
-            start_power_cycle("main")
-
-        # wifi button
-        if button_wifi.held_time() > 0 and button_wifi.held_time() < FLASH_START_SEC:
-          rgb_led_wifi.green()
-          rgb_led_wifi.flash(False)
-        elif button_wifi.held_time() > FLASH_START_SEC:
-          rgb_led_wifi.red()
-          rgb_led_wifi.flash(True)
-          if button_wifi.held_time() > FLASH_ENOUGH_SEC:
-            power_cycling_target = "wifi"
-            start_power_cycle("wifi")
-
-        # router button
-        if button_router.held_time() > 0 and button_router.held_time() < FLASH_START_SEC:
-          rgb_led_router.green()
-          rgb_led_router.flash(False)
-        elif button_router.held_time() >= FLASH_START_SEC:
-          rgb_led_router.red()
-          rgb_led_router.flash(True)
-          if button_router.held_time() > FLASH_ENOUGH_SEC:
-            power_cycling_target = "router"
-            start_power_cycle("router")
-
-        # modem button
-        if button_modem.held_time() > 0 and button_modem.held_time() < FLASH_START_SEC:
-          rgb_led_modem.green()
-          rgb_led_modem.flash(False)
-        elif button_modem.held_time() > FLASH_START_SEC:
-          rgb_led_modem.red()
-          rgb_led_modem.flash(True)
-          if button_modem.held_time() > FLASH_ENOUGH_SEC:
-            power_cycling_target = "modem"
-            start_power_cycle("modem")
-
-      RGB_LED.toggle_flash_state()
-      time.sleep(SLEEP_BETWEEN_BUTTON_CHECKS_SEC)
-
-
-
-
-@webapp.route("/")
-def get_status():
+buttons = {}
+def button_pressed(button):
+  with store.transaction() as t:
+    t.set('buttons', button.name, button.pressed_at)
+    update_status_pause()
+    publish_event('button', {'button': button.name, 'action': 'press', 'held': 0})
+    # Ignore the buttons of targets that are already power cycling
+    if not power.job_for(button.name):
+      show_led(button.name, 'green', False)
+
+def button_held(button, held):
+  with store.transaction():
+    publish_event('button', {'button': button.name, 'action': 'hold', 'held': held})
+    if not power.job_for(button.name) and button.is_pressed():
+      show_led(button.name, 'red', True)
+
+def button_held_enough(button, held):
+  if not power.job_for(button.name) and button.is_pressed():
+    request_power_cycle(button.name, 'button')
+
+def button_released(button, held):
+  with store.transaction() as t:
+    t.set('buttons', button.name, None)
+    update_status_pause()
+    publish_event('button', {'button': button.name, 'action': 'release', 'held': held})
+
+def watch_button(button):
+  button.on_press(button_pressed)
+  button.on_hold(FLASH_START_SEC, button_held)
+  button.on_hold(FLASH_ENOUGH_SEC, button_held_enough)
+  button.on_release(button_released)
+
+# Flashing RGB_LEDs either blink in step with the Flasher (by default), or
+# when MY_LED_BLINK is "pwm", with their blink patterns generated by GPIO
+# (software) PWM channels, which run in the GPIO library's C code rather than
+# in Python. The patterns can be changed (or added to) with
+# MY_BLINK_PATTERNS, e.g., '{"fast": [5, 30]}' for 5 Hz at 30%.
+MY_LED_BLINK = os.environ.get('MY_LED_BLINK', 'toggle')
+MY_BLINK_PATTERNS = os.environ.get('MY_BLINK_PATTERNS')
+def setup_blink():
+  RGB_LED.pwm_blink = ('pwm' == MY_LED_BLINK)
+  if MY_BLINK_PATTERNS:
+    for name, pattern in json.loads(MY_BLINK_PATTERNS).items():
+      RGB_LED.patterns[name] = (float(pattern[0]), float(pattern[1]))
+
+# A worker to toggle the flash state of the RGB_LEDs (forever). It parks
+# (with no timer at all) while no LED is flashing, and is woken again by the
+# first LED change that starts one flashing.
+SLEEP_BETWEEN_FLASH_TOGGLES_SEC = 0.33
+class Flasher(Worker):
+  def __init__(self):
+    Worker.__init__(self, 'flash')
+    self.parked = False
+
+  def led_changed(self):
+    if self.parked and RGB_LED.any_flashing():
+      self.parked = False
+      self.wake()
+
+  def _work(self, now):
+    # Parked first, so a flash starting during the check still wakes it
+    self.parked = True
+    if not RGB_LED.any_flashing():
+      return None
+    self.parked = False
+    RGB_LED.toggle_flash_state()
+    return now + SLEEP_BETWEEN_FLASH_TOGGLES_SEC
+
+
+
+
+# The status document is cached, and only rebuilt when the state changes (or
+# once it is STATUS_MAX_AGE_SEC old, to keep the ages in it reasonably fresh).
+# The shared state in it all comes from a single snapshot (whose version it
+# shows), so e.g., "power-cycling" always agrees with "rgb-leds".
+STATUS_MAX_AGE_SEC = 1.0
+def status_document():
+  s = store.snapshot()
+  now = clock.time()
   j = dict()
+  j['version'] = s.version
   j['swimming'] = keep_on_swimming
   j['power-cycling'] = 'None'
-  if power_cycling_target:
-    j['power-cycling'] = power_cycling_target
-  import ast
-  j['wifi-monitors'] = ast.literal_eval(wifi_monitor.details().decode('UTF-8'))
+  if s['power'].get('active'):
+    j['power-cycling'] = ', '.join(s['power']['active'])
+  j['power-jobs'] = thaw(s['power'].get('jobs', ()))
+  j['probes'] = dict()
+  for name, probe in s['probes'].items():
+    j['probes'][name] = {'kind': probe['kind'], 'addr': probe['addr'], 'status': s['statuses'].get(name), 'last': now - probe['good'], 'rtt': probe['rtt']}
+  j['wifi-monitors'] = dict()
+  for name, probe in j['probes'].items():
+    if 'http' == probe['kind']:
+      j['wifi-monitors'][name] = {'addr': probe['addr'], 'last': probe['last'], 'latency': probe['rtt']}
   j['buttons'] = dict()
-  j['buttons']['main'] = button_main.held_time()
-  j['buttons']['wifi'] = button_main.held_time()
-  j['buttons']['router'] = button_main.held_time()
-  j['buttons']['modem'] = button_main.held_time()
-  j['rgb-leds'] = dict()
-  j['rgb-leds']['main'] = rgb_led_main.state()
-  j['rgb-leds']['wifi-ap'] = rgb_led_wifi.state()
-  j['rgb-leds']['router'] = rgb_led_router.state()
-  j['rgb-leds']['modem'] = rgb_led_modem.state()
+  for name, pressed_at in s['buttons'].items():
+    j['buttons'][name] = 0 if pressed_at is None else now - pressed_at
+  j['rgb-leds'] = dict(s['leds'])
+  j['indicators'] = dict(s['indicators'])
+  j['provisional'] = status_engine.provisional()
   j['last-ping'] = dict()
-  j['last-ping']['wifi-monitors'] = (time.time() - wifi_monitor.last_good_status())
-  j['last-ping']['router'] = (time.time() - ping_times["router"])
-  j['last-ping']['wifi-ap'] = (time.time() - ping_times["ap"])
-  j['last-ping']['outside'] = (time.time() - ping_times["outside"])
+  if j['wifi-monitors']:
+    j['last-ping']['wifi-monitors'] = max(m['last'] for m in j['wifi-monitors'].values())
+  j['ping-rtt'] = dict()
+  for name, probe in j['probes'].items():
+    j['last-ping'][name] = probe['last']
+    j['ping-rtt'][name] = probe['rtt']
+  j['dns'] = resolver.status(now)
+  j['probe-intervals'] = probe_schedule.intervals()
+  j['availability'] = analytics.summary(now)
+  j['startup'] = dict(startup)
+  j['runtime'] = runtime_budget()
+  if LEGACY_LAYOUT:
+    legacy_keys(j)
+  return j
+status_cache = DocumentCache(status_document, STATUS_MAX_AGE_SEC)
+
+@route("/")
+def get_status():
+  return status_cache.respond(request)
+
+# Every new version of the state invalidates the cached status document
+store.on_publish(lambda snapshot: status_cache.invalidate())
+
+# State changes are published as a stream of events (each once the version
+# with the change in it has been published)
+events = EventStream()
+def publish_event(kind, data):
+  with store.transaction() as t:
+    t.after(events.publish, (kind, data))
+
+# Server-sent events stream of the state changes. Clients resume from the
+# Last-Event-ID header (or the "since" argument) after a disconnect, e.g.:
+#    curl -sSN localhost:8666/events
+@route("/events")
+def get_events():
+  if events.clients() >= MAX_EVENT_CLIENTS:
+    abort(503)
+  since = request.headers.get('Last-Event-ID', request.args.get('since'))
+  try:
+    since = None if since is None else int(since)
+  except ValueError:
+    abort(400)
+  headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+  return Response(events.sse(since), mimetype='text/event-stream', headers=headers)
+
+# Metrics, in the Prometheus text exposition format
+@route("/metrics")
+def get_metrics():
+  return Response(REGISTRY.exposition(), mimetype='text/plain; version=0.0.4')
+
+# Power cycles can also be requested, watched and cancelled over REST, e.g.:
+#    curl -sS -X POST localhost:8666/power/router
+#    curl -sS -X DELETE localhost:8666/power/jobs/1
+@route("/power")
+def get_power():
+  j = dict()
+  j['jobs'] = power.jobs()
+  return (json.dumps(j) + '\n').encode('UTF-8')
+
+@route("/power/<name>", methods=['POST'])
+def post_power(name):
+  if name not in topology.names():
+    abort(404)
+  job = request_power_cycle(name, 'api')
+  return (json.dumps(job.status()) + '\n').encode('UTF-8'), 202
+
+@route("/power/jobs/<int:id>", methods=['GET', 'DELETE'])
+def power_job(id):
+  job = power.job(id)
+  if job is None:
+    abort(404)
+  if 'DELETE' == request.method:
+    if power.cancel(id) is None:
+      abort(409)
+    return (json.dumps(job.status()) + '\n').encode('UTF-8'), 202
+  return (json.dumps(job.status()) + '\n').encode('UTF-8')
+
+# On a simulated board, show the pin levels, and allow buttons to be pressed
+# and released (and the CPU temperature set), e.g.:
+#    curl -sS -X POST localhost:8666/sim/press/26
+@route("/sim/pins")
+def get_sim_pins():
+  if not hal.simulated():
+    abort(404)
+  j = dict()
+  j['time'] = clock.time()
+  j['writes'] = GPIO.writes
+  j['levels'] = GPIO.levels()
+  j['pwms'] = GPIO.pwms()
+  return (json.dumps(j) + '\n').encode('UTF-8')
+
+@route("/sim/<action>/<int:pin>", methods=['POST'])
+def post_sim_pin(action, pin):
+  if not hal.simulated() or action not in ('press', 'release'):
+    abort(404)
+  if 'press' == action:
+    GPIO.press(pin)
+  else:
+    GPIO.release(pin)
+  return get_sim_pins()
+
+@route("/sim/cputemp/<float:temp>", methods=['POST'])
+def post_sim_cputemp(temp):
+  if not hal.simulated():
+    abort(404)
+  GPIO.cpu_temp = temp
+  return get_sim_pins()
+
+# Tracing (see tracing.py): the subsystems' flags, the trace records after a
+# sequence number (e.g., the last one seen, optionally of some subsystems only),
+# and how late each worker's steps have started and how long they ran. A flag
+# (or "all") is switched on or off with a POST, e.g.:
+#    curl -sS -X POST localhost:8666/trace/on/probes
+#    curl -sS 'localhost:8666/trace?since=120&subsystem=probes,loops'
+@route("/trace")
+def get_trace():
+  try:
+    since = int(request.args.get('since', 0))
+  except ValueError:
+    abort(400)
+  subsystems = request.args.get('subsystem')
+  j = dict()
+  j['flags'] = tracing.flags()
+  j['last'] = tracing.last_seq()
+  j['records'] = tracing.records(since, subsystems.split(',') if subsystems else None)
+  j['loops'] = runtime.timings()
+  return (json.dumps(j) + '\n').encode('UTF-8')
+
+@route("/trace/<action>/<name>", methods=['POST'])
+def post_trace(action, name):
+  if action not in ('on', 'off'):
+    abort(404)
+  try:
+    tracing.enable([name], 'on' == action)
+  except KeyError:
+    abort(404)
+  return (json.dumps(tracing.flags()) + '\n').encode('UTF-8')
+
+# Probe history. The start and end are in seconds since the epoch (or, when
+# negative, relative to now), and the range is downsampled into buckets, e.g.:
+#    curl -sS 'localhost:8666/history/router?start=-86400&buckets=24'
+def request_range(default_range):
+  now = clock.time()
+  try:
+    end = float(request.args.get('end', now))
+    start = float(request.args.get('start', end - default_range))
+  except ValueError:
+    abort(400)
+  if end <= 0:
+    end += now
+  if start < 0:
+    start += now
+  if start >= end:
+    abort(400)
+  return start, end
+
+HISTORY_DEFAULT_RANGE_SEC = 3600
+HISTORY_DEFAULT_BUCKETS = 60
+HISTORY_MAX_BUCKETS = 10000
+@route("/history")
+def get_history_targets():
+  j = dict()
+  for name in history.names():
+    j[name] = dict()
+    j[name]['samples'] = len(history.get(name))
+    j[name]['bytes'] = history.get(name).nbytes()
   return (json.dumps(j) + '\n').encode('UTF-8')
 
+@route("/history/<name>")
+def get_history(name):
+  h = history.get(name)
+  if h is None:
+    abort(404)
+  start, end = request_range(HISTORY_DEFAULT_RANGE_SEC)
+  try:
+    buckets = int(request.args.get('buckets', HISTORY_DEFAULT_BUCKETS))
+  except ValueError:
+    abort(400)
+  if buckets < 1 or buckets > HISTORY_MAX_BUCKETS:
+    abort(400)
+  j = dict()
+  j['target'] = name
+  j['start'] = start
+  j['end'] = end
+  j['buckets'] = h.query(start, end, buckets)
+  return (json.dumps(j) + '\n').encode('UTF-8')
+
+# Records from the persistent log (of one kind and/or name, if given), e.g.:
+#    curl -sS 'localhost:8666/log?start=-600&kind=power'
+# Or, exported in bulk (streamed, as CSV or the columnar binary format), e.g.:
+#    curl -sS 'localhost:8666/log/export?start=-2592000&format=csv' > log.csv
+LOG_DEFAULT_RANGE_SEC = 3600
+LOG_DEFAULT_LIMIT = 1000
+def request_log_records(default_range):
+  if not probe_log:
+    abort(404)
+  start, end = request_range(default_range)
+  kind = request.args.get('kind')
+  if kind is not None and kind not in KIND_CODES:
+    abort(400)
+  return probe_log.read(start, end, None if kind is None else KIND_CODES[kind], request.args.get('name'))
+
+@route("/log")
+def get_log():
+  records = request_log_records(LOG_DEFAULT_RANGE_SEC)
+  try:
+    limit = int(request.args.get('limit', LOG_DEFAULT_LIMIT))
+  except ValueError:
+    abort(400)
+  j = dict()
+  j['records'] = []
+  for record in records:
+    if len(j['records']) >= limit:
+      break
+    j['records'].append(record_dict(record))
+  records.close()
+  return (json.dumps(j) + '\n').encode('UTF-8')
+
+@route("/log/export")
+def get_log_export():
+  records = request_log_records(probe_log.retention_days * 24 * 3600 if probe_log else 0)
+  if 'columnar' == request.args.get('format'):
+    headers = {'Content-Disposition': 'attachment; filename="mybox-log.bin"'}
+    return Response(export_columnar(records), mimetype='application/octet-stream', headers=headers)
+  elif request.args.get('format', 'csv') != 'csv':
+    abort(400)
+  headers = {'Content-Disposition': 'attachment; filename="mybox-log.csv"'}
+  return Response(export_csv(records), mimetype='text/csv', headers=headers)
+
 
 
 
 
-# Main program (instantiates and starts threads)
+# The workers run on a loop (and thread) each, or all on one loop when
+# MY_RUNTIME is "loop" (see runtime.py). Either way, the memory and wakeup
+# budget (MY_MEMORY_BUDGET_MB of RSS, and MY_WAKEUP_BUDGET_PER_SEC wakeups of
+# the loops) is reported RUNTIME_REPORT_SEC after startup, and kept up to date
+# in the status document. An idle box with two targets measures about 4
+# wakeups/s (2 in "loop" mode), and flashing LEDs add about 6 more (the
+# toggles and their pin writes), so the default budget holds while all is
+# well, and is exceeded once failing probes are being retried quickly.
+MY_MEMORY_BUDGET_MB = float(os.environ.get('MY_MEMORY_BUDGET_MB', '96'))
+MY_WAKEUP_BUDGET_PER_SEC = float(os.environ.get('MY_WAKEUP_BUDGET_PER_SEC', '10'))
+RUNTIME_REPORT_SEC = 60
+def runtime_budget():
+  return runtime.budget(MY_MEMORY_BUDGET_MB, MY_WAKEUP_BUDGET_PER_SEC)
+
+def report_runtime():
+  j = runtime_budget()
+  print('Runtime budget (%s mode): %0.1f of %0.1f MB, %0.2f of %0.2f wakeups/s, %d threads%s' % (j['mode'], j['rss-mb'], j['memory-budget-mb'], j['wakeups-per-sec'], j['wakeup-budget-per-sec'], j['threads'], (', OVER BUDGET: ' + ', '.join(j['over-budget'])) if j['over-budget'] else ''))
+
+
+
+# Main program (instantiates and starts the workers)
 if __name__ == '__main__':
 
   import signal
@@ -443,26 +944,88 @@ if __name__ == '__main__':
   def signal_handler(signum, frame):
     global keep_on_swimming
     debug(DEBUG_SIGNALS, 'Signal received!')
+    # Only shut down once (e.g., when a second signal arrives mid-shutdown)
+    if not keep_on_swimming:
+      return
     keep_on_swimming = False
-    button_main.stop()
-    button_wifi.stop()
-    button_router.stop()
-    button_modem.stop()
-    rgb_led_main.stop()
-    rgb_led_wifi.stop()
-    rgb_led_router.stop()
-    rgb_led_modem.stop()
-    wifi_monitor.stop()
+    for button in buttons.values():
+      button.stop()
+    for led in rgb_leds.values():
+      led.stop()
+    if prober:
+      prober.stop()
+    if resolver:
+      resolver.stop()
+    for worker in (flasher, fan):
+      if worker:
+        worker.stop()
+    status_engine.stop()
+    power.stop()
+    runtime.stop()
+    if probe_log:
+      probe_log.close()
+      save_analytics(False)
     sys.exit(0)
   signal.signal(signal.SIGINT, signal_handler)
   signal.signal(signal.SIGTERM, signal_handler)
   signal.signal(signal.SIGQUIT, signal_handler)
   signal.signal(signal.SIGTERM, signal_handler)
 
+  # Toggle tracing (of the MY_TRACE_SIGNAL subsystems, by default all of them)
+  signal.signal(signal.SIGUSR1, tracing.on_signal)
+
+  startup_phase('imports')
+
+  # Setup the GPIO pins (on the real or simulated board)
+  setup_gpio()
+
   # Always initialize the relay output pins to HIGH (on) at powerup
-  GPIO.output(MY_RELAY_WIFI, GPIO.HIGH)
-  GPIO.output(MY_RELAY_ROUTER, GPIO.HIGH)
-  GPIO.output(MY_RELAY_MODEM, GPIO.HIGH)
+  for target in topology.power_on_order():
+    GPIO.output(target.relay, GPIO.HIGH)
+  startup_phase('gpio')
+
+  # Create the (edge-triggered) button and RGB_LED objects
+  setup_blink()
+  for target in topology:
+    if target.button is not None:
+      buttons[target.name] = Button(target.name, target.button, edge_triggered=True)
+    if target.led is not None:
+      rgb_leds[target.name] = RGB_LED(target.name, target.led[0], target.led[1], target.led[2])
+
+  # Publish every change in an RGB_LED's state (and the initial ones), and
+  # whether each button is pressed
+  with store.transaction() as t:
+    for name, led in rgb_leds.items():
+      t.set('leds', name, led.state())
+    for name in buttons.keys():
+      t.set('buttons', name, None)
+  RGB_LED.on_change = led_changed
+
+  # Operate the status LEDs according to the probe results (showing their
+  # last known states until then)
+  start_status_engine()
+
+  # Flash the flashing RGB_LEDs (unless PWM channels are doing it)
+  if not RGB_LED.pwm_blink:
+    flasher = Flasher()
+    flasher.start()
+  startup_phase('leds')
+
+  # Run power cycles (requested by the buttons, REST API and auto policy)
+  start_power()
+
+  # Open the persistent log (if any), and rebuild the history from it
+  start_probe_log()
+  startup_phase('history')
+
+  # Probe all of the targets (with every kind of probe), starting right away
+  start_resolver()
+  start_probes()
+  startup_phase('probing')
+
+  # Act on the button objects' events when they are pressed
+  for button in buttons.values():
+    watch_button(button)
 
   # Fan: (set initial value; change with: `fan_percent.ChangeDutyCycle(___)`
   fan_percent.start(50)
@@ -471,34 +1034,20 @@ if __name__ == '__main__':
   GPIO.setwarnings(True)
 
   # Monitor CPU temperature and adjust fan accordingly
-  fan = FanThread()
+  fan = FanControl()
   fan.start()
 
-  # Create the button objects
-  button_main = Button("main", MY_BUTTON_MAIN)
-  button_wifi = Button("wifi", MY_BUTTON_WIFI)
-  button_router = Button("router", MY_BUTTON_ROUTER)
-  button_modem = Button("modem", MY_BUTTON_MODEM)
-
-  # Create the RGB_LED objects
-  rgb_led_main = RGB_LED("main", MY_LED_MAIN_RED, MY_LED_MAIN_GREEN, None)
-  rgb_led_wifi = RGB_LED("wifi", MY_LED_WIFI_RED, MY_LED_WIFI_GREEN, None)
-  rgb_led_router = RGB_LED("router", MY_LED_ROUTER_RED, MY_LED_ROUTER_GREEN, None)
-  rgb_led_modem = RGB_LED("modem", MY_LED_MODEM_RED, MY_LED_MODEM_GREEN, None)
-
-  # Setup a monitor for the 4 wifi ssid listeners
-  import ast
-  wifis = ast.literal_eval(MY_WIFI_MONITORS)
-  wifi_monitor = WiFiMonitor(wifis)
-
-  # Monitor system status, and operate the status LEDs accordingly
-  status = StatusThread()
-  status.start()
-
-  # Monitor the button objects, and act accordingly when they are pressed
-  buttons = ButtonThread()
-  buttons.start()
-
-  # Start the Flask REST server (which never exits)
-  webapp.run(host=FLASK_BIND_ADDRESS, port=FLASK_PORT)
+  # Report the memory and wakeup budget once the startup has settled down
+  clock.timer(RUNTIME_REPORT_SEC, report_runtime)
+
+  # Start the REST server (which never exits). Use the (multi-threaded)
+  # waitress production server if it is available, otherwise use Flask's own
+  # development server (in threaded mode)
+  start_webapp()
+  startup_phase('http')
+  try:
+    import waitress
+    waitress.serve(webapp, host=FLASK_BIND_ADDRESS, port=FLASK_PORT, threads=HTTP_THREADS)
+  except ImportError:
+    webapp.run(host=FLASK_BIND_ADDRESS, port=FLASK_PORT, threaded=True)
 
@@ -0,0 +1,213 @@
+#
+# Power cycling orchestrator for my network monitor box
+#
+# Power cycles are submitted as jobs, each of which is a sequence of timed
+# steps (e.g., confirm, off, on) over a set of relays. The jobs are run as
+# state machines on the orchestrator's own loop, so submitting, cancelling
+# or querying them never waits on a power cycle. Jobs on independent relays
+# run at the same time, and a job that needs relays that are already in use
+# waits in the queue until they are free. E.g.:
+#    p = PowerOrchestrator()
+#    p.start()
+#    off = lambda: GPIO.output(27, GPIO.LOW)
+#    on = lambda: GPIO.output(27, GPIO.HIGH)
+#    job = p.submit("router", [27], [("off", off, 10), ("on", on, 0)], "api", on)
+#    p.cancel(job.id)
+#
+
+
+import threading
+from collections import deque
+
+from hal import clock
+from runtime import Worker
+from timer_wheel import TimerWheel
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_POWER = flag('power')
+
+
+# Job states (besides the names of their steps, while they are running)
+JOB_QUEUED = 'queued'
+JOB_DONE = 'done'
+JOB_CANCELLED = 'cancelled'
+JOB_FAILED = 'failed'
+
+
+class Job:
+
+  # The steps are (state, action, seconds) tuples: each action is called on
+  # entering its state, which then lasts for the given seconds. The abort
+  # function (if any) is called if the job is cancelled (or fails) after it
+  # has started, and must leave its relays in a safe state.
+  def __init__(self, id, target, relays, steps, source, abort):
+    self.id = id
+    self.target = target
+    self.relays = set(relays)
+    self.steps = list(steps)
+    self.source = source
+    self.abort = abort
+    self.state = JOB_QUEUED
+    self.step = -1
+    self.submitted = clock.time()
+    self.started = None
+    self.step_ends = None
+    self.finished = None
+
+  def active(self):
+    return self.finished is None
+
+  def status(self):
+    j = dict()
+    j['id'] = self.id
+    j['target'] = self.target
+    j['source'] = self.source
+    j['state'] = self.state
+    j['relays'] = sorted(self.relays)
+    j['submitted'] = self.submitted
+    j['started'] = self.started
+    j['step-ends'] = self.step_ends
+    j['finished'] = self.finished
+    return j
+
+
+JOB_HISTORY = 20
+class PowerOrchestrator(Worker):
+
+  # The on_start and on_done functions (if any) are called with the job when
+  # it starts, and when it finishes (in any way, once it has started). The
+  # on_change function (if any) is called after every pass over the jobs (in
+  # the same batch, if there is one), e.g., to publish jobs().
+  def __init__(self, on_start=None, on_done=None, on_change=None):
+    Worker.__init__(self, 'power')
+    self._on_start = on_start
+    self._on_done = on_done
+    self._on_change = on_change
+    self._next_id = 1
+    self._queue = []
+    self._running = {}
+    self._busy = {}
+    self._cancels = []
+    self._finished = deque(maxlen=JOB_HISTORY)
+    self._wheel = TimerWheel(clock.time())
+    self._lock = threading.RLock()
+
+  # Submit a job (or return the active one, if the target already has one)
+  def submit(self, target, relays, steps, source, abort=None):
+    with self._lock:
+      job = self.job_for(target)
+      if job is None:
+        job = Job(self._next_id, target, relays, steps, source, abort)
+        self._next_id += 1
+        self._queue.append(job)
+        self.wake()
+        debug(DEBUG_POWER, '--> job %d: "%s" (%s)', job.id, target, source)
+      return job
+
+  # Cancel a job (returning it, or None if it is not active)
+  def cancel(self, id):
+    with self._lock:
+      job = self.job(id)
+      if job is None or not job.active():
+        return None
+      self._cancels.append(job)
+      self.wake()
+      return job
+
+  # Return a job (active or recently finished) by its id
+  def job(self, id):
+    with self._lock:
+      for job in self._queue + list(self._running.values()) + list(self._finished):
+        if job.id == id:
+          return job
+      return None
+
+  # Return the active job for a target (or None)
+  def job_for(self, target):
+    with self._lock:
+      for job in self._queue + list(self._running.values()):
+        if job.target == target:
+          return job
+      return None
+
+  # Return the targets of the running jobs
+  def active(self):
+    with self._lock:
+      return [job.target for job in self._running.values()]
+
+  # Return the status of the running, queued and recently finished jobs
+  def jobs(self):
+    with self._lock:
+      jobs = list(self._running.values()) + self._queue + list(self._finished)
+      return [job.status() for job in jobs]
+
+  def _start_queued(self, now):
+    for job in list(self._queue):
+      if not any(relay in self._busy for relay in job.relays):
+        self._queue.remove(job)
+        for relay in job.relays:
+          self._busy[relay] = job.id
+        self._running[job.id] = job
+        job.started = now
+        debug(DEBUG_POWER, '--> job %d: started', job.id)
+        if self._on_start:
+          self._on_start(job)
+        self._step(job, now)
+
+  # Move a job on to its next step (or finish it)
+  def _step(self, job, now):
+    while job.active():
+      job.step += 1
+      if job.step >= len(job.steps):
+        self._finish(job, JOB_DONE, now)
+        return
+      state, action, seconds = job.steps[job.step]
+      job.state = state
+      debug(DEBUG_POWER, '--> job %d: %s (%0.1fs)', job.id, state, seconds)
+      try:
+        action()
+      except Exception as e:
+        debug(DEBUG_POWER, '--> job %d: %s failed: %s', job.id, state, e)
+        self._finish(job, JOB_FAILED, now)
+        return
+      if seconds > 0:
+        job.step_ends = now + seconds
+        self._wheel.schedule(job.id, job.step_ends)
+        return
+
+  def _finish(self, job, state, now):
+    self._wheel.cancel(job.id)
+    if job in self._queue:
+      self._queue.remove(job)
+    started = self._running.pop(job.id, None) is not None
+    for relay in job.relays:
+      if self._busy.get(relay) == job.id:
+        del self._busy[relay]
+    if started and JOB_DONE != state and job.abort:
+      job.abort()
+    job.state = state
+    job.step_ends = None
+    job.finished = now
+    self._finished.appendleft(job)
+    debug(DEBUG_POWER, '--> job %d: %s', job.id, state)
+    if started and self._on_done:
+      self._on_done(job)
+
+  # Cancel jobs, move jobs on whose steps have ended, and start queued jobs,
+  # sleeping until the next step ends
+  def _work(self, now):
+    with self._lock:
+      for job in self._cancels:
+        if job.active():
+          self._finish(job, JOB_CANCELLED, now)
+      self._cancels = []
+      for id in self._wheel.advance(now):
+        self._step(self._running[id], now)
+      self._start_queued(now)
+      if self._on_change:
+        self._on_change()
+      return self._wheel.next_expiry()
+
+
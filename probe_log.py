@@ -0,0 +1,320 @@
+#
+# Crash-safe, append-only log of the probe results, power cycles and CPU
+# temperatures of my network monitor box
+#
+# The log is a series of segment files (one or more per UTC day), each made of
+# fixed 32 byte records and memory-mapped, so appending a record is just a
+# copy into the page cache (which survives the process being killed, and is
+# flushed to disk every few seconds). A segment is allocated at its full size
+# when it is created, and when it is closed (at the end of the day, or when it
+# fills up) it is compacted down to the records it holds. Segments older than
+# the retention period are deleted. E.g.:
+#    log = ProbeLog("/data")
+#    log.probe("router", clock.time(), PROBE_UP, 0.002)
+#    for kind, code, when, value, name in log.read(start, end): ...
+#
+# Each record is (little-endian): a magic byte, the kind (probe, power or
+# temperature), a code (the probe status or power cycle state), the time (a
+# double), the value (a float: the round trip time, cycle duration or
+# temperature, NaN for none), the name (up to 15 bytes of UTF-8, NUL padded;
+# longer names are rejected, never cut short) and a 16 bit check of the rest.
+# A torn record at the end of a segment (from a crash in mid-append) fails its
+# check, and is overwritten by the next one.
+#
+# The columnar export format is the 8 byte magic "MBOXCOL1", followed by
+# blocks of: the record count (uint32, with 0 ending the export), the names
+# (a uint16 count, then each as a uint8 length and UTF-8 bytes), and then the
+# columns: times (float64), kinds (uint8), codes (uint8), values (float32),
+# and indexes into the names (uint16). All of it is little-endian.
+#
+
+
+import array
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from hal import clock
+from probes import PROBE_UP, PROBE_DOWN, PROBE_TIMEOUT
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_PROBE_LOG = flag('probe-log')
+
+
+# Record kinds, and their codes
+KIND_PROBE = 1
+KIND_POWER = 2
+KIND_TEMPERATURE = 3
+KIND_NAMES = {KIND_PROBE: 'probe', KIND_POWER: 'power', KIND_TEMPERATURE: 'temperature'}
+KIND_CODES = dict((name, kind) for kind, name in KIND_NAMES.items())
+PROBE_CODES = {PROBE_UP: 1, PROBE_DOWN: 2, PROBE_TIMEOUT: 3}
+POWER_CODES = {'started': 1, 'done': 2, 'cancelled': 3, 'failed': 4}
+CODE_NAMES = {
+  KIND_PROBE: dict((code, name) for name, code in PROBE_CODES.items()),
+  KIND_POWER: dict((code, name) for name, code in POWER_CODES.items()),
+  KIND_TEMPERATURE: {0: ''}
+}
+
+RECORD = struct.Struct('<BBBdf15sH')
+RECORD_MAGIC = 0xB7
+NAME_BYTES = 15
+
+def pack_record(kind, code, when, value, name):
+  encoded = name.encode('UTF-8')
+  if len(encoded) > NAME_BYTES:
+    raise ValueError('probe log: "%s" is longer than %d bytes' % (name, NAME_BYTES))
+  body = struct.pack('<BBBdf15s', RECORD_MAGIC, kind, code, when, float('nan') if value is None else value, encoded)
+  return body + struct.pack('<H', zlib.crc32(body) & 0xFFFF)
+
+# Return the (kind, code, when, value, name) of a record, or None if invalid
+def unpack_record(data):
+  magic, kind, code, when, value, name, check = RECORD.unpack(data)
+  if RECORD_MAGIC != magic or check != zlib.crc32(data[:RECORD.size - 2]) & 0xFFFF:
+    return None
+  return kind, code, when, value, name.rstrip(b'\x00').decode('UTF-8', 'replace')
+
+
+# A single segment file. Only the newest segment is ever appended to.
+SEGMENT_RECORDS = 128 * 1024 # 4MB
+class Segment:
+
+  def __init__(self, path, writable):
+    self.path = path
+    self.writable = writable
+    if writable:
+      self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      if os.fstat(self._fd).st_size < SEGMENT_RECORDS * RECORD.size:
+        os.ftruncate(self._fd, SEGMENT_RECORDS * RECORD.size)
+      self._map = mmap.mmap(self._fd, 0)
+    else:
+      self._fd = os.open(path, os.O_RDONLY)
+      size = os.fstat(self._fd).st_size
+      self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ) if size else b''
+    self.used = self._find_end()
+
+  # The records are valid up to the first empty (or torn) one
+  def _find_end(self):
+    n = 0
+    size = len(self._map) - len(self._map) % RECORD.size
+    while n < size and unpack_record(self._map[n:n + RECORD.size]) is not None:
+      n += RECORD.size
+    return n
+
+  def full(self):
+    return self.used + RECORD.size > len(self._map)
+
+  def append(self, record):
+    self._map[self.used:self.used + RECORD.size] = record
+    self.used += RECORD.size
+
+  def flush(self):
+    if self.writable:
+      self._map.flush()
+
+  # Return every record in this segment, in the order they were appended
+  def records(self):
+    for offset in range(0, self.used, RECORD.size):
+      record = unpack_record(self._map[offset:offset + RECORD.size])
+      if record is not None:
+        yield record
+
+  # Close this segment, optionally compacting it down to its records
+  def close(self, compact=False):
+    self.flush()
+    if isinstance(self._map, mmap.mmap):
+      self._map.close()
+    if compact and self.writable:
+      os.ftruncate(self._fd, self.used)
+    os.close(self._fd)
+
+
+LOG_RETENTION_DAYS = 90
+LOG_FLUSH_SEC = 5
+SEGMENT_PREFIX = 'probes-'
+SEGMENT_SUFFIX = '.log'
+class ProbeLog:
+
+  def __init__(self, directory, retention_days=LOG_RETENTION_DAYS):
+    self.directory = directory
+    self.retention_days = retention_days
+    self._lock = threading.Lock()
+    self._segment = None
+    self._day = None
+    self._flushed = clock.time()
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.expire(clock.time())
+
+  # Segments are named by their UTC day and a sequence number within it
+  def _day_of(self, when):
+    return time.strftime('%Y%m%d', time.gmtime(when))
+
+  def _path(self, day, n):
+    return os.path.join(self.directory, '%s%s-%03d%s' % (SEGMENT_PREFIX, day, n, SEGMENT_SUFFIX))
+
+  # Return the (day, sequence number, path) of every segment, oldest first
+  def segments(self):
+    found = []
+    for file in os.listdir(self.directory):
+      if file.startswith(SEGMENT_PREFIX) and file.endswith(SEGMENT_SUFFIX):
+        try:
+          day, n = file[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)].split('-')
+          found.append((day, int(n), os.path.join(self.directory, file)))
+        except ValueError:
+          continue
+    return sorted(found)
+
+  # Open the newest segment for today (or start a new one) to append to
+  def _open(self, day):
+    if self._segment:
+      self._segment.close(compact=True)
+    n = 0
+    for d, i, path in self.segments():
+      if d == day:
+        n = i
+    self._segment = Segment(self._path(day, n), True)
+    if self._segment.full():
+      self._segment.close()
+      self._segment = Segment(self._path(day, n + 1), True)
+    self._day = day
+    debug(DEBUG_PROBE_LOG, '--> appending to %s (at record %d)', self._segment.path, self._segment.used // RECORD.size)
+
+  def append(self, kind, code, when, value, name):
+    record = pack_record(kind, code, when, value, name)
+    with self._lock:
+      day = self._day_of(when)
+      if self._segment is None or day > self._day:
+        self._open(day)
+        self.expire(when)
+      elif self._segment.full():
+        self._open(day)
+      self._segment.append(record)
+      if when - self._flushed >= LOG_FLUSH_SEC:
+        self._segment.flush()
+        self._flushed = when
+
+  def probe(self, name, when, status, rtt):
+    self.append(KIND_PROBE, PROBE_CODES[status], when, rtt, name)
+
+  def power(self, name, when, state, duration):
+    self.append(KIND_POWER, POWER_CODES[state], when, duration, name)
+
+  def temperature(self, name, when, temp):
+    self.append(KIND_TEMPERATURE, 0, when, temp, name)
+
+  # Delete the segments that are older than the retention period
+  def expire(self, now):
+    oldest = self._day_of(now - self.retention_days * 24 * 3600)
+    for day, n, path in self.segments():
+      if day < oldest:
+        debug(DEBUG_PROBE_LOG, '--> deleting %s', path)
+        os.remove(path)
+
+  # Return the records in [start, end) (optionally, of just one kind or name),
+  # oldest first, as (kind, code, when, value, name) tuples. Only the segments
+  # of the days in the range are read, and then only as they are needed.
+  def read(self, start, end, kind=None, name=None):
+    first = self._day_of(start)
+    last = self._day_of(end)
+    with self._lock:
+      if self._segment:
+        self._segment.flush()
+    for day, n, path in self.segments():
+      if day < first or day > last:
+        continue
+      segment = Segment(path, False)
+      try:
+        for record in segment.records():
+          if start <= record[2] < end and (kind is None or kind == record[0]) and (name is None or name == record[4]):
+            yield record
+      finally:
+        segment.close()
+
+  # Rebuild the probe history (or anything else with the same record method)
+  # from the probe records since the given time, returning how many there were
+  def replay(self, history, since):
+    count = 0
+    for kind, code, when, value, name in self.read(since, clock.time() + 1, KIND_PROBE):
+      history.record(name, when, CODE_NAMES[KIND_PROBE][code], None if value != value else value)
+      count += 1
+    debug(DEBUG_PROBE_LOG, '--> replayed %d probe records', count)
+    return count
+
+  def close(self):
+    with self._lock:
+      if self._segment:
+        self._segment.close()
+        self._segment = None
+
+
+# Return a record as a dict (e.g., for JSON)
+def record_dict(record):
+  kind, code, when, value, name = record
+  j = dict()
+  j['kind'] = KIND_NAMES.get(kind, kind)
+  j['name'] = name
+  j['time'] = when
+  j['code'] = CODE_NAMES.get(kind, {}).get(code, code)
+  j['value'] = None if value != value else value
+  return j
+
+# Export the records as CSV, a chunk of lines at a time
+EXPORT_CHUNK_RECORDS = 4096
+def export_csv(records):
+  yield 'time,kind,name,code,value\n'
+  lines = []
+  for kind, code, when, value, name in records:
+    value = '' if value != value else repr(value)
+    lines.append('%.3f,%s,"%s",%s,%s\n' % (when, KIND_NAMES.get(kind, kind), name.replace('"', '""'), CODE_NAMES.get(kind, {}).get(code, code), value))
+    if len(lines) >= EXPORT_CHUNK_RECORDS:
+      yield ''.join(lines)
+      lines = []
+  if lines:
+    yield ''.join(lines)
+
+# Export the records in the columnar format (described above), a block at a
+# time
+COLUMNAR_MAGIC = b'MBOXCOL1'
+def export_columnar(records):
+  yield COLUMNAR_MAGIC
+  block = []
+  for record in records:
+    block.append(record)
+    if len(block) >= EXPORT_CHUNK_RECORDS:
+      yield columnar_block(block)
+      block = []
+  if block:
+    yield columnar_block(block)
+  yield struct.pack('<I', 0)
+
+def columnar_block(records):
+  names = {}
+  times = array.array('d')
+  kinds = array.array('B')
+  codes = array.array('B')
+  values = array.array('f')
+  indexes = array.array('H')
+  for kind, code, when, value, name in records:
+    times.append(when)
+    kinds.append(kind)
+    codes.append(code)
+    values.append(value)
+    indexes.append(names.setdefault(name, len(names)))
+  if 'big' == sys.byteorder:
+    for column in (times, values, indexes):
+      column.byteswap()
+  parts = [struct.pack('<IH', len(records), len(names))]
+  for name in sorted(names.keys(), key=lambda n: names[n]):
+    encoded = name.encode('UTF-8')
+    parts.append(struct.pack('<B', len(encoded)) + encoded)
+  for column in (times, kinds, codes, values, indexes):
+    parts.append(column.tobytes())
+  return b''.join(parts)
+
+
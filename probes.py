@@ -0,0 +1,417 @@
+#
+# Network reachability probes for my network monitor box.
+#
+# Every kind of probe (ICMP echo and TCP connect here, HTTP in chk_wifi.py and
+# DNS queries in resolver.py) is a plugin run by a single ProbeEngine, on one
+# loop, with one adaptive schedule and one result callback. Plugins never
+# block: each starts its probe, and the engine calls it back when its socket
+# is ready (or times it out), so adding a kind of probe never means adding a
+# thread (or a loop). The ICMP probes all share a single socket, keeping many
+# requests in flight at once and matching the replies by id and sequence
+# number. Each target is probed on its own adaptive schedule (quickly after a
+# failure, backing off while it stays up). E.g.:
+#    def got(name, kind, status, rtt): ...
+#    e = ProbeEngine(got)
+#    e.add(ICMPProbe("router", "192.168.123.1"))
+#    e.add(TCPProbe("nas", "192.168.123.10:445"))
+#    e.start()
+#
+
+
+import errno
+import os
+import socket
+import struct
+import time
+
+from hal import clock
+from runtime import Worker
+from scheduler import AdaptiveSchedule
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_PROBES = flag('probes')
+
+
+# Probe result status values (passed to the result callbacks)
+PROBE_UP = 'up'
+PROBE_DOWN = 'down'
+PROBE_TIMEOUT = 'timeout'
+
+
+# Split an address of the form "host[:port]"
+def split_address(address, port):
+  if ':' in address:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+  return address, port
+
+
+# The plugin interface. A probe is started by begin(), and must end by calling
+# done() (from begin itself, or from a callback of a socket it is watching),
+# unless it times out first, in which case cancel() is called instead. The
+# host is the name (or address) that the engine's resolver keeps resolved. A
+# plugin times its own round trip on the performance counter, with sending()
+# right before its request goes out and elapsed() right as the answer is in
+# (so each probe gets its own time, in real seconds, whatever the loop does).
+PROBE_TIMEOUT_SEC = 10
+class Probe:
+
+  kind = None
+  timeout = PROBE_TIMEOUT_SEC
+
+  def __init__(self, name, address, timeout=None):
+    self.name = name
+    self.address = address
+    self.host = address
+    if timeout is not None:
+      self.timeout = timeout
+    self.engine = None
+    self.started = None
+    self.sent = None
+
+  # Start a probe, returning False if it cannot be sent yet (e.g., while its
+  # host name is being resolved), in which case there is no result
+  def begin(self, now):
+    raise NotImplementedError()
+
+  # Clean up after a probe that has timed out (e.g., close its socket)
+  def cancel(self):
+    pass
+
+  def done(self, status, rtt=None):
+    self.engine.complete(self, status, rtt)
+
+  def sending(self):
+    self.sent = time.perf_counter()
+
+  def elapsed(self):
+    return time.perf_counter() - self.sent
+
+
+# A probe of one connection-oriented exchange over its own socket, e.g.,
+# connecting, then (optionally) sending a request and reading the answer
+class SocketProbe(Probe):
+
+  sock = None
+
+  def _open(self, family, kind):
+    self.sock = socket.socket(family, kind)
+    self.sock.setblocking(False)
+    return self.sock
+
+  def _close(self):
+    if self.sock is not None:
+      self.engine.unwatch(self.sock)
+      self.sock.close()
+      self.sock = None
+
+  def cancel(self):
+    self._close()
+
+  def finish(self, status, rtt=None):
+    self._close()
+    self.done(status, rtt)
+
+
+# TCP connect probes: up once the connection is established (with the time
+# that took), and down if it is refused (or fails in any other way)
+TCP_TIMEOUT_SEC = 5
+class TCPProbe(SocketProbe):
+
+  kind = 'tcp'
+  timeout = TCP_TIMEOUT_SEC
+
+  def __init__(self, name, address, port=80, timeout=None):
+    SocketProbe.__init__(self, name, address, timeout)
+    self.host, self.port = split_address(address, port)
+
+  def begin(self, now):
+    ip = self.engine.resolve(self.host)
+    if ip is None:
+      return False
+    sock = self._open(socket.AF_INET, socket.SOCK_STREAM)
+    self.sending()
+    err = sock.connect_ex((ip, self.port))
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      self.finish(PROBE_DOWN)
+    else:
+      self.engine.watch(sock, True, self._connected)
+    return True
+
+  def _connected(self, now):
+    rtt = self.elapsed()
+    err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+      debug(DEBUG_PROBES, '<-- tcp %s (%s) [DN] %s', self.name, self.address, os.strerror(err))
+      self.finish(PROBE_DOWN)
+    else:
+      self.finish(PROBE_UP, rtt)
+
+
+# ICMP protocol constants
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_PAYLOAD = b'mybox-probe' + bytes(45)
+
+# Standard internet checksum (RFC 1071) of a byte string
+def icmp_checksum(data):
+  if len(data) % 2:
+    data += b'\x00'
+  total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+  total = (total >> 16) + (total & 0xFFFF)
+  total += (total >> 16)
+  return (~total) & 0xFFFF
+
+# Build an ICMP echo request packet for the given id and sequence number
+def icmp_echo_request(ident, seq):
+  header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+  checksum = icmp_checksum(header + ICMP_PAYLOAD)
+  return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + ICMP_PAYLOAD
+
+# Open an ICMP socket. Unprivileged "ping" datagram sockets are preferred (the
+# kernel then filters replies for us), and raw sockets are the fallback.
+def icmp_socket():
+  try:
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+  except OSError:
+    return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+
+
+# The socket shared by all of an engine's ICMP probes
+class ICMPChannel:
+
+  def __init__(self, engine):
+    self._engine = engine
+    self._icmp_id = os.getpid() & 0xFFFF
+    self._seq = 0
+    self._pending = {}
+    self._sock, self._raw = icmp_socket()
+    self._sock.setblocking(False)
+    engine.watch(self._sock, False, self._receive)
+
+  # Send an echo request for a probe, returning its sequence number. The round
+  # trip time of each packet is measured on the performance counter, from
+  # right before it is sent to right after its reply is read (so probes sent or
+  # answered in the same pass of the loop still get their own times).
+  def send(self, probe, ip):
+    self._seq = seq = (self._seq + 1) & 0xFFFF
+    self._pending[seq] = (probe, ip, time.perf_counter())
+    try:
+      self._sock.sendto(icmp_echo_request(self._icmp_id, seq), (ip, 0))
+    except OSError:
+      # The network is unreachable
+      del self._pending[seq]
+      raise
+    return seq
+
+  def forget(self, seq):
+    self._pending.pop(seq, None)
+
+  def _receive(self, now):
+    while True:
+      try:
+        packet, source = self._sock.recvfrom(2048)
+      except (BlockingIOError, InterruptedError):
+        return
+      received = time.perf_counter()
+      # Raw sockets deliver the IP header too, so skip over it
+      if self._raw:
+        packet = packet[(packet[0] & 0x0F) * 4:]
+      if len(packet) < 8:
+        continue
+      kind, code, checksum, ident, seq = struct.unpack('!BBHHH', packet[:8])
+      if ICMP_ECHO_REPLY != kind:
+        continue
+      # Datagram sockets get their id assigned by the kernel (which filters
+      # the replies for us), so the id can only be checked on raw sockets
+      if self._raw and ident != self._icmp_id:
+        continue
+      pending = self._pending.get(seq)
+      if pending is None or pending[1] != source[0]:
+        continue
+      del self._pending[seq]
+      pending[0].done(PROBE_UP, received - pending[2])
+
+  def close(self):
+    self._engine.unwatch(self._sock)
+    self._sock.close()
+
+
+# ICMP echo ("ping") probes
+PING_BASE_SEC = 2.5
+MAX_SLEEP_BETWEEN_PINGS_SEC = 10
+PING_TIMEOUT_SEC = 10
+class ICMPProbe(Probe):
+
+  kind = 'icmp'
+  timeout = PING_TIMEOUT_SEC
+
+  def __init__(self, name, address, timeout=None):
+    Probe.__init__(self, name, address, timeout)
+    self._seq = None
+
+  def begin(self, now):
+    ip = self.engine.resolve(self.host)
+    if ip is None:
+      debug(DEBUG_PROBES, '--> ping %s (%s) not resolved yet', self.name, self.address)
+      return False
+    try:
+      self._seq = self.engine.channel(ICMPChannel).send(self, ip)
+      debug(DEBUG_PROBES, '--> ping %s (%s) seq=%d', self.name, self.address, self._seq)
+    except OSError:
+      self.done(PROBE_DOWN)
+    return True
+
+  def cancel(self):
+    if self._seq is not None:
+      self.engine.channel(ICMPChannel).forget(self._seq)
+      self._seq = None
+
+
+# Class to run any number of probes (of any kinds) from a single loop
+class ProbeEngine(Worker):
+
+  # The on_result function (if any) is called with (name, kind, status, rtt)
+  # for every completed probe, where the status is one of the PROBE_* values
+  # and rtt is in seconds (None unless up). The schedule (if any) is an
+  # AdaptiveSchedule keyed by the probe names. Host names are looked up in
+  # the resolver (e.g., a DNSCache) if given, or else by the system (which
+  # blocks the loop while it does).
+  def __init__(self, on_result=None, schedule=None, resolver=None):
+    Worker.__init__(self, 'probes')
+    self._on_result = on_result
+    self._schedule = schedule
+    if self._schedule is None:
+      self._schedule = AdaptiveSchedule(PING_BASE_SEC, MAX_SLEEP_BETWEEN_PINGS_SEC)
+    self._resolver = resolver
+    self._probes = {}
+    self._next = {}
+    self._deadlines = {}
+    self._lasts = {}
+    self._rtts = {}
+    self._statuses = {}
+    self._channels = {}
+
+  # Add a probe (before the engine is started)
+  def add(self, probe):
+    probe.engine = self
+    self._probes[probe.name] = probe
+    self._next[probe.name] = 0
+    self._lasts[probe.name] = 0
+    self._rtts[probe.name] = None
+    self._statuses[probe.name] = None
+    if self._resolver:
+      self._resolver.add(probe.host)
+    debug(DEBUG_PROBES, '--> %s "%s": "%s"', probe.kind, probe.name, probe.address)
+
+  # Return the probes, as {name: probe}
+  def probes(self):
+    return dict(self._probes)
+
+  # Return the time of the last successful probe (or 0)
+  def last_good(self, name):
+    return self._lasts[name]
+
+  # Return the round trip time of the last successful probe
+  def rtt(self, name):
+    return self._rtts[name]
+
+  # Return a dict describing the state of each probe
+  def status(self, now=None):
+    if now is None:
+      now = clock.time()
+    j = dict()
+    for name, probe in self._probes.items():
+      j[name] = dict()
+      j[name]['kind'] = probe.kind
+      j[name]['addr'] = probe.address
+      j[name]['status'] = self._statuses[name]
+      j[name]['last'] = now - self._lasts[name]
+      j[name]['rtt'] = self._rtts[name]
+    return j
+
+  # The plugins' interface to the engine: look up a host name (returning an
+  # address, or None if it is not resolved yet), get the channel shared by a
+  # kind of probe (made on first use), and watch a socket (for reading, or
+  # writing) with a callback that is called with the time it became ready
+  def resolve(self, host):
+    if self._resolver:
+      return self._resolver.lookup(host)
+    try:
+      return socket.gethostbyname(host)
+    except OSError:
+      return None
+
+  def channel(self, kind):
+    channel = self._channels.get(kind)
+    if channel is None:
+      channel = self._channels[kind] = kind(self)
+    return channel
+
+  def watch(self, sock, write, callback):
+    self.loop.watch(sock, write, callback)
+
+  def unwatch(self, sock):
+    self.loop.unwatch(sock)
+
+  # Called by the plugins (through Probe.done) with every result. Late results
+  # (of probes that have already timed out) are ignored.
+  def complete(self, probe, status, rtt):
+    if self._deadlines.pop(probe.name, None) is None:
+      return
+    self._record(probe, status, rtt)
+    self.wake()
+
+  # Every result reschedules its probe (sooner, if its interval has shrunk)
+  def _record(self, probe, status, rtt):
+    name = probe.name
+    self._schedule.result(name, PROBE_UP == status)
+    self._next[name] = min(self._next[name], self._schedule.next(name, clock.time()))
+    self._statuses[name] = status
+    if PROBE_UP == status:
+      self._lasts[name] = clock.time()
+      self._rtts[name] = rtt
+      debug(DEBUG_PROBES, '<-- %s %s (%s) [UP] %0.1fms', probe.kind, name, probe.address, rtt * 1000.0)
+    else:
+      debug(DEBUG_PROBES, '<-- %s %s (%s) [%s]', probe.kind, name, probe.address, status)
+    if self._on_result:
+      self._on_result(name, probe.kind, status, rtt)
+
+  def _expire(self, now):
+    for name in [n for n, deadline in self._deadlines.items() if deadline <= now]:
+      del self._deadlines[name]
+      probe = self._probes[name]
+      probe.cancel()
+      self._record(probe, PROBE_TIMEOUT, None)
+
+  def _begin(self, now):
+    for name, probe in self._probes.items():
+      if name not in self._deadlines and self._next[name] <= now:
+        self._next[name] = self._schedule.next(name, now)
+        probe.started = now
+        self._deadlines[name] = now + probe.timeout
+        try:
+          if not probe.begin(now):
+            del self._deadlines[name]
+        except Exception as e:
+          debug(DEBUG_PROBES, '--> %s %s failed: %s', probe.kind, name, e)
+          probe.cancel()
+          self.complete(probe, PROBE_DOWN, None)
+
+  # Time out the probes that have had no answer, and start the ones that are
+  # due, sleeping until the next is due (or may time out). The answers arrive
+  # through the sockets the plugins watch on the loop.
+  def _work(self, now):
+    self._expire(now)
+    self._begin(now)
+    wake = [self._next[name] for name in self._probes.keys() if name not in self._deadlines]
+    return min(wake + list(self._deadlines.values()), default=None)
+
+  def _stopped(self):
+    for probe in self._probes.values():
+      probe.cancel()
+    for channel in self._channels.values():
+      channel.close()
+
@@ -0,0 +1,383 @@
+#
+# Caching DNS resolver for the probe targets of my network monitor box
+#
+# Host names are resolved on the resolver's own loop (so a slow or broken DNS
+# never holds up a probe), with a small non-blocking UDP DNS client that sees
+# the TTLs of the answers. Each name is refreshed in the background before its
+# TTL runs out, and lookups are always answered from the cache. When a refresh
+# fails, the last good addresses keep being used (so the targets can still be
+# probed while DNS is down), and a name that has never resolved is negatively
+# cached (for the SOA minimum TTL, or DNS_RETRY_SEC) before it is retried.
+# Every lookup is reported (with how long it took), as a health signal of its
+# own. Names in /etc/hosts are answered from there, and without a name server
+# the system resolver is used (on a short-lived thread, as it blocks).
+# DNSProbe is the probe plugin (for the ProbeEngine, in probes.py) that times
+# a query of its own, to watch a name server like any other target. E.g.:
+#    def got(host, status, seconds): ...
+#    r = DNSCache(got)
+#    r.add("darlingevil.com")
+#    ip = r.lookup("darlingevil.com") # None until it has been resolved
+#    e.add(DNSProbe("dns", "darlingevil.com", "192.168.123.1"))
+#
+
+
+import random
+import socket
+import struct
+import threading
+
+from hal import clock
+from runtime import Worker
+from probes import SocketProbe, PROBE_UP, PROBE_DOWN, PROBE_TIMEOUT, split_address
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_RESOLVER = flag('resolver')
+
+
+# DNS protocol constants
+DNS_PORT = 53
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_TYPE_SOA = 6
+DNS_CLASS_IN = 1
+DNS_RCODE_OK = 0
+DNS_RCODE_NXDOMAIN = 3
+
+# Raised for a DNS answer that says the name does not exist (or has no
+# addresses), with the TTL it may be negatively cached for (if given)
+class NoSuchName(Exception):
+
+  def __init__(self, host, ttl=None):
+    Exception.__init__(self, 'no addresses for "%s"' % (host))
+    self.ttl = ttl
+
+# Raised for any other failure (e.g., SERVFAIL, or a malformed answer)
+class LookupFailed(Exception):
+  pass
+
+# Build a query for the A records of a name, with the given id
+def dns_query_packet(ident, host):
+  header = struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0)
+  qname = b''.join(struct.pack('!B', len(label)) + label for label in host.encode('ascii').split(b'.') if label)
+  return header + qname + b'\x00' + struct.pack('!HH', DNS_TYPE_A, DNS_CLASS_IN)
+
+# Return the offset just past the (possibly compressed) name at offset
+def skip_name(data, offset):
+  while True:
+    length = data[offset]
+    if 0 == length:
+      return offset + 1
+    if 0xC0 == length & 0xC0:
+      return offset + 2
+    offset += 1 + length
+
+# Parse an answer to dns_query_packet, returning (addresses, ttl)
+def parse_dns_answer(data, ident, host):
+  try:
+    rid, flags, qdcount, ancount, nscount, arcount = struct.unpack('!HHHHHH', data[:12])
+    if rid != ident or not flags & 0x8000:
+      raise LookupFailed('unexpected answer for "%s"' % (host))
+    rcode = flags & 0x000F
+    offset = 12
+    for i in range(qdcount):
+      offset = skip_name(data, offset) + 4
+    addresses = []
+    ttl = None
+    for i in range(ancount + nscount):
+      offset = skip_name(data, offset)
+      rtype, rclass, rttl, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+      offset += 10
+      rdata = data[offset:offset + rdlength]
+      offset += rdlength
+      if i < ancount and rtype in (DNS_TYPE_A, DNS_TYPE_CNAME):
+        ttl = rttl if ttl is None else min(ttl, rttl)
+        if DNS_TYPE_A == rtype and 4 == rdlength:
+          addresses.append(socket.inet_ntoa(rdata))
+      elif i >= ancount and DNS_TYPE_SOA == rtype and len(rdata) >= 4:
+        # Negative answers may be cached for the lesser of the SOA record's
+        # TTL and its minimum field (RFC 2308)
+        ttl = min(rttl, struct.unpack('!I', rdata[-4:])[0])
+  except (struct.error, IndexError):
+    raise LookupFailed('malformed answer for "%s"' % (host))
+  if DNS_RCODE_NXDOMAIN == rcode or (DNS_RCODE_OK == rcode and not addresses):
+    raise NoSuchName(host, ttl)
+  if DNS_RCODE_OK != rcode:
+    raise LookupFailed('rcode %d for "%s"' % (rcode, host))
+  return addresses, ttl
+
+# Return True for an answer that is (or claims to be) to the query with the
+# given id, so stray (or spoofed) answers with the wrong id can be ignored
+def answers(data, ident):
+  return len(data) >= 2 and struct.unpack('!H', data[:2])[0] == ident
+
+# Return the first name server in resolv.conf (or None)
+def system_name_server(path='/etc/resolv.conf'):
+  try:
+    with open(path, 'r') as file:
+      for line in file:
+        fields = line.split()
+        if len(fields) >= 2 and 'nameserver' == fields[0] and ':' not in fields[1]:
+          return fields[1]
+  except OSError:
+    pass
+  return None
+
+# Return the IPv4 entries in the hosts file, as {name: address}
+def hosts_file(path='/etc/hosts'):
+  hosts = dict()
+  try:
+    with open(path, 'r') as file:
+      for line in file:
+        fields = line.split('#')[0].split()
+        if len(fields) >= 2 and is_address(fields[0]):
+          for name in fields[1:]:
+            hosts.setdefault(name.lower(), fields[0])
+  except OSError:
+    pass
+  return hosts
+
+def is_address(host):
+  try:
+    socket.inet_aton(host)
+    return 4 == len(host.split('.'))
+  except OSError:
+    return False
+
+
+# One cached name
+class Entry:
+
+  def __init__(self, host):
+    self.host = host
+    self.addresses = []
+    self.ttl = None
+    self.resolved = None
+    self.refresh = 0
+    self.status = None
+    self.seconds = None
+    self.failures = 0
+    # The query in flight (if any)
+    self.started = None
+    self.deadline = None
+    self.sock = None
+    self.ident = None
+
+
+# Class to resolve (and keep resolved) any number of names, from one loop.
+# The TTLs of the answers are clamped to [MIN_TTL_SEC, MAX_TTL_SEC], and each
+# name is refreshed once REFRESH_FRACTION of its TTL has passed.
+DNS_TIMEOUT_SEC = 2.0
+DNS_RETRY_SEC = 5.0
+MIN_TTL_SEC = 5.0
+MAX_TTL_SEC = 3600.0
+DEFAULT_TTL_SEC = 300.0
+REFRESH_FRACTION = 0.8
+class DNSCache(Worker):
+
+  # The on_result function (if any) is called with (host, status, seconds)
+  # for every lookup, where the status is one of the PROBE_* values
+  def __init__(self, on_result=None, server=None, timeout=DNS_TIMEOUT_SEC):
+    Worker.__init__(self, 'resolver')
+    self._on_result = on_result
+    self._server = server or system_name_server()
+    self._hosts = hosts_file()
+    self._timeout = timeout
+    self._entries = {}
+    self._lock = threading.Lock()
+    debug(DEBUG_RESOLVER, 'DNS resolver started (server %s).', self._server)
+    self.start()
+
+  # Start keeping a name resolved (and resolve it right away)
+  def add(self, host):
+    if is_address(host):
+      return
+    with self._lock:
+      if host in self._entries:
+        return
+      self._entries[host] = Entry(host)
+    self.wake()
+
+  # Return an address for a name from the cache (or None if it has not been
+  # resolved yet, or never successfully). Never waits for the network.
+  def lookup(self, host):
+    if is_address(host):
+      return host
+    entry = self._entries.get(host)
+    if entry is None:
+      self.add(host)
+      return None
+    addresses = entry.addresses
+    return addresses[0] if addresses else None
+
+  # Return a dict describing the state of each cached name
+  def status(self, now=None):
+    if now is None:
+      now = clock.time()
+    j = dict()
+    with self._lock:
+      for host, entry in self._entries.items():
+        j[host] = dict()
+        j[host]['addresses'] = list(entry.addresses)
+        j[host]['ttl'] = entry.ttl
+        j[host]['age'] = None if entry.resolved is None else now - entry.resolved
+        j[host]['status'] = entry.status
+        j[host]['seconds'] = entry.seconds
+        j[host]['failures'] = entry.failures
+    return j
+
+  # Start looking a name up (the result arrives through _resolved)
+  def _resolve(self, entry, now):
+    entry.started = now
+    address = self._hosts.get(entry.host.lower())
+    if address is not None:
+      self._resolved(entry, PROBE_UP, [address], MAX_TTL_SEC)
+    elif self._server is None:
+      threading.Thread(target=self._system_lookup, args=(entry,), daemon=True).start()
+    else:
+      entry.ident = random.randint(0, 0xFFFF)
+      entry.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      entry.sock.setblocking(False)
+      try:
+        entry.sock.connect((self._server, DNS_PORT))
+        entry.sock.send(dns_query_packet(entry.ident, entry.host))
+      except (OSError, UnicodeError) as e:
+        debug(DEBUG_RESOLVER, '--> "%s": %s', entry.host, e)
+        self._resolved(entry, PROBE_DOWN, None, DNS_RETRY_SEC)
+        return
+      entry.deadline = now + self._timeout
+      self.loop.watch(entry.sock, False, lambda now: self._answered(entry))
+
+  def _system_lookup(self, entry):
+    try:
+      result = (PROBE_UP, [socket.gethostbyname(entry.host)], DEFAULT_TTL_SEC)
+    except (OSError, UnicodeError):
+      result = (PROBE_DOWN, None, DNS_RETRY_SEC)
+    self.loop.call_soon(self._resolved, (entry,) + result)
+
+  def _answered(self, entry):
+    try:
+      data = entry.sock.recv(4096)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError as e:
+      # E.g., the name server's port is unreachable
+      debug(DEBUG_RESOLVER, '--> "%s": %s', entry.host, e)
+      self._resolved(entry, PROBE_DOWN, None, DNS_RETRY_SEC)
+      return
+    try:
+      addresses, ttl = parse_dns_answer(data, entry.ident, entry.host)
+      self._resolved(entry, PROBE_UP, addresses, DEFAULT_TTL_SEC if ttl is None else ttl)
+    except NoSuchName as e:
+      self._resolved(entry, PROBE_DOWN, None, DNS_RETRY_SEC if e.ttl is None else e.ttl)
+    except LookupFailed as e:
+      if answers(data, entry.ident):
+        debug(DEBUG_RESOLVER, '--> "%s": %s', entry.host, e)
+        self._resolved(entry, PROBE_DOWN, None, DNS_RETRY_SEC)
+
+  def _close(self, entry):
+    if entry.sock is not None:
+      self.loop.unwatch(entry.sock)
+      entry.sock.close()
+      entry.sock = None
+    entry.deadline = None
+
+  # Note the result of a lookup (on the loop)
+  def _resolved(self, entry, status, addresses, ttl):
+    self._close(entry)
+    now = clock.time()
+    ttl = max(MIN_TTL_SEC, min(MAX_TTL_SEC, ttl))
+    with self._lock:
+      entry.status = status
+      entry.seconds = now - entry.started
+      entry.started = None
+      if PROBE_UP == status:
+        entry.addresses = addresses
+        entry.ttl = ttl
+        entry.resolved = now
+        entry.failures = 0
+        entry.refresh = now + ttl * REFRESH_FRACTION
+        debug(DEBUG_RESOLVER, '<-- "%s": %s (ttl=%ds)', entry.host, addresses, ttl)
+      else:
+        # Keep any stale addresses, and retry after the negative TTL
+        entry.failures += 1
+        entry.refresh = now + ttl
+        debug(DEBUG_RESOLVER, '<-- "%s": %s (retry in %ds)', entry.host, status, ttl)
+    if self._on_result:
+      self._on_result(entry.host, status, entry.seconds)
+    self.wake()
+
+  # Time out the lookups that have had no answer, and start the ones that are
+  # due, sleeping until the next is due (or may time out)
+  def _work(self, now):
+    with self._lock:
+      entries = list(self._entries.values())
+    for entry in entries:
+      if entry.deadline is not None and entry.deadline <= now:
+        self._resolved(entry, PROBE_TIMEOUT, None, DNS_RETRY_SEC)
+      elif entry.started is None and entry.refresh <= now:
+        self._resolve(entry, now)
+    wake = [e.deadline for e in entries if e.deadline is not None]
+    wake += [e.refresh for e in entries if e.started is None]
+    return min(wake, default=None)
+
+  def _stopped(self):
+    for entry in list(self._entries.values()):
+      self._close(entry)
+
+
+# DNS query probes: up when the name server answers with addresses for the
+# name (with the time that took), and down if it has none (or fails). The
+# server is "address[:port]", and the system's name server by default.
+class DNSProbe(SocketProbe):
+
+  kind = 'dns'
+  timeout = DNS_TIMEOUT_SEC
+
+  def __init__(self, name, query, server=None, timeout=None):
+    server = server or system_name_server() or ''
+    SocketProbe.__init__(self, name, server, timeout)
+    self.host, self.port = split_address(server, DNS_PORT)
+    self.query = query
+    self._ident = None
+
+  def begin(self, now):
+    if not self.host:
+      self.done(PROBE_DOWN)
+      return True
+    ip = self.engine.resolve(self.host)
+    if ip is None:
+      return False
+    self._ident = random.randint(0, 0xFFFF)
+    sock = self._open(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      sock.connect((ip, self.port))
+      packet = dns_query_packet(self._ident, self.query)
+      self.sending()
+      sock.send(packet)
+    except (OSError, UnicodeError):
+      self.finish(PROBE_DOWN)
+      return True
+    self.engine.watch(sock, False, self._answered)
+    return True
+
+  def _answered(self, now):
+    rtt = self.elapsed()
+    try:
+      data = self.sock.recv(4096)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      # E.g., the port is unreachable
+      self.finish(PROBE_DOWN)
+      return
+    try:
+      addresses, ttl = parse_dns_answer(data, self._ident, self.query)
+      debug(DEBUG_RESOLVER, '<-- dns %s "%s": %s', self.name, self.query, addresses)
+      self.finish(PROBE_UP, rtt)
+    except NoSuchName:
+      self.finish(PROBE_DOWN)
+    except LookupFailed:
+      if answers(data, self._ident):
+        self.finish(PROBE_DOWN)
@@ -6,125 +6,244 @@
 #    GPIO.setup(<<pin>>, GPIO.OUT)
 #    x = RGB_LED("foo", 20, 21, 18)
 #
+# By default, flashing LEDs blink in step with RGB_LED.toggle_flash_state(),
+# which the main program must call regularly. Alternatively, set pwm_blink
+# (before creating any RGB_LEDs) to have GPIO (software) PWM channels generate
+# the blink waveforms, each according to its pattern. E.g.:
+#    RGB_LED.pwm_blink = True
+#    x.red()
+#    x.flash("fast")
+#
 # Written by Glen Darling, February 2020.
 #
 
 
 import threading
-import time
+
+from runtime import Worker
 
 
 # Import the GPIO library so python can work with the GPIO pins
-import RPi.GPIO as GPIO
+from hal import GPIO
+from tracing import flag, debug
 
 
 # Debug flags
-DEBUG_RGB_LEDS = False
-
-# Debug print
-def debug(flag, str):
-  if flag:
-    print(str)
-
+DEBUG_RGB_LEDS = flag('rgb-leds')
+
+
+# Blink patterns, as (frequency in Hz, duty cycle in percent). These are only
+# followed in PWM blink mode (where "True" means the "normal" pattern).
+BLINK_PATTERNS = {
+  'slow': (1.0, 50),
+  'normal': (1.5, 50),
+  'fast': (4.0, 50)
+}
+DEFAULT_BLINK = 'normal'
+
+
+# A single worker drives the GPIO pins of every RGB_LED. It sleeps until some
+# LED changes color or flash state (or the flash state toggles), and then only
+# writes the pins whose level has actually changed. In PWM blink mode a pin
+# gets a PWM channel the first time it blinks, whose duty cycle and frequency
+# are only changed when the pin's waveform changes. RPi.GPIO's PWM is software
+# PWM (a thread in its C code toggling the pin), so pins that never blink are
+# written directly. A channel is kept for the pin's lifetime, with steady
+# levels set as a duty cycle of 0 or 100: stopping a channel only takes effect
+# after its current half period (when it drives the pin low, and only then
+# frees the pin for a new channel), which would race with the next write.
+class RGB_LED_Driver(Worker):
+
+  def __init__(self, pwm=False):
+    Worker.__init__(self, 'rgb-leds')
+    self._pwm = pwm
+    self._pwms = {}
+    self._leds = []
+    self._levels = {}
+    self._lock = threading.Lock()
+    debug(DEBUG_RGB_LEDS, "RGB_LED driver started (%s).", 'PWM' if self._pwm else 'toggled')
+    self.start()
 
-SLEEP_BETWEEN_UPDATES_SEC = 0.1
-class RGB_LED(threading.Thread):
+  def add(self, led):
+    with self._lock:
+      self._leds.append(led)
+    self.refresh()
+
+  # Return whether any of the LEDs is flashing
+  def flashing(self):
+    with self._lock:
+      return any(led._lit[3] for led in self._leds)
+
+  def remove(self, led):
+    with self._lock:
+      if led in self._leds:
+        self._leds.remove(led)
+      if 0 == len(self._leds):
+        self.stop()
+    self.refresh()
+
+  # Request an update of the pins (cheap, and safe to call from any thread)
+  def refresh(self):
+    self.wake()
+
+  # Set the (frequency, duty cycle) waveform of a pin (steady ones have no
+  # frequency, and keep the channel's last one, if it has a channel)
+  def _wave(self, pin, wave):
+    frequency, duty = wave
+    pwm = self._pwms.get(pin)
+    if pwm is None and not frequency:
+      GPIO.output(pin, GPIO.HIGH if duty >= 100 else GPIO.LOW)
+    elif pwm is None:
+      pwm = self._pwms[pin] = GPIO.PWM(pin, frequency)
+      pwm.start(duty)
+    else:
+      if frequency:
+        pwm.ChangeFrequency(frequency)
+      pwm.ChangeDutyCycle(duty)
+    debug(DEBUG_RGB_LEDS, "--> pin %d: %s Hz, %d%%", pin, frequency, duty)
+
+  def _work(self, now):
+    with self._lock:
+      leds = list(self._leds)
+    for led in leds:
+      if self._pwm:
+        for pin, wave in led.waveforms():
+          if self._levels.get(pin) != wave:
+            self._wave(pin, wave)
+            self._levels[pin] = wave
+      else:
+        for pin, level in led.levels():
+          if self._levels.get(pin) != level:
+            GPIO.output(pin, level)
+            self._levels[pin] = level
+
+  def _stopped(self):
+    for pwm in self._pwms.values():
+      pwm.stop()
+
+
+class RGB_LED:
 
   flash_state = False
+  driver = None
+  pwm_blink = False
+  patterns = dict(BLINK_PATTERNS)
+
+  # If set, on_change(led) is called whenever an RGB_LED's state changes
+  on_change = None
 
   # The main program must call this regularly to change the flash state
   @classmethod
   def toggle_flash_state(cls):
     cls.flash_state = not cls.flash_state
+    if cls.driver:
+      cls.driver.refresh()
+
+  # Return whether any RGB_LED is flashing (i.e., whether toggling the flash
+  # state would change anything)
+  @classmethod
+  def any_flashing(cls):
+    return cls.driver is not None and cls.driver.flashing()
 
   # Constructor for an RGB_LED
   # Pass None to the constuctor as a color pin number to not use that color.
   # E.g., to not use blue:  x = RGB_LED("foo", 20, 21, None)
   def __init__(self, name, gpio_red, gpio_green, gpio_blue):
-    threading.Thread.__init__(self)
     self.name = name
     self.gpio_red = gpio_red
     self.gpio_green = gpio_green
     self.gpio_blue = gpio_blue
-    self._red = False
-    self._green = False
-    self._blue = False
-    self._flash = False
-    self._keep_swimming = True
-    self.start()
+    # The (red, green, blue, flash) state, replaced as a whole (so that it is
+    # never seen half changed from another thread)
+    self._lit = (False, False, False, False)
+    debug(DEBUG_RGB_LEDS, "Starting RGB_LED \"%s\", pins: R=%s G=%s B=%s", self.name, str(self.gpio_red), str(self.gpio_green), str(self.gpio_blue))
+    if not RGB_LED.driver or not RGB_LED.driver.is_alive():
+      RGB_LED.driver = RGB_LED_Driver(RGB_LED.pwm_blink)
+    RGB_LED.driver.add(self)
+
+  # Set the colors and flash state, waking the driver only if anything changed
+  def _set(self, red, green, blue, flash):
+    if (red, green, blue, flash) != self._lit:
+      self._lit = (red, green, blue, flash)
+      debug(DEBUG_RGB_LEDS, "--> RGB_LED \"%s\", state: %s", self.name, self.state())
+      RGB_LED.driver.refresh()
+      if RGB_LED.on_change:
+        RGB_LED.on_change(self)
 
   # Command this RGB_LED to turn off
   def off(self):
-    self._green = False
-    self._red = False
-    self._blue = False
+    self._set(False, False, False, self._lit[3])
 
   # Command this RGB_LED to turn red
   def red(self):
-    self._green = False
-    self._red = True
-    self._blue = False
+    self._set(True, False, False, self._lit[3])
 
   # Command this RGB_LED to turn green
   def green(self):
-    self._green = True
-    self._red = False
-    self._blue = False
+    self._set(False, True, False, self._lit[3])
 
   # Command this RGB_LED to turn blue
   def blue(self):
-    self._green = True
-    self._red = False
-    self._blue = True
+    self._set(False, True, True, self._lit[3])
 
   # Return a string describing the current state of hit RGB_LED (for debugging)
   def state(self):
-    if self._flash:
-      if self._red: return "red,flashing"
-      elif self._green: return "green,flashing"
-      elif self._blue: return "blue,flashing"
+    red, green, blue, flash = self._lit
+    if flash:
+      if red: return "red,flashing"
+      elif green: return "green,flashing"
+      elif blue: return "blue,flashing"
     else:
-      if self._red: return "red,solid"
-      elif self._green: return "green,solid"
-      elif self._blue: return "blue,solid"
+      if red: return "red,solid"
+      elif green: return "green,solid"
+      elif blue: return "blue,solid"
     return "off"
 
-  # Command this RGB_LED to start or stop flashing
+  # Command this RGB_LED to start or stop flashing (with True, or the name of
+  # a blink pattern, to start)
   def flash(self, which):
-    self._flash = which
+    if True == which:
+      which = DEFAULT_BLINK
+    if which and which not in RGB_LED.patterns:
+      raise ValueError('unknown blink pattern: "%s"' % (which))
+    red, green, blue, flash = self._lit
+    self._set(red, green, blue, which)
+
+  # Return the (pin, level) pairs this RGB_LED should currently be showing
+  def levels(self):
+    red, green, blue, flash = self._lit
+    on = True
+    # If this RGB_LED is in flashing state
+    if flash:
+      # Set "on" to the state of the global toggle (else leave it on)
+      on = RGB_LED.flash_state
+    pins = []
+    if self.gpio_red:
+      pins.append((self.gpio_red, GPIO.HIGH if on and red else GPIO.LOW))
+    if self.gpio_green:
+      pins.append((self.gpio_green, GPIO.HIGH if on and green else GPIO.LOW))
+    if self.gpio_blue:
+      pins.append((self.gpio_blue, GPIO.HIGH if on and blue else GPIO.LOW))
+    return pins
+
+  # Return the (pin, (frequency, duty cycle)) waveforms this RGB_LED should
+  # currently be showing (in PWM blink mode). Steady pins have no frequency.
+  def waveforms(self):
+    red, green, blue, flash = self._lit
+    on = (None, 100)
+    if flash:
+      on = RGB_LED.patterns[flash]
+    pins = []
+    if self.gpio_red:
+      pins.append((self.gpio_red, on if red else (None, 0)))
+    if self.gpio_green:
+      pins.append((self.gpio_green, on if green else (None, 0)))
+    if self.gpio_blue:
+      pins.append((self.gpio_blue, on if blue else (None, 0)))
+    return pins
 
   def stop(self):
-    self._keep_swimming = False
-
-  def run(self):
-    debug(DEBUG_RGB_LEDS, ("Starting RGB_LED \"%s\", pins: R=%s G=%s B=%s" % (self.name, str(self.gpio_red), str(self.gpio_green), str(self.gpio_blue))))
-    while self._keep_swimming:
-      on = True
-      # If this RGB_LED is in flashing state
-      if self._flash:
-        # Set "on" to the state of the global toggle (else leave it on)
-        on = RGB_LED.flash_state 
-      # if a gpio pin is defined for red:
-      if self.gpio_red:
-        # if the global toggle is on, and red is active (true) on this RGB_LED:
-        if on and self._red:
-          GPIO.output(self.gpio_red, GPIO.HIGH)
-        # Otherwise the global toggle is off, or red is nto currently active
-        else:
-          GPIO.output(self.gpio_red, GPIO.LOW)
-      if self.gpio_green:
-        if on and self._green:
-          GPIO.output(self.gpio_green, GPIO.HIGH)
-        else:
-          GPIO.output(self.gpio_green, GPIO.LOW)
-      if self.gpio_blue:
-        if on and self._blue:
-          GPIO.output(self.gpio_blue, GPIO.HIGH)
-        else:
-          GPIO.output(self.gpio_blue, GPIO.LOW)
-      if self._red or self._green or self._blue:
-        debug(DEBUG_RGB_LEDS, ("--> RGB_LED \"%s\", state: %s" % (self.name, self.state())))
-      time.sleep(SLEEP_BETWEEN_UPDATES_SEC)
+    RGB_LED.driver.remove(self)
 
 
 
@@ -0,0 +1,364 @@
+#
+# Event loops (and the workers that run on them) for my network monitor box
+#
+# Every worker of the daemon (the status engine, power orchestrator, probe
+# engine, resolver, LED driver, fan control, ...) is written as a task for a
+# Loop: it does its work in _work() when it is woken, or when the time it
+# asked for comes, and watches sockets through the loop rather than blocking
+# on them. By default ("threads" mode) each worker gets a loop (and thread) of
+# its own. In "loop" mode they all share a single loop, on a single thread,
+# and so do all of the clock's timers (which would otherwise each be a thread
+# of their own). The mode comes from MY_RUNTIME. E.g.:
+#    MY_RUNTIME=loop python mybox.py
+# Or, from python (before any worker is started):
+#    runtime.install("loop")
+#
+
+
+import heapq
+import itertools
+import os
+import resource
+import select
+import socket
+import threading
+import traceback
+
+from hal import clock
+from metrics import loop_seconds, loop_lateness, loop_wakeups
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_RUNTIME = flag('runtime')
+DEBUG_LOOPS = flag('loops')
+
+
+# A call scheduled on a loop (which can be cancelled, like a threading.Timer).
+# Calls for the same time are made in the order they were scheduled.
+class Handle:
+
+  def __init__(self, when, seq, function, args):
+    self.when = when
+    self.seq = seq
+    self.function = function
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+  def __lt__(self, other):
+    return (self.when, self.seq) < (other.when, other.seq)
+
+
+# A single threaded event loop, running timed calls (on the clock's time) and
+# socket callbacks. Calls can be scheduled from any thread.
+class Loop:
+
+  def __init__(self, name):
+    self.name = name
+    self._lock = threading.Lock()
+    self._timers = []
+    self._seq = itertools.count()
+    self._watched = {}
+    self._wake_in, self._wake_out = socket.socketpair()
+    self._wake_in.setblocking(False)
+    self._wake_out.setblocking(False)
+    self._woken = False
+    self._thread = None
+    self._started = False
+    self._began = None
+    self._keep_swimming = True
+    self.wakeups = 0
+
+  # Run the loop on a thread of its own (once)
+  def start(self):
+    if not self._started:
+      self._started = True
+      threading.Thread(target=self.run, name=self.name).start()
+
+  def stop(self):
+    self._keep_swimming = False
+    self._wake()
+
+  def running(self):
+    return self._keep_swimming
+
+  # Call function(*args) at (or after) the given time on the clock
+  def call_at(self, when, function, args=()):
+    with self._lock:
+      handle = Handle(when, next(self._seq), function, args)
+      heapq.heappush(self._timers, handle)
+    if threading.current_thread() is not self._thread:
+      self._wake()
+    return handle
+
+  def call_later(self, seconds, function, args=()):
+    return self.call_at(clock.time() + seconds, function, args)
+
+  def call_soon(self, function, args=()):
+    return self.call_at(0, function, args)
+
+  # Call callback(now) whenever the socket is ready for reading (or writing)
+  def watch(self, sock, write, callback):
+    with self._lock:
+      self._watched[sock] = (write, callback)
+    if threading.current_thread() is not self._thread:
+      self._wake()
+
+  def unwatch(self, sock):
+    with self._lock:
+      self._watched.pop(sock, None)
+
+  # Return a dict describing this loop (e.g., how often it has woken up)
+  def status(self):
+    j = dict()
+    j['wakeups'] = self.wakeups
+    j['seconds'] = None if self._began is None else clock.time() - self._began
+    with self._lock:
+      j['timers'] = len([h for h in self._timers if not h.cancelled])
+      j['sockets'] = len(self._watched)
+    return j
+
+  def _wake(self):
+    if not self._woken:
+      self._woken = True
+      try:
+        self._wake_out.send(b'!')
+      except OSError:
+        pass
+
+  def _run_timers(self):
+    while True:
+      with self._lock:
+        if not self._timers or self._timers[0].when > clock.time():
+          return
+        handle = heapq.heappop(self._timers)
+      if not handle.cancelled:
+        try:
+          handle.function(*handle.args)
+        except Exception:
+          traceback.print_exc()
+
+  def run(self):
+    self._thread = threading.current_thread()
+    self._began = clock.time()
+    debug(DEBUG_RUNTIME, 'Loop "%s" started.', self.name)
+    while self._keep_swimming:
+      with self._lock:
+        while self._timers and self._timers[0].cancelled:
+          heapq.heappop(self._timers)
+        wait = None
+        if self._timers:
+          wait = max(0, clock.real(self._timers[0].when - clock.time()))
+        readers = [self._wake_in] + [s for s, (write, cb) in self._watched.items() if not write]
+        writers = [s for s, (write, cb) in self._watched.items() if write]
+      try:
+        readable, writable, _ = select.select(readers, writers, [], wait)
+      except (OSError, ValueError):
+        # A watched socket was closed under us (it is unwatched by now)
+        continue
+      self.wakeups += 1
+      loop_wakeups.labels(self.name).inc()
+      now = clock.time()
+      if self._wake_in in readable:
+        readable.remove(self._wake_in)
+        self._woken = False
+        try:
+          while self._wake_in.recv(64):
+            pass
+        except (BlockingIOError, InterruptedError):
+          pass
+      for sock in readable + writable:
+        with self._lock:
+          watched = self._watched.get(sock)
+        if watched:
+          try:
+            watched[1](now)
+          except Exception:
+            traceback.print_exc()
+      self._run_timers()
+    self._wake_in.close()
+    self._wake_out.close()
+    debug(DEBUG_RUNTIME, 'Loop "%s" stopped.', self.name)
+
+
+# The base of the daemon's workers. A worker's _work(now) is called on its
+# loop whenever it is woken (with wake(), e.g., when it has been given more
+# work), and at the time its previous step returned (if any). It is timed as
+# an iteration of the worker's loop (named after the worker, in threads mode),
+# along with how late it started (after the time it asked for, or after it was
+# woken), which shows when a loop is being starved.
+# If the worker has a batch (a context manager factory, e.g., the transaction
+# of the state store) each step runs inside a batch of its own.
+class Worker:
+
+  def __init__(self, loop_name):
+    self.loop_name = loop_name
+    self.loop = None
+    self._own_loop = False
+    self._pending = False
+    self._timer = None
+    self._keep_swimming = True
+    self._wake_lock = threading.Lock()
+    self.batch = None
+    self.iterations = 0
+    self.late = self.max_late = 0.0
+    self.ran = self.max_ran = 0.0
+
+  def start(self):
+    self.loop, self._own_loop = loop_for(self.loop_name)
+    workers.append(self)
+    self.wake()
+
+  def is_alive(self):
+    return self.loop is not None and self._keep_swimming
+
+  # Ask for a step as soon as possible (cheap, and safe to call from any thread)
+  def wake(self):
+    with self._wake_lock:
+      if self._pending or self.loop is None:
+        return
+      self._pending = True
+    self.loop.call_soon(self._run, (clock.time(),))
+
+  def stop(self):
+    self._keep_swimming = False
+    if self.loop is not None:
+      self.loop.call_soon(self._end)
+
+  def _work(self, now):
+    return None
+
+  # Clean up (on the loop) once stopped
+  def _stopped(self):
+    pass
+
+  # Return how late (and for how long) this worker's steps have run, in ms
+  def timing(self):
+    j = dict()
+    j['iterations'] = self.iterations
+    j['late-ms'] = round(self.late * 1000.0, 3)
+    j['max-late-ms'] = round(self.max_late * 1000.0, 3)
+    j['ran-ms'] = round(self.ran * 1000.0, 3)
+    j['max-ran-ms'] = round(self.max_ran * 1000.0, 3)
+    return j
+
+  def _run(self, due):
+    with self._wake_lock:
+      self._pending = False
+    if not self._keep_swimming:
+      return
+    started = clock.time()
+    self.late = max(0.0, started - due)
+    if self.batch is None:
+      wake = self._work(started)
+    else:
+      with self.batch():
+        wake = self._work(started)
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if wake is not None and self._keep_swimming:
+      self._timer = self.loop.call_at(wake, self._run, (wake,))
+    self.ran = clock.time() - started
+    self.iterations += 1
+    self.max_late = max(self.max_late, self.late)
+    self.max_ran = max(self.max_ran, self.ran)
+    loop_lateness.labels(self.loop_name).observe(self.late)
+    loop_seconds.labels(self.loop_name).observe(self.ran)
+    debug(DEBUG_LOOPS, '--> %s: %0.2fms late, ran %0.2fms', self.loop_name, self.late * 1000.0, self.ran * 1000.0)
+
+  def _end(self):
+    if self._timer is not None:
+      self._timer.cancel()
+    self._stopped()
+    if self._own_loop:
+      self.loop.stop()
+
+
+# The runtime mode, the shared loop (in "loop" mode), and every loop and
+# worker that has been started
+RUNTIME_MODES = ('threads', 'loop')
+mode = 'threads'
+shared = None
+loops = []
+workers = []
+def install(new_mode):
+  global mode
+  global shared
+  if new_mode not in RUNTIME_MODES:
+    raise ValueError('unknown runtime mode: "%s"' % (new_mode))
+  mode = new_mode
+  if 'loop' == mode and shared is None:
+    shared = Loop('loop')
+    loops.append(shared)
+    clock.loop = shared
+
+# Stop the shared loop (if any), once the workers on it have stopped
+def stop():
+  if shared is not None:
+    shared.call_soon(shared.stop)
+
+# Return (loop, whether it is the worker's own) for a worker. The shared loop
+# is started by its first worker (until then, it only collects timers).
+def loop_for(name):
+  if shared is not None:
+    shared.start()
+    return shared, False
+  loop = Loop(name)
+  loops.append(loop)
+  loop.start()
+  return loop, True
+
+# Return a version of a callback (e.g., for GPIO events, which arrive on a
+# thread of the GPIO library's) that runs it on the shared loop (if any)
+def on_loop(callback):
+  if shared is None:
+    return callback
+  return lambda *args: shared.call_soon(callback, args)
+
+
+# Return the timing of every running worker, by its loop name
+def timings():
+  return dict((w.loop_name, w.timing()) for w in workers if w.is_alive())
+
+
+# Return the resident set size of this process (in MB)
+def rss_mb():
+  try:
+    with open('/proc/self/status', 'r') as file:
+      for line in file:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024.0
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Return the memory and wakeup budget of the daemon, and how it is doing
+# against it: its RSS and threads, and the wakeups per second (of the clock)
+# of its loops over their lifetimes (threads that are not loops, e.g., the
+# HTTP server's, are not counted)
+def budget(memory_mb, wakeups_per_sec):
+  j = dict()
+  j['mode'] = mode
+  j['rss-mb'] = round(rss_mb(), 1)
+  j['memory-budget-mb'] = memory_mb
+  j['threads'] = threading.active_count()
+  j['loops'] = dict()
+  wakeups = 0.0
+  for loop in loops:
+    s = j['loops'][loop.name] = loop.status()
+    if s['seconds']:
+      s['wakeups-per-sec'] = round(s['wakeups'] / s['seconds'], 2)
+      wakeups += s['wakeups-per-sec']
+  j['wakeups-per-sec'] = round(wakeups, 2)
+  j['wakeup-budget-per-sec'] = wakeups_per_sec
+  j['over-budget'] = [k for k, v, b in (('memory', j['rss-mb'], memory_mb), ('wakeups', wakeups, wakeups_per_sec)) if b and v > b]
+  return j
+
+
+# Select the mode from the environment (default: a thread for each worker)
+MY_RUNTIME = os.environ.get('MY_RUNTIME', 'threads')
+install(MY_RUNTIME)
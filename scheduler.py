@@ -0,0 +1,87 @@
+#
+# Adaptive per-target probe scheduling for my network monitor box
+#
+# Each target is probed quickly (every fast seconds) right after a failure, or
+# while its latest result is unconfirmed (i.e., until the same result has been
+# seen confirm times in a row). Once a target is confirmed up, its interval
+# starts at base and doubles with every further good result, up to its
+# ceiling. A target that is confirmed down keeps being probed every base
+# seconds, so its recovery is noticed promptly. Every interval is shortened by
+# a random jitter (never lengthened, so the ceilings hold), which stops the
+# probes from synchronizing. E.g.:
+#    s = AdaptiveSchedule(2.5, 10)
+#    s.ceiling("outside", 60)
+#    s.base("Bag End", 1.0)
+#    s.result("router", True)
+#    next_probe = s.next("router", clock.time())
+#
+
+
+import random
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_SCHEDULER = flag('scheduler')
+
+
+FAST_PROBE_SEC = 1.0
+CONFIRM_PROBES = 2
+JITTER_FRACTION = 0.1
+class AdaptiveSchedule:
+
+  def __init__(self, base, ceiling, fast=FAST_PROBE_SEC, confirm=CONFIRM_PROBES, jitter=JITTER_FRACTION):
+    self._base = base
+    self._default_ceiling = ceiling
+    self._fast = fast
+    self._confirm = confirm
+    self._jitter = jitter
+    self._bases = {}
+    self._ceilings = {}
+    self._goods = {}
+    self._streaks = {}
+    self._intervals = {}
+
+  # Set the base interval for one target (e.g., for a kind of probe that is
+  # cheaper, or dearer, than the rest)
+  def base(self, key, seconds):
+    self._bases[key] = seconds
+
+  # Set the longest interval for one target (e.g., to keep it well inside the
+  # tolerances of the indicator it drives)
+  def ceiling(self, key, seconds):
+    self._ceilings[key] = seconds
+
+  # Return the current interval for a target (before jitter)
+  def interval(self, key):
+    return self._intervals.get(key, self._fast)
+
+  # Return the current interval for every target that has had a result
+  def intervals(self):
+    return dict(self._intervals)
+
+  # Note whether a probe of a target was good, returning its new interval
+  def result(self, key, good):
+    if self._goods.get(key) == good:
+      self._streaks[key] += 1
+    else:
+      self._goods[key] = good
+      self._streaks[key] = 1
+    ceiling = self._ceilings.get(key, self._default_ceiling)
+    interval = self._intervals.get(key, self._fast)
+    if self._streaks[key] < self._confirm:
+      interval = self._fast
+    elif good and self._streaks[key] > self._confirm:
+      interval = min(interval * 2, ceiling)
+    else:
+      interval = min(self._bases.get(key, self._base), ceiling)
+    if interval != self._intervals.get(key):
+      debug(DEBUG_SCHEDULER, '--> "%s" [%s]: every %0.2fs', key, 'UP' if good else 'DN', interval)
+    self._intervals[key] = interval
+    return interval
+
+  # Return when a target should next be probed
+  def next(self, key, now):
+    return now + self.interval(key) * (1.0 - self._jitter * random.random())
+
+
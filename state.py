@@ -0,0 +1,159 @@
+#
+# Versioned state store for my network monitor box
+#
+# The state shared between the workers and the REST API (the probe results,
+# indicators, LEDs, buttons and power jobs) is published as immutable,
+# versioned snapshots. Writers batch related changes into a transaction, which
+# copies just the sections it changes and then publishes the new snapshot with
+# a single reference assignment (which is atomic), so readers never take a
+# lock and always see one consistent point in time. A transaction opened while
+# the same thread already has one open joins it, so everything that happens
+# while handling one event (e.g., a button press and the LED it lights) lands
+# in the same version. Anything that announces the change (e.g., an event) can
+# be deferred until the version is published. E.g.:
+#    store = StateStore()
+#    with store.transaction() as t:
+#      t.set("leds", "router", "red,flashing")
+#      t.set("power", "active", ["router"])
+#    s = store.snapshot()
+#    print(s.version, s["leds"]["router"])
+#
+
+
+import threading
+from types import MappingProxyType
+
+from hal import clock
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_STATE = flag('state')
+
+
+# Return a read-only copy of a (JSON-like) value, with dicts made into
+# read-only mappings and lists into tuples
+def freeze(value):
+  if isinstance(value, (dict, MappingProxyType)):
+    return MappingProxyType(dict((k, freeze(v)) for k, v in value.items()))
+  if isinstance(value, (list, tuple)):
+    return tuple(freeze(v) for v in value)
+  return value
+
+# Return a (JSON serializable) copy of a frozen value
+def thaw(value):
+  if isinstance(value, MappingProxyType):
+    return dict((k, thaw(v)) for k, v in value.items())
+  if isinstance(value, tuple):
+    return [thaw(v) for v in value]
+  return value
+
+
+EMPTY = MappingProxyType({})
+MISSING = object()
+class Snapshot:
+
+  def __init__(self, version, time, sections):
+    self.version = version
+    self.time = time
+    self._sections = sections
+
+  # Return a section (as a read-only mapping, which is empty if it has never
+  # been written)
+  def __getitem__(self, section):
+    return self._sections.get(section, EMPTY)
+
+  def sections(self):
+    return list(self._sections.keys())
+
+
+class Transaction:
+
+  def __init__(self, store):
+    self._store = store
+    self._changes = {}
+    self._after = []
+
+  # Set a value (a change to an equal value is no change)
+  def set(self, section, key, value):
+    value = freeze(value)
+    if self.get(section, key, MISSING) != value:
+      self._changes.setdefault(section, {})[key] = value
+
+  # Return a value as it stands in this transaction
+  def get(self, section, key, default=None):
+    changes = self._changes.get(section, {})
+    if key in changes:
+      return changes[key]
+    return self._store.snapshot()[section].get(key, default)
+
+  # Call function(*args) once the transaction is published (e.g., to announce
+  # a change only when readers can see it)
+  def after(self, function, args=()):
+    self._after.append((function, args))
+
+  def changed(self):
+    return bool(self._changes)
+
+  # Copy the changed sections into a new snapshot (the rest are shared with
+  # the current one)
+  def _apply(self, current):
+    sections = dict(current._sections)
+    for section, changes in self._changes.items():
+      values = dict(sections.get(section, EMPTY))
+      values.update(changes)
+      sections[section] = MappingProxyType(values)
+    return Snapshot(current.version + 1, clock.time(), sections)
+
+
+class StateStore:
+
+  def __init__(self):
+    self._current = Snapshot(0, clock.time(), {})
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._listeners = []
+
+  # Return the current snapshot (never waits)
+  def snapshot(self):
+    return self._current
+
+  # Call listener(snapshot) after every new version is published
+  def on_publish(self, listener):
+    self._listeners.append(listener)
+
+  # Return a context manager for a transaction (joining this thread's open
+  # one, if any), which is published when the outermost one ends
+  def transaction(self):
+    return _Scope(self)
+
+  def _publish(self, transaction):
+    with self._lock:
+      snapshot = self._current = transaction._apply(self._current)
+    debug(DEBUG_STATE, '--> v%d: %s', snapshot.version, lambda: ', '.join(transaction._changes.keys()))
+    for listener in self._listeners:
+      listener(snapshot)
+
+
+class _Scope:
+
+  def __init__(self, store):
+    self._store = store
+    self._outer = False
+
+  def __enter__(self):
+    local = self._store._local
+    if getattr(local, 'transaction', None) is None:
+      local.transaction = Transaction(self._store)
+      self._outer = True
+    return local.transaction
+
+  def __exit__(self, kind, value, traceback):
+    if self._outer:
+      transaction = self._store._local.transaction
+      self._store._local.transaction = None
+      if transaction.changed():
+        self._store._publish(transaction)
+      for function, args in transaction._after:
+        function(*args)
+    return False
@@ -0,0 +1,259 @@
+#
+# Event-driven status engine for the status LEDs of my network monitor box
+#
+# Probe results are reported to the engine as they arrive, and it immediately
+# re-evaluates just the affected indicator. Each indicator is "alive" (solid
+# green) until its alive tolerance has passed since its last good probe, then
+# "degraded" (slowly flashing green), and then "dead" (quickly flashing red)
+# once its dead tolerance has passed. The next of those boundaries is kept on
+# a timer wheel, so nothing runs at all between results and boundaries.
+# Alongside those timestamp rules, a failure detector watches the sequence of
+# results of each probe (e.g., 3 failures in a row is dead, and 2 in the last
+# 5 is degraded), so an outage shows as soon as enough probes have failed,
+# however long the tolerances are. An indicator shows the worse of the two. An
+# indicator can start in a provisional state (e.g., the last one it had before
+# a restart), which is shown until its first report (or its alive tolerance
+# passes). E.g.:
+#    engine = StatusEngine()
+#    engine.add("router", rgb_led_router, 21, 81, provisional=DEAD)
+#    engine.result("router", "router-ping", False)
+#    engine.report("router", clock.time())
+#
+
+
+import threading
+from collections import deque
+
+from hal import clock
+from runtime import Worker
+from timer_wheel import TimerWheel
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_STATUS = flag('status')
+
+
+# Indicator states
+ALIVE = 'alive'
+DEGRADED = 'degraded'
+DEAD = 'dead'
+SEVERITY = {ALIVE: 0, DEGRADED: 1, DEAD: 2}
+
+# Return the worse of two states
+def worse(a, b):
+  return a if SEVERITY[a] > SEVERITY[b] else b
+
+
+# Failure detector over the recent results of one probe: dead after
+# dead_after failures in a row, degraded while at least k of the last n
+# results have failed (for degraded=(k, n)), and otherwise alive. Either rule
+# can be turned off with None. A verdict is only eased (e.g., from dead to
+# degraded) after recover_after good results in a row, so a target that is
+# just coming back does not flap.
+DETECT_DEAD_AFTER = 3
+DETECT_DEGRADED = (2, 5)
+DETECT_RECOVER_AFTER = 2
+class FailureDetector:
+
+  def __init__(self, dead_after=DETECT_DEAD_AFTER, degraded=DETECT_DEGRADED, recover_after=DETECT_RECOVER_AFTER):
+    self.dead_after = dead_after
+    self.degraded = degraded
+    self.recover_after = recover_after
+    self._recent = deque(maxlen=degraded[1] if degraded else 1)
+    self._failures = 0
+    self._goods = 0
+    self.state = ALIVE
+
+  # Note a result, returning the (possibly new) verdict
+  def result(self, good):
+    self._recent.append(good)
+    if good:
+      self._goods += 1
+      self._failures = 0
+    else:
+      self._failures += 1
+      self._goods = 0
+    state = ALIVE
+    if self.dead_after and self._failures >= self.dead_after:
+      state = DEAD
+    elif self.degraded and len([g for g in self._recent if not g]) >= self.degraded[0]:
+      state = DEGRADED
+    if SEVERITY[state] < SEVERITY[self.state] and self._goods < self.recover_after:
+      state = self.state
+    self.state = state
+    return state
+
+
+class Indicator:
+
+  # Until the first good probe, an indicator is shown as degraded (i.e., its
+  # state is unknown), and it goes dead if nothing good arrives in time. One
+  # that starts out provisionally dead stays dead until something good does.
+  # Reports of older good probes (e.g., of probes that have never been good)
+  # never take the indicator back further than that. The detector options are
+  # the FailureDetector arguments for each of its probes (or False for none).
+  def __init__(self, name, led, alive_tolerance, dead_tolerance, now, provisional=None, detector=False):
+    self.name = name
+    self.led = led
+    self.alive_tolerance = alive_tolerance
+    self.dead_tolerance = dead_tolerance
+    self.detector = detector
+    self.detectors = {}
+    self.floor = now - (dead_tolerance if DEAD == provisional else alive_tolerance)
+    self.last_good = self.floor
+    self.provisional = provisional
+    self.provisional_until = now + alive_tolerance
+    self.state = None
+
+  # Note a probe result (for its failure detector)
+  def detect(self, probe, good):
+    if self.detector is False:
+      return
+    if probe not in self.detectors:
+      self.detectors[probe] = FailureDetector(**self.detector)
+    self.detectors[probe].result(good)
+
+  # Return the worst verdict of the failure detectors
+  def detected(self):
+    state = ALIVE
+    for detector in self.detectors.values():
+      state = worse(state, detector.state)
+    return state
+
+  # Return the state at the given time (the worse of the timestamp rules and
+  # the failure detectors), and when the timestamp rules will next change it
+  def evaluate(self, now):
+    if self.provisional is not None:
+      if now < self.provisional_until:
+        return self.provisional, self.provisional_until
+      self.provisional = None
+    age = now - self.last_good
+    if age <= self.alive_tolerance:
+      state, boundary = ALIVE, self.last_good + self.alive_tolerance
+    elif age <= self.dead_tolerance:
+      state, boundary = DEGRADED, self.last_good + self.dead_tolerance
+    else:
+      state, boundary = DEAD, None
+    return worse(state, self.detected()), boundary
+
+  # Show the given state on this indicator's LED (if it has one)
+  def show(self, state):
+    if self.led is None:
+      return
+    if ALIVE == state:
+      self.led.green()
+      self.led.flash(False)
+    elif DEGRADED == state:
+      self.led.green()
+      self.led.flash('slow')
+    else:
+      self.led.red()
+      self.led.flash('fast')
+
+
+class StatusEngine(Worker):
+
+  # The on_change function (if any) is called with (name, state) whenever an
+  # indicator changes state
+  def __init__(self, on_change=None):
+    Worker.__init__(self, 'status')
+    self._on_change = on_change
+    self._indicators = {}
+    self._reported = set()
+    self._paused = False
+    self._held = set()
+    self._refresh = set()
+    self._wheel = TimerWheel(clock.time())
+    self._lock = threading.RLock()
+
+  # The detector options are FailureDetector arguments (None for the defaults,
+  # or False for no detector)
+  def add(self, name, led, alive_tolerance, dead_tolerance, provisional=None, detector=None):
+    if detector is None:
+      detector = dict()
+    with self._lock:
+      self._indicators[name] = Indicator(name, led, alive_tolerance, dead_tolerance, clock.time(), provisional, detector)
+      self._reported.add(name)
+    self.wake()
+
+  # Report the result of one of an indicator's probes to its failure detector
+  # (like report(), safe to call from any thread)
+  def result(self, name, probe, good):
+    with self._lock:
+      self._indicators[name].detect(probe, good)
+      self._reported.add(name)
+    self.wake()
+
+  # Report the time of the latest good probe for an indicator (safe to call
+  # from any thread, and cheap: the evaluation happens on the engine's loop)
+  def report(self, name, last_good):
+    with self._lock:
+      indicator = self._indicators[name]
+      indicator.last_good = max(last_good, indicator.floor)
+      indicator.provisional = None
+      self._reported.add(name)
+    self.wake()
+
+  # While paused (e.g., while the buttons own the LEDs), states are
+  # still tracked but not shown. Every LED is refreshed on resuming.
+  def pause(self, paused):
+    with self._lock:
+      if paused == self._paused:
+        return
+      self._paused = paused
+      if not paused:
+        self._refresh.update(self._indicators.keys())
+    self.wake()
+
+  # Hold (or release) one indicator, e.g., while its target is power cycling.
+  # Like pausing, but just for that indicator, which is refreshed on release.
+  def hold(self, name, held):
+    with self._lock:
+      if held:
+        self._held.add(name)
+        return
+      if name not in self._held:
+        return
+      self._held.discard(name)
+      self._refresh.add(name)
+    self.wake()
+
+  # Return the current state of every indicator
+  def states(self):
+    return dict((name, i.state) for name, i in self._indicators.items())
+
+  # Return the names of the indicators still showing a provisional state
+  def provisional(self):
+    return [name for name, i in self._indicators.items() if i.provisional is not None]
+
+  def _evaluate(self, indicator, now, refresh):
+    state, boundary = indicator.evaluate(now)
+    if boundary is None:
+      self._wheel.cancel(indicator.name)
+    else:
+      self._wheel.schedule(indicator.name, boundary)
+    changed = state != indicator.state
+    indicator.state = state
+    if changed:
+      debug(DEBUG_STATUS, '--> %s: %s', indicator.name, state)
+    if (changed or refresh) and not self._paused and indicator.name not in self._held:
+      indicator.show(state)
+    if changed and self._on_change:
+      self._on_change(indicator.name, state)
+
+  # Evaluate the reported (and refreshed) indicators, and those with a boundary
+  # due, sleeping until the next boundary
+  def _work(self, now):
+    with self._lock:
+      reported = self._reported
+      self._reported = set()
+      refresh = self._refresh
+      self._refresh = set()
+      for name in self._wheel.advance(now):
+        reported.add(name)
+      for name in reported | refresh:
+        self._evaluate(self._indicators[name], now, name in refresh)
+      return self._wheel.next_expiry()
+
+
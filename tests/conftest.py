@@ -0,0 +1,43 @@
+#
+# Shared setup for the tests, which all run on a simulated board (so they run
+# on any Linux machine, e.g., in CI), in either runtime mode. E.g.:
+#    MY_RUNTIME=loop python -m pytest -q tests
+#
+
+
+import os
+import sys
+
+# The simulated board has to be chosen before anything imports hal
+os.environ.setdefault('MY_GPIO_BACKEND', 'sim')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import hal
+import runtime
+from hal import GPIO, clock, SimulatedBoard, ScaledClock
+
+
+# Stop the shared loop (in "loop" mode) once all of the tests have run
+def pytest_sessionfinish(session, exitstatus):
+  runtime.stop()
+
+
+# How many times faster than real time the virtual clock runs (a test module
+# can override this fixture)
+@pytest.fixture
+def scale():
+  return 100
+
+# A fresh simulated board and virtual clock (still driving the shared loop's
+# timers, if there is one) for one test, with the old ones put back afterwards
+@pytest.fixture
+def board(scale):
+  gpio, real = GPIO._target, clock._target
+  sim = SimulatedBoard()
+  virtual = ScaledClock(scale)
+  virtual.loop = real.loop
+  hal.install(gpio=sim, clock=virtual)
+  yield sim
+  hal.install(gpio=gpio, clock=real)
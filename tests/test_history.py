@@ -0,0 +1,61 @@
+#
+# Tests for the probe history ring buffers
+#
+
+
+from hal import clock
+from probes import PROBE_UP, PROBE_DOWN, PROBE_TIMEOUT
+import history
+from history import ProbeHistory
+
+
+def test_grows_in_chunks_up_to_capacity(monkeypatch):
+  monkeypatch.setattr(history, 'HISTORY_CHUNK', 4)
+  h = ProbeHistory(capacity=10)
+  empty = h.nbytes()
+  now = int(clock.time())
+  for i in range(5):
+    h.append(now + i, PROBE_UP, 0.001)
+  assert len(h) == 5
+  assert h.nbytes() == 2 * empty
+  for i in range(5, 20):
+    h.append(now + i, PROBE_UP, 0.001)
+  assert len(h) == 10
+  assert h.nbytes() == 10 * empty // 4
+
+def test_wraps_keeping_the_newest():
+  h = ProbeHistory(capacity=5)
+  now = int(clock.time())
+  for i in range(12):
+    h.append(now + i, PROBE_UP, i / 1000.0)
+  assert len(h) == 5
+  with h._lock:
+    times = [h._time(n) - now for n in range(len(h))]
+  assert [round(t, 1) for t in times] == [7, 8, 9, 10, 11]
+  b = h.query(now, now + 12, 1)[0]
+  assert b['count'] == 5
+  assert abs(b['rtt-min'] - 0.007) < 1e-6
+  assert abs(b['rtt-max'] - 0.011) < 1e-6
+
+def test_query_buckets():
+  h = ProbeHistory(capacity=100)
+  now = int(clock.time())
+  for i in range(20):
+    if i % 4 == 3:
+      h.append(now + i, PROBE_TIMEOUT, None)
+    elif i >= 10 and i % 5 == 0:
+      h.append(now + i, PROBE_DOWN, None)
+    else:
+      h.append(now + i, PROBE_UP, 0.002 if i < 10 else 0.004)
+  buckets = h.query(now, now + 20, 2)
+  assert [b['count'] for b in buckets] == [10, 10]
+  assert [b[PROBE_UP] for b in buckets] == [8, 6]
+  assert [b[PROBE_DOWN] for b in buckets] == [0, 1]
+  assert [b[PROBE_TIMEOUT] for b in buckets] == [2, 3]
+  assert abs(buckets[0]['rtt-avg'] - 0.002) < 1e-6
+  assert abs(buckets[1]['rtt-avg'] - 0.004) < 1e-6
+  # Only the samples inside [start, end) are counted
+  assert h.query(now + 5, now + 7, 1)[0]['count'] == 2
+  assert h.query(now + 30, now + 40, 1)[0] == {
+    'start': now + 30, 'count': 0, PROBE_UP: 0, PROBE_DOWN: 0,
+    PROBE_TIMEOUT: 0, 'rtt-min': None, 'rtt-max': None, 'rtt-avg': None}
@@ -0,0 +1,51 @@
+#
+# End to end: holding the button down power cycles the relay, on a simulated
+# board with a clock running 50 times faster than real time
+#
+
+
+import threading
+
+import pytest
+
+from hal import GPIO, clock
+from buttons import Button
+from power import PowerOrchestrator, JOB_DONE
+
+
+BUTTON_GPIO = 26
+RELAY_GPIO = 27
+
+
+@pytest.fixture
+def scale():
+  return 50
+
+def test_button_hold_power_cycles_relay(board):
+  GPIO.setup(BUTTON_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+  GPIO.setup(RELAY_GPIO, GPIO.OUT, initial=GPIO.HIGH)
+  done = threading.Event()
+  power = PowerOrchestrator(on_done=lambda job: done.set())
+  power.start()
+  off = lambda: GPIO.output(RELAY_GPIO, GPIO.LOW)
+  on = lambda: GPIO.output(RELAY_GPIO, GPIO.HIGH)
+  steps = [('confirm', lambda: None, 3), ('off', off, 10), ('on', on, 0)]
+  jobs = []
+  button = Button('main', BUTTON_GPIO, edge_triggered=True)
+  button.on_hold(4, lambda b, held: jobs.append(power.submit('router', [RELAY_GPIO], steps, 'button', on)))
+  try:
+    pressed = clock.time()
+    board.press(BUTTON_GPIO)
+    assert done.wait(5)
+    board.release(BUTTON_GPIO)
+  finally:
+    button.stop()
+    power.stop()
+  job, = jobs
+  assert job.state == JOB_DONE
+  writes = [(when, level) for when, pin, level in board.log() if pin == RELAY_GPIO]
+  assert [level for when, level in writes] == [0, 1]
+  # Off after the hold and the confirm step, then back on 10 seconds later
+  assert 7 <= writes[0][0] - pressed < 8
+  assert 10 <= writes[1][0] - writes[0][0] < 11
+  assert board.level(RELAY_GPIO) == GPIO.HIGH
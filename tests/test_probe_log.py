@@ -0,0 +1,58 @@
+#
+# Tests for the crash-safe probe log
+#
+
+
+import os
+
+import pytest
+
+from hal import clock
+from probes import PROBE_UP, PROBE_TIMEOUT
+from probe_log import pack_record, unpack_record, ProbeLog, RECORD, KIND_PROBE, KIND_POWER, PROBE_CODES, POWER_CODES
+
+
+def test_pack_unpack_round_trip():
+  record = pack_record(KIND_PROBE, PROBE_CODES[PROBE_UP], 1700000000.5, 0.25, 'router')
+  assert len(record) == RECORD.size == 32
+  assert unpack_record(record) == (KIND_PROBE, PROBE_CODES[PROBE_UP], 1700000000.5, 0.25, 'router')
+  kind, code, when, value, name = unpack_record(pack_record(KIND_PROBE, 3, 1.0, None, ''))
+  assert value != value and name == ''
+
+def test_corrupt_records_are_invalid():
+  record = pack_record(KIND_POWER, POWER_CODES['done'], 1700000000.0, 12.0, 'modem')
+  for i in range(RECORD.size):
+    broken = bytearray(record)
+    broken[i] ^= 0x40
+    assert unpack_record(bytes(broken)) is None
+  assert unpack_record(bytes(RECORD.size)) is None
+
+def test_long_names_are_rejected():
+  pack_record(KIND_PROBE, 1, 1.0, 0.0, 'x' * 15)
+  with pytest.raises(ValueError):
+    pack_record(KIND_PROBE, 1, 1.0, 0.0, 'x' * 16)
+  with pytest.raises(ValueError):
+    pack_record(KIND_PROBE, 1, 1.0, 0.0, u'é' * 8)
+
+def test_torn_record_is_overwritten(tmp_path):
+  now = clock.time()
+  log = ProbeLog(str(tmp_path))
+  for i in range(3):
+    log.probe('router', now + i, PROBE_UP, 0.001 * i)
+  log.close()
+  (day, n, path), = log.segments()
+  # Tear the third record, as if the box had crashed while writing it
+  with open(path, 'r+b') as f:
+    f.seek(2 * RECORD.size + 20)
+    f.write(b'\xff\xff')
+  log = ProbeLog(str(tmp_path))
+  assert [r[2] for r in log.read(now - 1, now + 10)] == [now, now + 1]
+  log.probe('router', now + 5, PROBE_TIMEOUT, None)
+  records = list(log.read(now - 1, now + 10))
+  assert [r[2] for r in records] == [now, now + 1, now + 5]
+  assert records[-1][1] == PROBE_CODES[PROBE_TIMEOUT]
+  log.close()
+  assert os.path.getsize(path) == 128 * 1024 * RECORD.size
+  with open(path, 'rb') as f:
+    f.seek(2 * RECORD.size)
+    assert unpack_record(f.read(RECORD.size))[2] == now + 5
@@ -0,0 +1,31 @@
+#
+# Tests for the adaptive per-target probe schedule
+#
+
+
+from scheduler import AdaptiveSchedule
+
+
+def test_backs_off_to_ceiling_and_snaps_back():
+  s = AdaptiveSchedule(2.5, 10, fast=1.0, confirm=2)
+  assert s.interval('router') == 1.0
+  assert [s.result('router', True) for i in range(5)] == [1.0, 2.5, 5.0, 10, 10]
+  assert s.result('router', False) == 1.0
+  assert s.result('router', False) == 2.5
+  assert s.result('router', False) == 2.5
+  assert s.result('router', True) == 1.0
+
+def test_per_target_base_and_ceiling():
+  s = AdaptiveSchedule(2.5, 10)
+  s.base('cheap', 1.5)
+  s.ceiling('cheap', 4)
+  assert [s.result('cheap', True) for i in range(4)] == [1.0, 1.5, 3.0, 4]
+  assert s.intervals() == {'cheap': 4}
+
+def test_jitter_only_shortens():
+  s = AdaptiveSchedule(2.5, 10, jitter=0.1)
+  for i in range(3):
+    s.result('router', True)
+  for i in range(100):
+    t = s.next('router', 1000.0)
+    assert 1000.0 + 5.0 * 0.9 <= t <= 1000.0 + 5.0
@@ -0,0 +1,23 @@
+#
+# Tests for the failure detector behind each indicator
+#
+
+
+from status_engine import FailureDetector, ALIVE, DEGRADED, DEAD
+
+
+def test_detector_sequence():
+  d = FailureDetector()
+  results = [d.result(bool(g)) for g in [1, 0, 1, 0, 0, 0, 1, 1, 1, 1, 1]]
+  assert results == [
+    ALIVE, ALIVE, ALIVE, DEGRADED, DEGRADED, DEAD,
+    DEAD, DEGRADED, DEGRADED, ALIVE, ALIVE]
+  assert d.state == ALIVE
+
+def test_rules_can_be_turned_off():
+  d = FailureDetector(dead_after=None)
+  assert [d.result(False) for i in range(6)][-1] == DEGRADED
+  d = FailureDetector(degraded=None, recover_after=1)
+  assert [d.result(g) for g in [False, False, True, False, False, False]] == [
+    ALIVE, ALIVE, ALIVE, ALIVE, ALIVE, DEAD]
+  assert d.result(True) == ALIVE
@@ -0,0 +1,47 @@
+#
+# Tests for the hashed timing wheel
+#
+
+
+from timer_wheel import TimerWheel
+
+
+def test_expires_in_order():
+  w = TimerWheel(100.0)
+  w.schedule('b', 102.0)
+  w.schedule('a', 101.0)
+  w.schedule('c', 150.0)
+  assert len(w) == 3
+  assert w.advance(100.5) == []
+  assert w.advance(102.0) == ['a', 'b']
+  assert len(w) == 1
+
+def test_reschedule_and_cancel():
+  w = TimerWheel(100.0)
+  w.schedule('a', 101.0)
+  w.schedule('b', 101.0)
+  w.schedule('a', 105.0)
+  w.cancel('b')
+  assert w.advance(104.0) == []
+  assert w.advance(105.0) == ['a']
+  assert len(w) == 0
+
+def test_next_expiry_skips_dead_entries():
+  w = TimerWheel(100.0)
+  assert w.next_expiry() is None
+  w.schedule('a', 101.0)
+  w.schedule('b', 103.0)
+  w.schedule('a', 110.0)
+  assert abs(w.next_expiry() - 103.0) < 1e-6
+  w.cancel('b')
+  assert abs(w.next_expiry() - 110.0) < 1e-6
+  w.cancel('a')
+  assert w.next_expiry() is None
+
+def test_long_gap_wraps_the_wheel():
+  w = TimerWheel(0.0, tick=0.1, slots=8)
+  w.schedule('far', 5.0)
+  w.schedule('near', 0.3)
+  assert w.advance(0.5) == ['near']
+  assert w.advance(4.9) == []
+  assert w.advance(60.0) == ['far']
@@ -0,0 +1,79 @@
+#
+# A hashed timing wheel, for scheduling many timers cheaply
+#
+# Timers are keyed (so scheduling a key again moves its timer), and are
+# rounded up to whole ticks. Scheduling and cancelling are O(1), and advancing
+# the wheel only looks at the slots for the ticks that have passed. A heap of
+# the expiry ticks (from which cancelled or moved timers are dropped lazily)
+# keeps finding the next expiry O(log n). E.g.:
+#    w = TimerWheel(clock.time())
+#    w.schedule("router", clock.time() + 21)
+#    ...
+#    for key in w.advance(clock.time()): ...
+#
+
+
+import heapq
+import itertools
+import math
+
+
+WHEEL_TICK_SEC = 0.1
+WHEEL_SLOTS = 512
+class TimerWheel:
+
+  def __init__(self, now, tick=WHEEL_TICK_SEC, slots=WHEEL_SLOTS):
+    self._tick = tick
+    self._slots = [dict() for i in range(slots)]
+    self._current = int(now / tick)
+    self._timers = {}
+    self._heap = []
+    self._seq = itertools.count()
+
+  def __len__(self):
+    return len(self._timers)
+
+  # Schedule (or reschedule) the timer for key to expire at the given time
+  def schedule(self, key, when):
+    self.cancel(key)
+    t = max(self._current + 1, int(math.ceil(when / self._tick)))
+    self._slots[t % len(self._slots)][key] = t
+    self._timers[key] = t
+    heapq.heappush(self._heap, (t, next(self._seq), key))
+    # Rebuild the heap once it is mostly dead entries, so it stays bounded
+    if len(self._heap) > 2 * len(self._timers) + WHEEL_SLOTS:
+      self._heap = [(t, next(self._seq), k) for k, t in self._timers.items()]
+      heapq.heapify(self._heap)
+
+  def cancel(self, key):
+    t = self._timers.pop(key, None)
+    if t is not None:
+      self._slots[t % len(self._slots)].pop(key, None)
+
+  # Return the time the next timer expires (or None if there are no timers)
+  def next_expiry(self):
+    heap = self._heap
+    while heap and self._timers.get(heap[0][2]) != heap[0][0]:
+      heapq.heappop(heap)
+    if not heap:
+      return None
+    return heap[0][0] * self._tick
+
+  # Advance the wheel to the given time, returning the keys of the expired
+  # timers (in expiry order)
+  def advance(self, now):
+    target = int(now / self._tick)
+    expired = []
+    # After a long gap every slot has to be looked at once, but no more
+    steps = min(target - self._current, len(self._slots))
+    for i in range(1, steps + 1):
+      slot = self._slots[(self._current + i) % len(self._slots)]
+      for key, t in sorted(slot.items(), key=lambda kt: kt[1]):
+        if t <= target:
+          del slot[key]
+          del self._timers[key]
+          expired.append((t, key))
+    self._current = max(self._current, target)
+    return [key for t, key in sorted(expired, key=lambda tk: tk[0])]
+
+
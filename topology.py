@@ -0,0 +1,177 @@
+#
+# Topology of my network monitor box: the targets it watches, and the LEDs,
+# relays and buttons bound to each of them
+#
+# Each target has a status indicator, which is driven by any number of probes,
+# of any of the PROBE_KEYS kinds: ICMP ("ping"), HTTP ("http"), TCP connect
+# ("tcp") and DNS query ("dns") probes. Each probe is given by its address
+# (the name to query, for "dns"), or by a dict of its options. It may have an
+# RGB LED to show its status on, a relay to power cycle it with (powering on
+# in power_on_order, then waiting power_on_delay seconds before the next), and
+# a button. Holding a target's button power cycles its relay, or every relay
+# if the target has none, and so does its target being dead for
+# auto_cycle_after seconds (if set). Its indicator is degraded once no probe
+# has been good for "alive" seconds, and dead after "dead" seconds, or sooner
+# once its probes' failure detector says so (see FailureDetector in
+# status_engine.py). That detector has the DETECTOR_KEYS options (e.g.,
+# {"dead_after": 3, "degraded": [2, 5], "recover_after": 2}), or is turned off
+# with a null "detector". Target and probe names are at most NAME_BYTES (15)
+# bytes of UTF-8. The topology is JSON (or YAML, if PyYAML is installed),
+# e.g.:
+#    {"targets": [
+#      {"name": "main", "led": {"red": 21, "green": 25}, "button": 26,
+#       "http": {"Bag End": "192.168.123.201"}, "alive": 51, "dead": 111},
+#      {"name": "router", "led": {"red": 16, "green": 20}, "relay": 27,
+#       "button": 13, "ping": {"router": "192.168.123.1"},
+#       "power_on_order": 0, "power_on_delay": 5,
+#       "detector": {"dead_after": 2}},
+#      {"name": "nas", "ping": {"nas": "192.168.123.10"},
+#       "tcp": {"smb": "192.168.123.10:445"},
+#       "http": {"nas-ui": {"address": "192.168.123.10:8080", "method": "HEAD"}},
+#       "dns": {"dns": {"query": "darlingevil.com", "server": "192.168.123.1"}}}
+#    ]}
+#    t = Topology(load_spec(path="/mybox.json"))
+#    for target in t: ...
+#
+
+
+import json
+
+from probes import MAX_SLEEP_BETWEEN_PINGS_SEC, PING_TIMEOUT_SEC
+from probe_log import NAME_BYTES
+from tracing import flag, debug
+
+
+# Debug flags
+DEBUG_TOPOLOGY = flag('topology')
+
+
+# Return the topology spec from the given JSON (or YAML) text, or file
+def load_spec(text=None, path=None):
+  if text is None:
+    with open(path, 'r') as file:
+      text = file.read()
+  if path and (path.endswith('.yaml') or path.endswith('.yml')):
+    import yaml
+    return yaml.safe_load(text)
+  return json.loads(text)
+
+
+# The kinds of probes (keys of a target spec)
+PROBE_KEYS = ('ping', 'http', 'tcp', 'dns')
+
+# The target and probe names are kept in the probe log, which has room for
+# NAME_BYTES (of UTF-8) of each, so longer ones are rejected
+def check_name(name):
+  if len(name.encode('UTF-8')) > NAME_BYTES:
+    raise ValueError('topology: "%s" is longer than %d bytes' % (name, NAME_BYTES))
+  return name
+
+
+DEFAULT_ALIVE_TOLERANCE_SEC = 1 + (MAX_SLEEP_BETWEEN_PINGS_SEC + PING_TIMEOUT_SEC)
+DEFAULT_DEAD_MARGIN_SEC = 60
+DEFAULT_POWER_ON_DELAY_SEC = 1
+DETECTOR_KEYS = ('dead_after', 'degraded', 'recover_after')
+class Target:
+
+  def __init__(self, spec, order):
+    if 'name' not in spec:
+      raise ValueError('topology: every target needs a name')
+    self.name = check_name(str(spec['name']))
+    led = spec.get('led')
+    self.led = None
+    if led is not None:
+      self.led = (led.get('red'), led.get('green'), led.get('blue'))
+    self.relay = spec.get('relay')
+    self.button = spec.get('button')
+    self.probe_specs = dict()
+    for key in PROBE_KEYS:
+      for name, probe in spec.get(key, {}).items():
+        if name in self.probe_specs:
+          raise ValueError('topology: duplicate probe "%s"' % (name))
+        self.probe_specs[check_name(name)] = (key, probe)
+    self.alive_tolerance = float(spec.get('alive', DEFAULT_ALIVE_TOLERANCE_SEC))
+    self.dead_tolerance = float(spec.get('dead', self.alive_tolerance + DEFAULT_DEAD_MARGIN_SEC))
+    self.power_on_order = spec.get('power_on_order', order)
+    self.power_on_delay = float(spec.get('power_on_delay', DEFAULT_POWER_ON_DELAY_SEC))
+    self.auto_cycle_after = spec.get('auto_cycle_after')
+    if self.dead_tolerance < self.alive_tolerance:
+      raise ValueError('topology: "%s" is dead before it is degraded' % (self.name))
+    self.detector = self._detector(spec.get('detector', {}))
+
+  # Return the failure detector options (or False for no detector)
+  def _detector(self, detector):
+    if detector is None:
+      return False
+    for key in detector:
+      if key not in DETECTOR_KEYS:
+        raise ValueError('topology: "%s" has an unknown detector option "%s"' % (self.name, key))
+    options = dict(detector)
+    degraded = options.get('degraded')
+    if degraded is not None:
+      if len(degraded) != 2 or not 0 < int(degraded[0]) <= int(degraded[1]):
+        raise ValueError('topology: "%s" needs a detector "degraded" of [k, n], with 0 < k <= n' % (self.name))
+      options['degraded'] = (int(degraded[0]), int(degraded[1]))
+    return options
+
+  # Return the names of all of this target's probes
+  def probes(self):
+    return list(self.probe_specs.keys())
+
+  # Return the output pins of this target (LED and relay) in use
+  def outputs(self):
+    pins = [] if self.led is None else [p for p in self.led if p is not None]
+    if self.relay is not None:
+      pins.append(self.relay)
+    return pins
+
+
+class Topology:
+
+  def __init__(self, spec):
+    self._targets = [Target(t, i) for i, t in enumerate(spec.get('targets', []))]
+    self._by_name = {}
+    self._by_probe = {}
+    pins = {}
+    for t in self._targets:
+      if t.name in self._by_name:
+        raise ValueError('topology: duplicate target "%s"' % (t.name))
+      self._by_name[t.name] = t
+      for probe in t.probes():
+        if probe in self._by_probe:
+          raise ValueError('topology: duplicate probe "%s"' % (probe))
+        self._by_probe[probe] = t
+      for pin in t.outputs() + ([] if t.button is None else [t.button]):
+        if pin in pins:
+          raise ValueError('topology: pin %s is used by both "%s" and "%s"' % (pin, pins[pin], t.name))
+        pins[pin] = t.name
+      debug(DEBUG_TOPOLOGY, '--> "%s": led=%s relay=%s button=%s probes=%s', t.name, t.led, t.relay, t.button, t.probes())
+
+  def __iter__(self):
+    return iter(self._targets)
+
+  def __len__(self):
+    return len(self._targets)
+
+  def __getitem__(self, name):
+    return self._by_name[name]
+
+  def names(self):
+    return [t.name for t in self._targets]
+
+  # Return the target that a probe drives the indicator of
+  def target_of(self, probe):
+    return self._by_probe[probe]
+
+  # Return all of the probes, as {name: (key, address or options)}
+  def probes(self):
+    j = dict()
+    for t in self._targets:
+      j.update(t.probe_specs)
+    return j
+
+  # Return the targets with relays, in the order they are powered on
+  def power_on_order(self):
+    return sorted([t for t in self._targets if t.relay is not None], key=lambda t: t.power_on_order)
+
+
@@ -0,0 +1,107 @@
+#
+# Tracing for my network monitor box
+#
+# Every module's debug output goes through here, under a named flag for its
+# subsystem (e.g., "probes"). The flags can be switched on and off while the
+# daemon runs: over HTTP (see /trace in mybox.py), with SIGUSR1 (which toggles
+# the subsystems in MY_TRACE_SIGNAL, by default all of them), or at startup
+# with MY_TRACE (a comma separated list of subsystems, or "all"). A message is
+# only formatted (and any callable argument only called for its value) when
+# its flag is on, so a call site costs next to nothing while it is off. The
+# records are printed, and kept in a bounded ring that can be read back from
+# any sequence number. E.g.:
+#    DEBUG_PROBES = flag('probes')
+#    debug(DEBUG_PROBES, '<-- %s [%s] %s', name, status, lambda: costly(name))
+#    enable(['probes'])
+#    records(since=0)
+#
+
+
+import os
+import threading
+import time
+from collections import deque
+
+
+# A switchable flag (which is truthy while it is on)
+class Flag:
+
+  def __init__(self, name, on):
+    self.name = name
+    self.on = on
+
+  def __bool__(self):
+    return self.on
+
+
+# The subsystems to trace from the start, and the ones SIGUSR1 toggles
+MY_TRACE = [name for name in os.environ.get('MY_TRACE', '').split(',') if name]
+MY_TRACE_SIGNAL = [name for name in os.environ.get('MY_TRACE_SIGNAL', 'all').split(',') if name]
+
+_flags = {}
+_flags_lock = threading.Lock()
+
+# Return the flag of a subsystem (the same one for every module that asks)
+def flag(name, on=False):
+  with _flags_lock:
+    if name not in _flags:
+      _flags[name] = Flag(name, on or name in MY_TRACE or 'all' in MY_TRACE)
+    return _flags[name]
+
+# Return the state of every flag, as {name: on}
+def flags():
+  return dict((name, f.on) for name, f in sorted(_flags.items()))
+
+# Switch flags on (or off) by name ("all" for every one), returning the names
+# of the flags switched. Unknown names raise a KeyError.
+def enable(names, on=True):
+  if 'all' in names:
+    names = list(_flags.keys())
+  for name in names:
+    if name not in _flags:
+      raise KeyError(name)
+  for name in names:
+    _flags[name].on = on
+  return sorted(names)
+
+# Switch flags on, unless they all are already on (then switch them off)
+def toggle(names):
+  if 'all' in names:
+    names = list(_flags.keys())
+  names = [name for name in names if name in _flags]
+  return enable(names, not all(_flags[name].on for name in names))
+
+# Signal handler, to toggle the MY_TRACE_SIGNAL subsystems
+def on_signal(signum, frame):
+  names = toggle(MY_TRACE_SIGNAL)
+  print('Tracing %s: %s' % ('on' if names and _flags[names[0]].on else 'off', ', '.join(names)))
+
+
+# The ring of trace records, as (sequence number, time, subsystem, message)
+TRACE_RING_LENGTH = 2000
+_ring = deque(maxlen=TRACE_RING_LENGTH)
+_ring_lock = threading.Lock()
+_next_seq = 1
+
+# Trace a message (fmt % args) if the flag is on
+def debug(flag, fmt, *args):
+  global _next_seq
+  if not flag:
+    return
+  if args:
+    fmt = fmt % tuple(a() if callable(a) else a for a in args)
+  with _ring_lock:
+    _ring.append((_next_seq, time.time(), getattr(flag, 'name', None), fmt))
+    _next_seq += 1
+  print(fmt)
+
+# Return the records in the ring after the given sequence number (optionally
+# only those of the given subsystems), as dicts
+def records(since=0, subsystems=None):
+  with _ring_lock:
+    found = [r for r in _ring if r[0] > since and (not subsystems or r[2] in subsystems)]
+  return [{'seq': r[0], 'time': r[1], 'subsystem': r[2], 'message': r[3]} for r in found]
+
+# Return the sequence number of the latest record (or 0)
+def last_seq():
+  return _next_seq - 1